@@ -0,0 +1,136 @@
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from geopy.exc import GeocoderUnavailable
+
+from code.geocoders import NOT_FOUND, get_geocoder_chain
+from code.location_tools import get_address_spellings
+
+
+# number of addresses geocoded at the same time; the calls to the remote
+# geocoder are further limited by its rate limiter (see `geocoders`)
+DEFAULT_N_WORKERS = 4
+
+# number of times an address is tried again when no geocoder could answer,
+# and the wait (in seconds) before the first retry, doubled after each one;
+# the wait is extended until the circuit breakers of the skipped geocoders let
+# calls through again
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 1.
+
+
+def _geocode_once(street_address, city=None, state=None):
+    """Geocode an address, trying all of its spellings.
+
+    Return the geopy Location of the address, or None if it can't be
+    geocoded. Raise `GeocoderUnavailable` if none of the spellings was found
+    and no geocoder could answer for at least one of them."""
+    chain = get_geocoder_chain()
+    deadline = chain.get_deadline()
+
+    answered = True
+    for full_address in get_address_spellings(street_address, city, state):
+        location = chain.lookup(full_address, deadline=deadline)
+        if location is None:
+            answered = False
+        elif location is not NOT_FOUND:
+            return location
+
+    if not answered:
+        raise GeocoderUnavailable(f"No geocoder answered for: {street_address}")
+
+    return None
+
+
+def _geocode_with_retries(street_address, city, state,
+                          max_retries, backoff, sleep):
+    """Geocode an address, retrying with exponential backoff."""
+    for attempt in range(max_retries + 1):
+        try:
+            return _geocode_once(street_address, city, state)
+        except GeocoderUnavailable:
+            if attempt == max_retries:
+                return None
+            sleep(max(backoff * 2**attempt,
+                      get_geocoder_chain().retry_after()))
+
+
+def geocode_addresses(addresses,
+                      city=None,
+                      state=None,
+                      n_workers=DEFAULT_N_WORKERS,
+                      max_retries=DEFAULT_MAX_RETRIES,
+                      backoff=DEFAULT_BACKOFF,
+                      sleep=time.sleep):
+    """Geocode a list of addresses.
+
+    Return the geopy Locations of the addresses, in the same order, with None
+    for the addresses that could not be geocoded. The addresses are spelled
+    out like in `get_coords_from_address`, and are geocoded by `n_workers`
+    threads through the process-wide geocoder chain, so the calls to the
+    remote geocoder are rate limited, and the addresses already geocoded
+    (e.g., by an earlier, interrupted run) are answered from the geocode
+    cache. Addresses for which no geocoder could answer are tried again up to
+    `max_retries` times, waiting `backoff` seconds before the first retry and
+    twice as long before each of the next ones, or until the geocoders that
+    were skipped because their circuit breaker was open can be called again,
+    whichever is longer. Duplicate addresses are only geocoded once."""
+    unique_addresses = list(dict.fromkeys(addresses))
+
+    def _geocode(address):
+        return _geocode_with_retries(address, city, state,
+                                     max_retries, backoff, sleep)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        locations = dict(zip(unique_addresses,
+                             executor.map(_geocode, unique_addresses)))
+
+    return [locations[address] for address in addresses]
+
+
+def main(argv=None):
+    """Geocode a file of addresses from the command line.
+
+    The input file has one address per line. The output is a CSV file with
+    the address, longitude, and latitude of each address, in the same order;
+    the coordinates are left empty for the addresses that can't be geocoded.
+    Re-running the command after an interruption resumes from the geocode
+    cache."""
+    parser = argparse.ArgumentParser(description=main.__doc__.split('\n')[0])
+    parser.add_argument('address_file',
+                        help="file with one address per line")
+    parser.add_argument('-o', '--output', default=None,
+                        help="output CSV file (default: standard output)")
+    parser.add_argument('--city', default=None,
+                        help="city added to the addresses")
+    parser.add_argument('--state', default=None,
+                        help="state added to the addresses")
+    parser.add_argument('-n', '--n-workers', type=int,
+                        default=DEFAULT_N_WORKERS,
+                        help="number of addresses geocoded at the same time")
+    parser.add_argument('--max-retries', type=int,
+                        default=DEFAULT_MAX_RETRIES,
+                        help="number of retries when no geocoder answers")
+    args = parser.parse_args(argv)
+
+    with open(args.address_file, 'r') as f:
+        addresses = [line.strip() for line in f if line.strip()]
+
+    locations = geocode_addresses(addresses,
+                                  city=args.city,
+                                  state=args.state,
+                                  n_workers=args.n_workers,
+                                  max_retries=args.max_retries)
+
+    pd.DataFrame({
+        'address': addresses,
+        'longitude': [lct.longitude if lct else None for lct in locations],
+        'latitude': [lct.latitude if lct else None for lct in locations],
+    }).to_csv(args.output or sys.stdout, index=False)
+
+
+if __name__ == "__main__":
+    main()
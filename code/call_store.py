@@ -0,0 +1,295 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from code.exceptions import CallStoreError
+from code.mappings import CALL_SCHEMA
+
+
+# column on which the medical calls are partitioned in the Parquet store;
+# it is derived from 'Received DtTm' when the calls are written
+PARTITION_COL = 'Received Year'
+
+# columns holding `shapely` geometries, which are stored as WKB
+GEOMETRY_COLS = ['Coords']
+
+
+def apply_call_schema(df, schema=CALL_SCHEMA):
+    """Cast the columns of a medical calls dataframe to their compact dtypes.
+
+    Columns that are not in the dataframe, or that already have the right
+    dtype, are skipped. Tract codes stored as strings are converted to
+    integers, with missing tracts left as <NA>."""
+    for col, dtype in schema.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        if dtype == 'Int64' and df[col].dtype == object:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+        df[col] = df[col].astype(dtype)
+
+    return df
+
+
+def concat_medical_calls(dfs, ignore_index=False):
+    """Concatenate dataframes of medical calls, keeping their categoricals.
+
+    `pd.concat` turns categorical columns whose categories differ between
+    the dataframes (e.g., chunks of the call dataset) into object columns,
+    which take many times more memory. The categories of these columns are
+    first set to the union of the categories of all the dataframes, which
+    only remaps their integer codes, so they stay categorical."""
+    dfs = list(dfs)
+    for col in dfs[0].columns:
+        if not all(col in df.columns and
+                   isinstance(df[col].dtype, pd.CategoricalDtype)
+                   for df in dfs):
+            continue
+
+        categories = dfs[0][col].cat.categories
+        for df in dfs[1:]:
+            categories = categories.union(df[col].cat.categories)
+        for df in dfs:
+            df[col] = df[col].cat.set_categories(categories)
+
+    return pd.concat(dfs, ignore_index=ignore_index)
+
+
+def memory_report(df):
+    """Return the memory used by each column of a dataframe.
+
+    The report lists the dtype and the memory (in MB, including the memory
+    of the Python objects in object columns) of each column, as well as the
+    total memory used by the dataframe."""
+    memory = df.memory_usage(index=True, deep=True) / 1024.**2
+    report = pd.DataFrame({
+        'dtype': [str(df.index.dtype)] + [str(df[col].dtype)
+                                          for col in df.columns],
+        'memory_MB': memory.values,
+    }, index=memory.index)
+    report.loc['Total'] = ['', report['memory_MB'].sum()]
+
+    return report
+
+
+def is_parquet_store(filename):
+    """Return True if the filename points to a Parquet store of calls."""
+    return filename.endswith('.parquet')
+
+
+def _build_filters(years=None, unit_types=None, priorities=None):
+    """Build the Parquet row filters for a query on the medical calls.
+
+    `years` is an inclusive (first year, last year) range; either end can be
+    None. `unit_types` and `priorities` are lists of the allowed 'Unit Type'
+    and 'Original Priority' values."""
+    filters = []
+    if years:
+        first_year, last_year = years
+        if first_year is not None:
+            filters.append((PARTITION_COL, '>=', int(first_year)))
+        if last_year is not None:
+            filters.append((PARTITION_COL, '<=', int(last_year)))
+    if unit_types is not None:
+        filters.append(('Unit Type', 'in', list(unit_types)))
+    if priorities is not None:
+        filters.append(('Original Priority', 'in', list(priorities)))
+
+    return filters or None
+
+
+def _write_partitions(df, dirname):
+    """Write the medical calls to a new Parquet store partitioned by year."""
+    df = df.copy()
+    df[PARTITION_COL] = df['Received DtTm'].dt.year
+    for col in GEOMETRY_COLS:
+        if col in df.columns:
+            df[col] = shapely.to_wkb(df[col].values)
+
+    df.to_parquet(dirname,
+                  engine='pyarrow',
+                  partition_cols=[PARTITION_COL],
+                  index=False)
+
+
+def recover_interrupted_write(dirname):
+    """Repair a Parquet store after an interrupted write or upsert.
+
+    The partitions that an interrupted `write_medical_calls` or
+    `upsert_medical_calls` had moved aside are moved back into the store, if
+    the store has no partition for their year; the other ones have already
+    been replaced by their new version, and are removed. The new partitions
+    that hadn't been swapped in yet are dropped, since the calls in them are
+    only recorded as ingested once the write is done (see `CallWatermark`).
+    Raise a `CallStoreError` if the store is missing, but some of its old
+    partitions were left aside."""
+    dirname = os.path.normpath(dirname)
+    staging_dirname = f"{dirname}.staging"
+
+    for old_dirname in [f"{dirname}.old",
+                        os.path.join(staging_dirname, 'old')]:
+        if not os.path.isdir(old_dirname):
+            continue
+
+        if not os.path.isdir(dirname):
+            # only a full overwrite moves the whole store aside
+            if old_dirname != f"{dirname}.old":
+                raise CallStoreError(dirname, "the store is missing, but "
+                                     f"some of its partitions are in "
+                                     f"{old_dirname}")
+            os.replace(old_dirname, dirname)
+            continue
+
+        for partition in os.listdir(old_dirname):
+            if not os.path.exists(os.path.join(dirname, partition)):
+                os.replace(os.path.join(old_dirname, partition),
+                           os.path.join(dirname, partition))
+        shutil.rmtree(old_dirname)
+
+    for tmp_dirname in [f"{dirname}.new", staging_dirname]:
+        if os.path.isdir(tmp_dirname):
+            shutil.rmtree(tmp_dirname)
+
+
+def write_medical_calls(df, dirname, overwrite=True):
+    """Write the medical calls to a Parquet store partitioned by year.
+
+    Each year of calls is written to its own directory, so that reading a
+    range of years only touches the files for those years. Geometry columns
+    are stored as WKB. If `overwrite=True`, any existing store is replaced;
+    otherwise, the calls are added to the existing store.
+
+    A store being replaced is only removed once the new one is fully
+    written, so an interrupted write leaves the old store in place, or
+    aside, from where it's moved back by the next write (see
+    `recover_interrupted_write`)."""
+    dirname = os.path.normpath(dirname)
+    recover_interrupted_write(dirname)
+    if not (overwrite and os.path.isdir(dirname)):
+        _write_partitions(df, dirname)
+        return
+
+    new_dirname = f"{dirname}.new"
+    old_dirname = f"{dirname}.old"
+    _write_partitions(df, new_dirname)
+    os.replace(dirname, old_dirname)
+    os.replace(new_dirname, dirname)
+    shutil.rmtree(old_dirname)
+
+
+def _partition_dir(dirname, year):
+    """Return the directory of the partition holding a year of calls."""
+    return os.path.join(dirname, f'{PARTITION_COL}={year}')
+
+
+def upsert_medical_calls(df, dirname):
+    """Add new calls to a Parquet store and replace updated ones.
+
+    Calls are matched on 'RowID'. Only the partitions containing the years
+    of the new calls, or older versions of the updated calls, are read and
+    rewritten; all the other partitions are left untouched.
+
+    The rewritten partitions are first written to a staging store next to
+    the store, and only then swapped in, one directory rename per partition.
+    The old partitions are moved to the staging store, and only deleted once
+    all the new ones are in place, so an interrupted upsert never loses any
+    calls: they are either still in the store, or in the staging store, from
+    where they're moved back by the next write (see
+    `recover_interrupted_write`)."""
+    dirname = os.path.normpath(dirname)
+    recover_interrupted_write(dirname)
+    if not os.path.isdir(dirname):
+        write_medical_calls(df, dirname)
+        return
+
+    # reading only the RowID column of the store is cheap, and it tells which
+    # partitions hold older versions of the calls being written
+    stored_ids = read_medical_calls(dirname,
+                                    columns=['RowID', PARTITION_COL])
+    is_updated = stored_ids['RowID'].isin(df['RowID'])
+    years = set(stored_ids.loc[is_updated, PARTITION_COL].astype(int))
+    years |= set(df['Received DtTm'].dt.year)
+
+    partitions = [df]
+    for year in sorted(years):
+        if os.path.isdir(_partition_dir(dirname, year)):
+            stored = read_medical_calls(dirname, years=(year, year))
+            partitions.append(stored[~stored['RowID'].isin(df['RowID'])])
+    partitions = concat_medical_calls(partitions, ignore_index=True)
+
+    staging_dirname = f"{dirname}.staging"
+    new_dirname = os.path.join(staging_dirname, 'new')
+    old_dirname = os.path.join(staging_dirname, 'old')
+    os.makedirs(old_dirname)
+    if not partitions.empty:
+        _write_partitions(partitions, new_dirname)
+
+    for year in sorted(years):
+        if os.path.isdir(_partition_dir(dirname, year)):
+            os.replace(_partition_dir(dirname, year),
+                       _partition_dir(old_dirname, year))
+        if os.path.isdir(_partition_dir(new_dirname, year)):
+            os.replace(_partition_dir(new_dirname, year),
+                       _partition_dir(dirname, year))
+
+    shutil.rmtree(staging_dirname)
+
+
+def read_medical_calls(dirname,
+                       columns=None,
+                       years=None,
+                       unit_types=None,
+                       priorities=None):
+    """Read the medical calls from a Parquet store.
+
+    Only the given `columns` are read (all of them if None), and only the
+    calls matching the row filters (see `_build_filters`) are returned. Year
+    ranges are resolved from the partition directories, without opening the
+    files of the other years."""
+    df = pd.read_parquet(
+        dirname,
+        engine='pyarrow',
+        columns=columns,
+        filters=_build_filters(years, unit_types, priorities),
+    )
+
+    # the partition column is only kept if explicitly requested
+    if PARTITION_COL in df.columns and not (columns and
+                                            PARTITION_COL in columns):
+        df.drop(PARTITION_COL, axis=1, inplace=True)
+
+    for col in GEOMETRY_COLS:
+        if col in df.columns:
+            df[col] = shapely.from_wkb(df[col].values)
+
+    return apply_call_schema(df)
+
+
+def filter_medical_calls(df,
+                         columns=None,
+                         years=None,
+                         unit_types=None,
+                         priorities=None):
+    """Apply the Parquet store projection and row filters to a dataframe.
+
+    This makes the calls read from a pickled dataframe match those read from
+    a Parquet store with the same query."""
+    is_selected = np.ones(len(df), dtype=bool)
+    if years:
+        first_year, last_year = years
+        call_years = df['Received DtTm'].dt.year.values
+        if first_year is not None:
+            is_selected &= call_years >= int(first_year)
+        if last_year is not None:
+            is_selected &= call_years <= int(last_year)
+    if unit_types is not None:
+        is_selected &= df['Unit Type'].isin(unit_types).values
+    if priorities is not None:
+        is_selected &= df['Original Priority'].isin(priorities).values
+    df = df[is_selected]
+    if columns is not None:
+        df = df[columns]
+
+    return df
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import shutil
+
+import numpy as np
+
+from code.facilities import FACILITY_TABLES, get_facilities
+from code.key_utils import get_secret_key
+from code.file_version import get_file_version, expire_file_version
+from code.mappings import DEGREES_TO_KM, DEGREES_TO_MILES, EARTH_RADIUS_MILES
+
+
+# default spacing (in meters) between the nodes of the distance raster
+DEFAULT_RASTER_RESOLUTION = 20.
+
+DATA_DIR = get_secret_key('DATA_DIR')
+
+# directory of the distance raster in the data directory; each build is
+# written to its own subdirectory, and the file `CURRENT_BUILD_FILENAME`
+# names the subdirectory of the build in use
+DISTANCE_RASTER_DIR = "Facility_Distance_Raster/"
+CURRENT_BUILD_FILENAME = "CURRENT"
+
+# distance rasters loaded by the whole process, by directory, with the
+# version of the file naming their build when they were loaded
+_DISTANCE_RASTERS = {}
+
+
+def _cell_diagonal_miles(lng0, lat0, dlng, dlat, haversine):
+    """Return the length (in miles) of the diagonal of a raster cell."""
+    if not haversine:
+        return DEGREES_TO_MILES * np.hypot(dlng, dlat)
+
+    # the cells are widest at the latitude closest to the equator
+    lat = np.radians(lat0)
+    a = np.sin(np.radians(dlat) / 2)**2 + \
+        np.cos(lat) * np.cos(lat + np.radians(dlat)) * \
+        np.sin(np.radians(dlng) / 2)**2
+
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+
+
+class DistanceRaster:
+    """Precomputed distances to the nearest facilities over a grid.
+
+    The distance (in miles) to the nearest facility of each type, and the ID
+    of that facility, are stored at the nodes of a regular (lng, lat) grid.
+    The distance at any location inside the grid is bilinearly interpolated
+    from the four nodes around it. The distance to the nearest facility
+    changes by at most the distance moved, so the interpolated distance is
+    within the length of a cell diagonal (`error_bound`, in miles) of the
+    exact one; that is about 0.02 miles with the default 20 m resolution.
+    The nearest facility ID is the one of the closest node, so it may differ
+    from the exact one near the boundaries between facilities.
+
+    The arrays are memory-mapped from disk, so loading the raster is cheap,
+    and only the parts of the grid that are read are brought into memory."""
+
+    def __init__(self, dirname, mmap_mode='r'):
+        with open(os.path.join(dirname, 'raster.json'), 'r') as f:
+            self.meta = json.load(f)
+
+        self.lng0 = self.meta['lng0']
+        self.lat0 = self.meta['lat0']
+        self.dlng = self.meta['dlng']
+        self.dlat = self.meta['dlat']
+        self.haversine = self.meta['haversine']
+        self.error_bound = self.meta['error_bound']
+
+        self.distances = {}
+        self.ids = {}
+        for kind in self.meta['checksums']:
+            self.distances[kind] = np.load(
+                os.path.join(dirname, f'{kind}_distance.npy'),
+                mmap_mode=mmap_mode,
+            )
+            self.ids[kind] = np.load(
+                os.path.join(dirname, f'{kind}_id.npy'),
+                mmap_mode=mmap_mode,
+            )
+
+        self.shape = tuple(self.meta['shape'])
+
+    def is_current(self, kind, facilities):
+        """Return True if the raster was built for the given facilities."""
+        return self.meta['checksums'].get(kind) == facilities.checksum
+
+    def lookup(self, kind, lngs, lats):
+        """Look up the distances to, and IDs of, the nearest facilities.
+
+        Return the distances (in miles), the IDs, and a mask of the locations
+        inside the raster; the distances of the locations outside the raster
+        are NaN, and their IDs are None."""
+        lngs = np.asarray(lngs, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+
+        # fractional (row, column) position of the locations in the grid
+        rows = (lats - self.lat0) / self.dlat
+        cols = (lngs - self.lng0) / self.dlng
+
+        n_rows, n_cols = self.shape
+        is_inside = (rows >= 0) & (rows <= n_rows - 1) & \
+                    (cols >= 0) & (cols <= n_cols - 1)
+
+        distances = np.full(len(lngs), np.nan)
+        ids = np.full(len(lngs), None, dtype=object)
+        if not is_inside.any():
+            return distances, ids, is_inside
+
+        rows = rows[is_inside]
+        cols = cols[is_inside]
+        row0 = np.minimum(rows.astype(np.intp), n_rows - 2)
+        col0 = np.minimum(cols.astype(np.intp), n_cols - 2)
+        u = rows - row0
+        v = cols - col0
+
+        grid = self.distances[kind]
+        distances[is_inside] = \
+            (1 - u) * (1 - v) * grid[row0, col0] + \
+            (1 - u) * v * grid[row0, col0 + 1] + \
+            u * (1 - v) * grid[row0 + 1, col0] + \
+            u * v * grid[row0 + 1, col0 + 1]
+
+        ids[is_inside] = self.ids[kind][np.rint(rows).astype(np.intp),
+                                        np.rint(cols).astype(np.intp)]
+
+        return distances, ids, is_inside
+
+
+def _read_current_build(dirname):
+    """Return the subdirectory of the raster build in use, or None."""
+    try:
+        with open(os.path.join(dirname, CURRENT_BUILD_FILENAME), 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _remove_old_builds(dirname, keep):
+    """Remove the raster builds other than those to `keep`.
+
+    The build that was in use before the last one is kept too, since other
+    processes may still be loading it."""
+    for build in os.listdir(dirname):
+        build_dirname = os.path.join(dirname, build)
+        if build not in keep and os.path.isdir(build_dirname):
+            shutil.rmtree(build_dirname)
+
+
+def build_distance_raster(bounds=None,
+                          resolution=DEFAULT_RASTER_RESOLUTION,
+                          haversine=False,
+                          dirname=DISTANCE_RASTER_DIR,
+                          facilities=None):
+    """Precompute the distances to the nearest facilities over a grid.
+
+    The grid covers the (lng_min, lat_min, lng_max, lat_max) `bounds`, by
+    default those of the census tracts of the county, with nodes spaced by
+    `resolution` meters. `facilities` maps the facility types to their
+    `Facilities`; by default, all the facilities in the database are used.
+    The raster is written to a new subdirectory of `dirname` in the data
+    directory (see `DistanceRaster`), which is only then made the one in
+    use, so that processes loading the raster during the build still get
+    the whole previous one."""
+    dirname = DATA_DIR + dirname
+
+    if bounds is None:
+        # hacky way to avoid circular imports... :-/
+        from code.tract_tools import get_tract_locator
+        bounds = get_tract_locator().bounds
+
+    if facilities is None:
+        facilities = {kind: get_facilities(kind) for kind in FACILITY_TABLES}
+
+    lng_min, lat_min, lng_max, lat_max = bounds
+    dlat = resolution / (DEGREES_TO_KM * 1000.)
+    dlng = dlat / np.cos(np.radians(max(abs(lat_min), abs(lat_max))))
+
+    # the grid extends one node past the bounds, so they're fully covered
+    lat_nodes = lat_min + dlat * np.arange(
+        int(np.ceil((lat_max - lat_min) / dlat)) + 2
+    )
+    lng_nodes = lng_min + dlng * np.arange(
+        int(np.ceil((lng_max - lng_min) / dlng)) + 2
+    )
+    lngs, lats = np.meshgrid(lng_nodes, lat_nodes)
+
+    build = f"build_{time.time_ns()}"
+    build_dirname = os.path.join(dirname, build)
+    os.makedirs(build_dirname)
+
+    checksums = {}
+    for kind, kind_facilities in facilities.items():
+        distances, ids = kind_facilities.nearest(lngs.ravel(),
+                                                 lats.ravel(),
+                                                 haversine=haversine)
+        np.save(os.path.join(build_dirname, f'{kind}_distance.npy'),
+                distances.reshape(lngs.shape).astype(np.float32))
+        np.save(os.path.join(build_dirname, f'{kind}_id.npy'),
+                ids.reshape(lngs.shape).astype(np.int32))
+        checksums[kind] = kind_facilities.checksum
+
+    with open(os.path.join(build_dirname, 'raster.json'), 'w') as f:
+        json.dump({
+            'lng0': float(lng_min),
+            'lat0': float(lat_min),
+            'dlng': float(dlng),
+            'dlat': float(dlat),
+            'shape': list(lngs.shape),
+            'resolution': float(resolution),
+            'haversine': haversine,
+            'error_bound': float(_cell_diagonal_miles(lng_min, lat_min,
+                                                      dlng, dlat,
+                                                      haversine)),
+            'checksums': checksums,
+        }, f)
+
+    # the new build is only put in use once it's complete
+    previous_build = _read_current_build(dirname)
+    current_fp = os.path.join(dirname, CURRENT_BUILD_FILENAME)
+    with open(f"{current_fp}.tmp", 'w') as f:
+        f.write(f"{build}\n")
+    os.replace(f"{current_fp}.tmp", current_fp)
+    expire_file_version(current_fp)
+
+    _remove_old_builds(dirname, keep=[build, previous_build])
+
+
+def get_distance_raster(dirname=DISTANCE_RASTER_DIR):
+    """Return the distance raster, or None if it hasn't been built.
+
+    The raster is only loaded once per process, and loaded again when it's
+    rebuilt (e.g., by `seed.py` after the facility tables are reloaded),
+    which is checked at most once per second (see `FileVersion`)."""
+    dirname = DATA_DIR + dirname
+    current_fp = os.path.join(dirname, CURRENT_BUILD_FILENAME)
+
+    version = get_file_version(current_fp)
+    if version is None:
+        _DISTANCE_RASTERS.pop(dirname, None)
+        return None
+
+    entry = _DISTANCE_RASTERS.get(dirname)
+    if entry is None or entry[0] != version:
+        build = _read_current_build(dirname)
+        _DISTANCE_RASTERS[dirname] = (
+            version,
+            DistanceRaster(os.path.join(dirname, build)),
+        )
+
+    return _DISTANCE_RASTERS[dirname][1]
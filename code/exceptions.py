@@ -18,3 +18,12 @@ class AddressError(Error):
 
     def __str__(self):
         return str(self.message)
+
+class CallStoreError(Error):
+    """Exception raised when the store of medical calls can't be repaired."""
+
+    def __init__(self, dirname, message):
+        self.message = f"Parquet store {dirname}: {message}"
+
+    def __str__(self):
+        return str(self.message)
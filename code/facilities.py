@@ -0,0 +1,185 @@
+import os
+import time
+import hashlib
+from functools import cached_property
+
+import numpy as np
+import shapely
+from sklearn.neighbors import KDTree, BallTree
+
+from code.db_model import SFHospital, SFFDFireStation
+from code.key_utils import get_secret_key
+from code.file_version import get_file_version, expire_file_version
+from code.mappings import DEGREES_TO_MILES, EARTH_RADIUS_MILES
+
+
+DATA_DIR = get_secret_key('DATA_DIR')
+
+
+# tables of facilities, with their ID and name columns
+FACILITY_TABLES = {
+    'hospitals': (SFHospital, 'hospital_id', 'hospital_name'),
+    'fire_stations': (SFFDFireStation, 'station_id', 'station_name'),
+}
+
+# file in the data directory whose modification time is the version of the
+# facility tables; it's rewritten by `seed.py` each time they're reloaded
+FACILITIES_VERSION_FILENAME = 'Facilities_Version'
+
+# facilities loaded by the whole process, by type of facility, with the
+# version of the tables they were read from
+_FACILITY_REGISTRY = {}
+
+
+class Facilities:
+    """Locations of the facilities of one type (e.g., hospitals).
+
+    The IDs and names of the facilities are kept in arrays, and their
+    (longitude, latitude) coordinates in a contiguous (n, 2) array, in the
+    same order."""
+
+    def __init__(self, ids, names, lngs, lats):
+        self.ids = np.asarray(ids)
+        self.names = np.asarray(names, dtype=object)
+        self.coords = np.ascontiguousarray(
+            np.column_stack([lngs, lats]),
+            dtype=np.float64,
+        )
+
+        # the POINT geometries are created once, rather than for each use
+        self.points = shapely.points(self.coords)
+
+        # the spatial indexes are built on first use
+        self._trees = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @cached_property
+    def checksum(self):
+        """Checksum of the IDs and coordinates of the facilities.
+
+        It's computed once per set of facilities, which are not modified
+        once loaded."""
+        md5 = hashlib.md5()
+        md5.update(np.asarray(self.ids, dtype=np.int64).tobytes())
+        md5.update(self.coords.tobytes())
+
+        return md5.hexdigest()
+
+    def _get_tree(self, haversine):
+        """Return the spatial index over the facility coordinates.
+
+        The flat distances are found with a KD-tree over the (lng, lat)
+        coordinates in degrees, and the haversine distances with a ball tree
+        over the (lat, lng) coordinates in radians."""
+        if haversine not in self._trees:
+            if haversine:
+                self._trees[haversine] = BallTree(
+                    np.radians(self.coords[:, ::-1]),
+                    metric='haversine',
+                )
+            else:
+                self._trees[haversine] = KDTree(self.coords)
+
+        return self._trees[haversine]
+
+    def nearest(self, lngs, lats, haversine=False):
+        """Find the nearest facility to each of a set of locations.
+
+        Return the distances (in miles) to the nearest facilities, and their
+        IDs. By default, the distances are the flat distances in degrees
+        converted with `DEGREES_TO_MILES`, as used to train the model; if
+        `haversine=True`, they are the great-circle distances. Locations with
+        NaN coordinates get a NaN distance and a None ID."""
+        lngs = np.asarray(lngs, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+
+        distances = np.full(len(lngs), np.nan)
+        ids = np.full(len(lngs), None, dtype=object)
+
+        is_valid = np.isfinite(lngs) & np.isfinite(lats)
+        if not is_valid.any() or not len(self):
+            return distances, ids
+
+        if haversine:
+            query = np.radians(np.column_stack([lats[is_valid],
+                                                lngs[is_valid]]))
+            scale = EARTH_RADIUS_MILES
+        else:
+            query = np.column_stack([lngs[is_valid], lats[is_valid]])
+            scale = DEGREES_TO_MILES
+
+        dist, index = self._get_tree(haversine).query(query, k=1)
+        distances[is_valid] = dist[:, 0] * scale
+        ids[is_valid] = self.ids[index[:, 0]]
+
+        return distances, ids
+
+
+def _load_facilities(kind):
+    """Read the facilities of one type from the database."""
+    # hacky way to avoid circular imports... :-/
+    from code.flaskr import app
+    from code.db_model import db, connect_to_db
+    connect_to_db(app)
+
+    db_table, id_col, name_col = FACILITY_TABLES[kind]
+
+    # the coordinates are extracted by PostGIS, so no WKB has to be decoded
+    rows = db_table.query.with_entities(
+        getattr(db_table, id_col),
+        getattr(db_table, name_col),
+        db.func.ST_X(db_table.coords),
+        db.func.ST_Y(db_table.coords),
+    ).order_by(getattr(db_table, id_col)).all()
+
+    ids, names, lngs, lats = zip(*rows) if rows else ([], [], [], [])
+
+    return Facilities(ids, names, lngs, lats)
+
+
+def get_facilities(kind):
+    """Return the facilities of one type ('hospitals' or 'fire_stations').
+
+    The facilities are read from the database the first time they're needed,
+    and then kept for the whole process, so that no database query is made
+    when handling a request. They're read again when the version of the
+    facility tables changes, i.e., when another process (e.g., `seed.py`)
+    calls `update_facilities_version` after reloading the tables; the
+    version is checked at most once per second (see `FileVersion`)."""
+    version = get_file_version(DATA_DIR + FACILITIES_VERSION_FILENAME)
+
+    entry = _FACILITY_REGISTRY.get(kind)
+    if entry is None or entry[0] != version:
+        _FACILITY_REGISTRY[kind] = (version, _load_facilities(kind))
+
+    return _FACILITY_REGISTRY[kind][1]
+
+
+def update_facilities_version():
+    """Mark the facility tables as reloaded.
+
+    All the processes, including this one, read the facilities again the
+    next time they're needed. The version file is written to a temporary
+    file first, then moved in place, so its modification time changes even
+    if the tables are reloaded twice within the resolution of the clock."""
+    version_fp = DATA_DIR + FACILITIES_VERSION_FILENAME
+
+    with open(f"{version_fp}.tmp", 'w') as f:
+        f.write(f"{time.time()}\n")
+    os.replace(f"{version_fp}.tmp", version_fp)
+    expire_file_version(version_fp)
+
+    invalidate_facilities()
+
+
+def invalidate_facilities(kind=None):
+    """Read the facilities of one type (or all of them) again on next use.
+
+    This only affects the current process; see `update_facilities_version`
+    to reload them in all the processes."""
+    if kind is None:
+        _FACILITY_REGISTRY.clear()
+    else:
+        _FACILITY_REGISTRY.pop(kind, None)
@@ -0,0 +1,69 @@
+import os
+import time
+import threading
+
+
+# minimum time (in seconds) between two checks of the version of a file
+VERSION_CHECK_INTERVAL = 1.
+
+
+class FileVersion:
+    """Version of a file that is replaced by other processes.
+
+    The version is the modification time and inode of the file, or None if
+    the file doesn't exist; files replaced with `os.replace` always get a
+    new version. To keep the checks cheap enough to be made on each request,
+    the file is only looked at once every `interval` seconds; in between,
+    the last version seen is returned."""
+
+    def __init__(self, fp, interval=VERSION_CHECK_INTERVAL,
+                 clock=time.monotonic):
+        self.fp = fp
+        self.interval = interval
+        self.clock = clock
+        self._version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the version of the file."""
+        with self._lock:
+            now = self.clock()
+            if self._checked_at is None or \
+                    now - self._checked_at >= self.interval:
+                try:
+                    stat = os.stat(self.fp)
+                    self._version = (stat.st_mtime_ns, stat.st_ino)
+                except FileNotFoundError:
+                    self._version = None
+                self._checked_at = now
+
+            return self._version
+
+    def expire(self):
+        """Look at the file again on the next check."""
+        with self._lock:
+            self._checked_at = None
+
+
+# versions of the files checked by the whole process, by file path
+_FILE_VERSIONS = {}
+
+
+def get_file_version(fp):
+    """Return the version of a file (see `FileVersion`)."""
+    if fp not in _FILE_VERSIONS:
+        _FILE_VERSIONS.setdefault(fp, FileVersion(fp))
+
+    return _FILE_VERSIONS[fp].get()
+
+
+def expire_file_version(fp=None):
+    """Look at a file (or all of them) again on the next check.
+
+    This is called by the process that replaces a file, so that it picks up
+    the new version at once."""
+    versions = _FILE_VERSIONS.values() if fp is None else \
+        [_FILE_VERSIONS[fp]] if fp in _FILE_VERSIONS else []
+    for version in versions:
+        version.expire()
@@ -3,6 +3,7 @@ from flask_debugtoolbar import DebugToolbarExtension
 from jinja2 import StrictUndefined
 
 from code.db_model import connect_to_db
+from code.location_tools import get_dispatch_location
 from code.key_utils import get_secret_key
 
 app = Flask(__name__)
@@ -26,6 +27,10 @@ if __name__ == "__main__":
 
     connect_to_db(app)
 
+    # resolve the location of the dispatcher at startup, rather than on the
+    # first request
+    get_dispatch_location()
+
     # Use the DebugToolbar
     DebugToolbarExtension(app)
 
@@ -1,19 +1,18 @@
 import datetime as dt
 
 import pandas as pd
-from flask import render_template, request, jsonify, flash, redirect, url_for
+from flask import render_template, request, jsonify, flash, redirect, url_for, \
+                  session
 from shapely.geometry import Point
 
 from code.flaskr import app
-from code.db_model import SFHospital, \
-                          SFFDFireStation
 from code.mappings import US_STATE_ABBR, \
-                          AMBULANCE_UNITS, \
-                          FEATURE_COLS
+                          AMBULANCE_UNITS
 from code.location_tools import get_new_incident_coords, \
-                                get_new_incident_tract, \
-                                get_locations_as_shape
-from code.utils import set_time_features, \
+                                get_new_incident_tract
+from code.facilities import get_facilities
+from code.distance_raster import get_distance_raster
+from code.utils import build_feature_matrix, \
                        load_model, \
                        set_new_incident_priority_code, \
                        set_new_incident_unit_type, \
@@ -73,13 +72,39 @@ def show_incident_density_map():
     )
 
 
+@app.route('/dispatch-location')
+def set_dispatch_location():
+    """Set the location of the dispatcher for the current session.
+
+    The city and state given (the full state name, e.g., 'California') are
+    used to complete the incident addresses entered in this session, instead
+    of the location set for the app. Without a city and state, the location
+    set for the app is used again."""
+    city = request.args.get('city')
+    state = request.args.get('state')
+
+    if not city or not state:
+        session.pop('dispatch_location', None)
+        return jsonify(success='', error_msg=None)
+
+    if state not in US_STATE_ABBR:
+        return jsonify(success='', error_msg=f"Unknown state: {state}")
+
+    session['dispatch_location'] = {'city': city, 'state': state}
+
+    return jsonify(success=f"{city}, {state}", error_msg=None)
+
+
 @app.route('/tract-stats')
 def get_tract_stats():
     """Display the tract statistics."""
     # get the location from the user input
     location = request.args['location']
 
-    lng, lat, city, state = get_new_incident_coords(location)
+    lng, lat, city, state = get_new_incident_coords(
+        location,
+        dispatch_location=session.get('dispatch_location'),
+    )
     print(lng, lat)
     if not lng or not lat:
         return jsonify(
@@ -167,7 +192,10 @@ def estimated_wait_time(
 
     # TODO: If (lng, lat) are None, then the app should flash a warning that
     # the address was not found.
-    lng, lat, city, state = get_new_incident_coords(street_address)
+    lng, lat, city, state = get_new_incident_coords(
+        street_address,
+        dispatch_location=session.get('dispatch_location'),
+    )
     if not lng or not lat:
         return jsonify(
             success='',
@@ -191,7 +219,6 @@ def estimated_wait_time(
     # make a dictionary whose keys match the names of the features in the
     # RF model
     incident_dict = {
-        'Received DtTm': current_DtTm,
         'Tract': tract,
         'Latitude': lat,
         'Longitude': lng,
@@ -215,33 +242,33 @@ def estimated_wait_time(
     # correctly...
     incident_df['Coords'] = Point(lng, lat)
 
-    # take the DataFrame above and set the time features from the
-    # 'Received DtTm' value
-    state_abbr = US_STATE_ABBR[state]
-    incident_df = set_time_features(
-        incident_df,
-        state=state_abbr,
-    )
-
     # add column with distance to the closest hospital
     incident_df = find_dist_to_closest_hospital(
         incident_df,
-        get_locations_as_shape(SFHospital)
+        get_facilities('hospitals'),
+        raster=get_distance_raster(),
     )
 
     # add column with distance to the closest fire station
     incident_df = find_dist_to_closest_fire_station(
         incident_df,
-        get_locations_as_shape(SFFDFireStation)
+        get_facilities('fire_stations'),
+        raster=get_distance_raster(),
     )
 
-    # columns reordered to match the training dataset
-    incident_df = incident_df[FEATURE_COLS]
+    # encode the time features from the time of the incident, and combine
+    # them with the other features into a matrix whose columns match the
+    # training dataset
+    features = build_feature_matrix(
+        incident_df,
+        [current_DtTm],
+        state=US_STATE_ABBR[state],
+    )
 
-    # send the incident_df DataFrame to the predict_eta function to estimate
-    # the arrival time for an ambulance
+    # send the feature matrix to the predict_eta function to estimate the
+    # arrival time for an ambulance
     wait_time = predict_eta(
-        incident_df,
+        features,
         filename=filename,
         model=model,
     )
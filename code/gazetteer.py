@@ -0,0 +1,138 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from code.key_utils import get_secret_key
+from code.file_version import get_file_version, expire_file_version
+from code.tract_tools import get_point_coords
+from code.mappings import STREET_TYPE_ABBR
+
+
+DATA_DIR = get_secret_key('DATA_DIR')
+
+# city whose historical calls are indexed in the gazetteer
+GAZETTEER_CITY = 'San Francisco'
+
+# gazetteers loaded by the whole process, by file path, with the version of
+# the file when it was loaded
+_GAZETTEERS = {}
+
+
+def normalize_block_address(address):
+    """Normalize a street address to the block address used in the calls.
+
+    The addresses of the calls in the fire department dataset are recorded by
+    block, e.g., '600 Block of SUTTER ST'. Street addresses entered by the
+    dispatcher, such as '683 Sutter Street', are converted to the same form,
+    with the street types abbreviated as in the dataset, so that both map to
+    '600 SUTTER ST'. Return None for addresses that don't start with a
+    street number (e.g., intersections)."""
+    if not isinstance(address, str):
+        return None
+
+    address = " ".join(re.sub(r'[^\w\s/]', ' ', address.upper()).split())
+    match = re.match(r'^(\d+)\s+(?:BLOCK OF\s+)?(.+)$', address)
+    if not match:
+        return None
+
+    number, street = match.groups()
+    street = street.split()
+    street[-1] = STREET_TYPE_ABBR.get(street[-1], street[-1])
+
+    return f"{int(number) // 100 * 100} {' '.join(street)}"
+
+
+def build_gazetteer(calls_filename='Med_Calls_with_Tracts.pkl',
+                    gazetteer_filename='Address_Gazetteer.parquet'):
+    """Build the address gazetteer from the historical medical calls.
+
+    Each block address in the calls is mapped to the median coordinates of
+    the calls recorded at that address. The gazetteer is saved to a Parquet
+    file. The tracts are not stored, since the tract of a location is found
+    from its coordinates anyway (see `get_new_incident_tract`)."""
+    # hacky way to avoid circular imports, since `sf_data` needs the
+    # geocoding tools that use the gazetteer
+    from code.sf_data import get_medical_calls
+
+    calls = get_medical_calls(filename=calls_filename,
+                              columns=['Address', 'Coords'])
+
+    # there are far fewer distinct addresses than calls, so the addresses are
+    # only normalized once each
+    codes, addresses = pd.factorize(calls['Address'])
+    block_addresses = np.array([normalize_block_address(address)
+                                for address in addresses], dtype=object)
+
+    lngs, lats = get_point_coords(calls['Coords'].values)
+    calls = pd.DataFrame({
+        'Block Address': block_addresses[codes],
+        'Longitude': lngs,
+        'Latitude': lats,
+    })
+    calls = calls[(codes >= 0) & calls['Block Address'].notna()]
+    calls = calls.dropna(subset=['Longitude', 'Latitude'])
+
+    gazetteer = calls.groupby('Block Address').agg(
+        Longitude=('Longitude', 'median'),
+        Latitude=('Latitude', 'median'),
+        n_calls=('Longitude', 'size'),
+    )
+
+    # the gazetteer is written to a temporary file first, so that a running
+    # app never reads a half-written gazetteer
+    gazetteer_fp = DATA_DIR + gazetteer_filename
+    gazetteer.reset_index().to_parquet(f"{gazetteer_fp}.tmp",
+                                       engine='pyarrow',
+                                       index=False)
+    os.replace(f"{gazetteer_fp}.tmp", gazetteer_fp)
+    expire_file_version(gazetteer_fp)
+
+
+def load_gazetteer(gazetteer_filename='Address_Gazetteer.parquet'):
+    """Load the address gazetteer.
+
+    The gazetteer is returned as a dictionary mapping each block address to
+    a (longitude, latitude) tuple. It is only read once per process, and
+    read again when the file changes (e.g., when `seed.py` rebuilds it while
+    the app is running), which is checked at most once per second (see
+    `FileVersion`). If the gazetteer hasn't been built, an empty dictionary
+    is returned, and the file is looked for again on the next check."""
+    gazetteer_fp = DATA_DIR + gazetteer_filename
+
+    version = get_file_version(gazetteer_fp)
+    if version is None:
+        return {}
+
+    cached = _GAZETTEERS.get(gazetteer_fp)
+    if cached is None or cached[0] != version:
+        _GAZETTEERS[gazetteer_fp] = (version, _read_gazetteer(gazetteer_fp))
+
+    return _GAZETTEERS[gazetteer_fp][1]
+
+
+def _read_gazetteer(gazetteer_fp):
+    """Read the address gazetteer from its Parquet file."""
+    gazetteer = pd.read_parquet(gazetteer_fp,
+                                engine='pyarrow',
+                                columns=['Block Address',
+                                         'Longitude',
+                                         'Latitude'])
+
+    return dict(zip(gazetteer['Block Address'],
+                    zip(gazetteer['Longitude'].tolist(),
+                        gazetteer['Latitude'].tolist())))
+
+
+def lookup_address(street_address,
+                   gazetteer_filename='Address_Gazetteer.parquet'):
+    """Look up a street address in the gazetteer.
+
+    Return a (longitude, latitude) tuple, or None if the block of the
+    address has never been seen in the historical calls."""
+    block_address = normalize_block_address(street_address)
+    if block_address is None:
+        return None
+
+    return load_gazetteer(gazetteer_filename).get(block_address)
@@ -0,0 +1,253 @@
+import re
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from geopy.location import Location
+from geopy.point import Point
+
+from code.key_utils import get_secret_key
+
+
+# how long geocoded addresses, and addresses that could not be geocoded, are
+# kept in the cache (in seconds)
+DEFAULT_TTL = 30 * 24 * 3600
+DEFAULT_NEGATIVE_TTL = 24 * 3600
+
+# maximum number of addresses kept in the cache; when the cache grows beyond
+# this size, the least recently used addresses are evicted
+DEFAULT_MAX_ENTRIES = 100000
+
+# number of the most recently used addresses also kept in memory, and number
+# of cache hits after which their last use is written to the database
+DEFAULT_MEMORY_ENTRIES = 1000
+DEFAULT_FLUSH_EVERY = 100
+
+
+def normalize_address(address):
+    """Normalize an address to use it as a cache key.
+
+    The address is lowercased, punctuation is removed, and whitespace is
+    collapsed, so that '683 Sutter St., San Francisco' and '683 sutter st
+    san francisco' share the same cache entry."""
+    return " ".join(re.sub(r'[^\w\s/]', ' ', address.lower()).split())
+
+
+class GeocodeCache:
+    """Persistent cache of geocoded addresses.
+
+    The cache is stored in a SQLite database, so it survives restarts. Both
+    successful lookups and addresses that could not be geocoded are cached,
+    each with their own time-to-live. When the cache holds more than
+    `max_entries` addresses, the least recently used ones are evicted.
+
+    The `memory_entries` most recently used addresses are also kept in
+    memory, so that most hits don't touch the database. The time of the last
+    use of the addresses is only written to the database every `flush_every`
+    hits, and before evicting addresses, so that a hit doesn't cost a write
+    transaction."""
+
+    def __init__(self,
+                 db_fp,
+                 ttl=DEFAULT_TTL,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES,
+                 memory_entries=DEFAULT_MEMORY_ENTRIES,
+                 flush_every=DEFAULT_FLUSH_EVERY,
+                 clock=time.time):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.flush_every = flush_every
+        self.clock = clock
+
+        # address key -> (location, expiration time), in order of last use
+        self._memory = OrderedDict()
+
+        # address key -> time of the last use not yet written to the
+        # database, and the number of hits since the last write
+        self._last_used = {}
+        self._n_hits = 0
+
+        # the connection is shared by the threads of the web server, so the
+        # access to it is serialized
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_fp, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS geocodes (
+                    address_key TEXT PRIMARY KEY,
+                    address TEXT,
+                    latitude REAL,
+                    longitude REAL,
+                    expires_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self._conn.execute("""
+                CREATE INDEX IF NOT EXISTS geocodes_last_used
+                ON geocodes (last_used)
+            """)
+
+        # the number of addresses is kept up to date by this process, and
+        # only counted again before evicting addresses, since other processes
+        # may have added some too
+        self._n_entries = self._count()
+
+    def _count(self):
+        """Count the addresses in the database."""
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM geocodes"
+        ).fetchone()[0]
+
+    def _remember(self, key, location, expires_at):
+        """Keep an address in memory, forgetting the least recently used."""
+        self._memory[key] = (location, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _touch(self, key, now):
+        """Record the use of an address, writing it later."""
+        self._last_used[key] = now
+        self._n_hits += 1
+        if self._n_hits >= self.flush_every:
+            self._flush_last_used()
+
+    def _flush_last_used(self):
+        """Write the last use of the addresses to the database."""
+        self._n_hits = 0
+        if not self._last_used:
+            return
+
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE geocodes SET last_used = ? WHERE address_key = ?",
+                [(now, key) for key, now in self._last_used.items()],
+            )
+        self._last_used.clear()
+
+    def get(self, address):
+        """Look up an address in the cache.
+
+        Return a (found, location) tuple. `found` is False if the address is
+        not in the cache, or if its entry has expired. Otherwise, `location`
+        is the cached geopy Location, or None if the address could not be
+        geocoded."""
+        key = normalize_address(address)
+        now = self.clock()
+
+        with self._lock:
+            if key in self._memory:
+                location, expires_at = self._memory[key]
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self._touch(key, now)
+                    return True, location
+                del self._memory[key]
+
+            row = self._conn.execute(
+                "SELECT address, latitude, longitude, expires_at "
+                "FROM geocodes WHERE address_key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return False, None
+
+            cached_address, latitude, longitude, expires_at = row
+            if expires_at <= now:
+                with self._conn:
+                    self._conn.execute(
+                        "DELETE FROM geocodes WHERE address_key = ?", (key,)
+                    )
+                self._last_used.pop(key, None)
+                self._n_entries -= 1
+                return False, None
+
+            location = None
+            if latitude is not None and longitude is not None:
+                location = Location(cached_address,
+                                    Point(latitude, longitude),
+                                    {})
+            self._remember(key, location, expires_at)
+            self._touch(key, now)
+
+        return True, location
+
+    def set(self, address, location):
+        """Cache the geocoded location of an address.
+
+        `location` is a geopy Location, or None if the address could not be
+        geocoded."""
+        key = normalize_address(address)
+        now = self.clock()
+
+        if location is None:
+            expires_at = now + self.negative_ttl
+            values = (key, None, None, None, expires_at, now)
+        else:
+            expires_at = now + self.ttl
+            values = (key,
+                      location.address,
+                      location.latitude,
+                      location.longitude,
+                      expires_at,
+                      now)
+
+        with self._lock:
+            is_new = self._conn.execute(
+                "SELECT 1 FROM geocodes WHERE address_key = ?", (key,)
+            ).fetchone() is None
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO geocodes "
+                    "(address_key, address, latitude, longitude, "
+                    " expires_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    values,
+                )
+            self._last_used.pop(key, None)
+            self._remember(key, location, expires_at)
+            self._n_entries += is_new
+            if self._n_entries > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        """Evict the least recently used addresses if the cache is full."""
+        self._flush_last_used()
+        self._n_entries = self._count()
+        if self._n_entries <= self.max_entries:
+            return
+
+        evicted = self._conn.execute(
+            "SELECT address_key FROM geocodes ORDER BY last_used LIMIT ?",
+            (self._n_entries - self.max_entries,),
+        ).fetchall()
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM geocodes WHERE address_key = ?", evicted
+            )
+        for key, in evicted:
+            self._memory.pop(key, None)
+        self._n_entries -= len(evicted)
+
+    def clear(self):
+        """Remove all the addresses from the cache."""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM geocodes")
+            self._memory.clear()
+            self._last_used.clear()
+            self._n_hits = 0
+            self._n_entries = 0
+
+
+@lru_cache(maxsize=None)
+def get_geocode_cache(filename='geocode_cache.sqlite'):
+    """Return the geocode cache shared by the whole process."""
+    DATA_DIR = get_secret_key('DATA_DIR')
+
+    return GeocodeCache(DATA_DIR + filename)
@@ -0,0 +1,392 @@
+import abc
+import time
+import threading
+
+from geopy.geocoders import Nominatim
+from geopy.exc import GeopyError
+from geopy.location import Location
+from geopy.point import Point
+
+from code.geocode_cache import get_geocode_cache, normalize_address
+from code.gazetteer import GAZETTEER_CITY, lookup_address
+
+
+# maximum time (in seconds) a single backend call, and a whole address
+# lookup, may take
+DEFAULT_CALL_TIMEOUT = 10.
+DEFAULT_REQUEST_BUDGET = 30.
+
+# rate limit of the calls to the remote geocoder, shared by all the threads of
+# the process: a sustained rate (calls per second), and the number of calls
+# that can be made at once; Nominatim's usage policy allows a single call per
+# second, with no bursts
+REMOTE_RATE_LIMIT = 1.
+REMOTE_BURST = 1
+
+
+class NotFound:
+    """Definitive answer from a backend that an address can't be geocoded.
+
+    Backends return None when they simply don't know an address (e.g., a
+    cache miss), and NOT_FOUND when they know that it can't be geocoded."""
+
+    def __repr__(self):
+        return 'NOT_FOUND'
+
+
+NOT_FOUND = NotFound()
+
+
+class CircuitBreaker:
+    """Stop calling a backend that keeps failing.
+
+    After `max_failures` consecutive failures, the breaker opens and the
+    backend is skipped for `reset_timeout` seconds. After that, one trial
+    call is let through, while the other callers keep skipping the backend:
+    if the trial succeeds, the breaker closes again; if it fails, the breaker
+    stays open for another `reset_timeout` seconds. The breaker can be shared
+    by several threads."""
+
+    def __init__(self, max_failures=3, reset_timeout=60.,
+                 clock=time.monotonic):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if the backend can be called.
+
+        When the breaker is open and its timeout has expired, only the first
+        caller is allowed, and it must then record the result of its call
+        (or `cancel_trial` if the backend wasn't actually called)."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+
+            if self.trial_in_progress or \
+                    self.clock() - self.opened_at < self.reset_timeout:
+                return False
+
+            self.trial_in_progress = True
+            return True
+
+    def record_success(self):
+        """Close the breaker after a successful call."""
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        """Count a failed call, opening the breaker if there are too many."""
+        with self._lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.failures >= self.max_failures:
+                self.opened_at = self.clock()
+
+    def retry_after(self):
+        """Return how long (in seconds) until the backend can be called."""
+        with self._lock:
+            if self.opened_at is None:
+                return 0.
+
+            return max(0., self.opened_at + self.reset_timeout - self.clock())
+
+    def cancel_trial(self):
+        """Let another caller make the trial call."""
+        with self._lock:
+            self.trial_in_progress = False
+
+
+class TokenBucket:
+    """Token bucket rate limiter, safe to share between threads.
+
+    Tokens are added at `rate` tokens per second, up to `capacity` tokens.
+    Each call takes a token, waiting for one if the bucket is empty."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity
+        self.updated_at = clock()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """Take a token; return 0 if successful, or the time to wait."""
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated_at) * self.rate,
+            )
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, timeout=None):
+        """Take a token, waiting at most `timeout` seconds for one.
+
+        Return True if a token was taken, and False otherwise."""
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            wait = self._take()
+            if not wait:
+                return True
+            if deadline is not None and self.clock() + wait > deadline:
+                return False
+            self.sleep(wait)
+
+
+class GeocoderBackend(abc.ABC):
+    """Base class for the geocoder backends.
+
+    Backends that call a remote service should have a `CircuitBreaker` in
+    their `breaker` attribute, and a `TokenBucket` in their `rate_limiter`
+    attribute if their calls are rate limited. The answers of backends that
+    set `cacheable` to False are not stored in the backends before them in
+    the chain."""
+
+    breaker = None
+    rate_limiter = None
+    cacheable = True
+
+    @abc.abstractmethod
+    def geocode(self, address, timeout):
+        """Return the geopy Location of an address, NOT_FOUND, or None.
+
+        Backends raise a `GeopyError` if they fail to answer."""
+
+    def store(self, address, location):
+        """Store the answer of a later backend in the chain (optional)."""
+        pass
+
+
+class CacheBackend(GeocoderBackend):
+    """Look up addresses in the persistent geocode cache."""
+
+    def __init__(self, cache=None):
+        self.cache = cache or get_geocode_cache()
+
+    def geocode(self, address, timeout):
+        found, location = self.cache.get(address)
+        if not found:
+            return None
+
+        return location if location else NOT_FOUND
+
+    def store(self, address, location):
+        self.cache.set(address, None if location is NOT_FOUND else location)
+
+
+class GazetteerBackend(GeocoderBackend):
+    """Look up addresses in the gazetteer of historical call addresses.
+
+    Only addresses in the city covered by the gazetteer are looked up, using
+    the street address before the first comma. The answers are estimates for
+    the whole block, and are cheap to look up again, so they are not cached
+    (which would also keep them after the gazetteer is rebuilt)."""
+
+    cacheable = False
+
+    def geocode(self, address, timeout):
+        street_address, _, city_state = address.partition(',')
+        if GAZETTEER_CITY.lower() not in city_state.lower():
+            return None
+
+        block_location = lookup_address(street_address)
+        if not block_location:
+            return None
+
+        lng, lat = block_location
+        return Location(address, Point(lat, lng), {})
+
+    def store(self, address, location):
+        # the gazetteer is only built from the historical calls
+        pass
+
+
+class NominatimBackend(GeocoderBackend):
+    """Geocode addresses with the Nominatim geocoder.
+
+    The calls are rate limited by a token bucket shared by all the threads
+    that use the backend; by default, to one call per second (see
+    `REMOTE_BURST`), so looking up several addresses concurrently doesn't
+    make the remote calls any faster."""
+
+    def __init__(self, user_agent="my_fd_app", breaker=None,
+                 rate_limiter=None):
+        self.geolocator = Nominatim(user_agent=user_agent)
+        self.breaker = breaker or CircuitBreaker()
+        self.rate_limiter = rate_limiter or TokenBucket(REMOTE_RATE_LIMIT,
+                                                        REMOTE_BURST)
+
+    def geocode(self, address, timeout):
+        location = self.geolocator.geocode(address, timeout=timeout)
+
+        return location if location else NOT_FOUND
+
+
+class StubBackend(GeocoderBackend):
+    """Geocode addresses from a fixed dictionary, without any network access.
+
+    The dictionary maps addresses to (longitude, latitude) pairs; addresses
+    are matched after normalization. Any other address is NOT_FOUND."""
+
+    def __init__(self, locations):
+        self.locations = {normalize_address(address): coords
+                          for address, coords in locations.items()}
+
+    def geocode(self, address, timeout):
+        coords = self.locations.get(normalize_address(address))
+        if not coords:
+            return NOT_FOUND
+
+        lng, lat = coords
+        return Location(address, Point(lat, lng), {})
+
+
+class GeocoderChain:
+    """Geocode addresses with a chain of backends.
+
+    The backends are called in order until one of them gives a definitive
+    answer (a location, or NOT_FOUND), which is then stored in the backends
+    before it (e.g., in the geocode cache), unless the backend isn't
+    `cacheable`. Each backend call is limited to `call_timeout` seconds, and
+    each address lookup to `budget` seconds. Backends whose circuit breaker
+    is open are skipped."""
+
+    def __init__(self,
+                 backends,
+                 call_timeout=DEFAULT_CALL_TIMEOUT,
+                 budget=DEFAULT_REQUEST_BUDGET,
+                 clock=time.monotonic):
+        self.backends = backends
+        self.call_timeout = call_timeout
+        self.budget = budget
+        self.clock = clock
+
+    def get_deadline(self):
+        """Return the deadline for a lookup that starts now."""
+        return self.clock() + self.budget
+
+    def geocode(self, address, deadline=None):
+        """Return the geopy Location of an address, or None.
+
+        If a `deadline` is given (see `get_deadline`), it is shared by all the
+        lookups made with it, e.g., when trying several spellings of the same
+        address. None is also returned if no backend could answer before the
+        deadline, in which case nothing is cached."""
+        location = self.lookup(address, deadline=deadline)
+
+        return None if location is NOT_FOUND else location
+
+    def lookup(self, address, deadline=None):
+        """Return the geopy Location of an address, NOT_FOUND, or None.
+
+        Unlike `geocode`, this tells apart the addresses that can't be
+        geocoded (NOT_FOUND) from those for which no backend could answer
+        before the deadline (None), which are worth trying again later."""
+        if deadline is None:
+            deadline = self.get_deadline()
+
+        for i, backend in enumerate(self.backends):
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                return None
+
+            breaker = backend.breaker
+            if breaker and not breaker.allow():
+                continue
+
+            rate_limiter = backend.rate_limiter
+            if rate_limiter and not rate_limiter.acquire(timeout=remaining):
+                # the backend wasn't called, so it didn't fail
+                if breaker:
+                    breaker.cancel_trial()
+                continue
+            remaining = deadline - self.clock()
+
+            try:
+                location = backend.geocode(
+                    address,
+                    timeout=min(self.call_timeout, remaining),
+                )
+            except GeopyError:
+                if breaker:
+                    breaker.record_failure()
+                continue
+            except Exception:
+                # any other error is unexpected, and is raised, but it still
+                # counts as a failure, or a trial call would never end
+                if breaker:
+                    breaker.record_failure()
+                raise
+            except BaseException:
+                if breaker:
+                    breaker.cancel_trial()
+                raise
+
+            if breaker:
+                breaker.record_success()
+
+            if location is None:
+                continue
+
+            if backend.cacheable:
+                for earlier_backend in self.backends[:i]:
+                    earlier_backend.store(address, location)
+
+            return location
+
+        return None
+
+    def retry_after(self):
+        """Return how long (in seconds) until a skipped backend can be called.
+
+        This is the shortest time until one of the open circuit breakers lets
+        a call through, or 0 if none of them is open."""
+        waits = [backend.breaker.retry_after() for backend in self.backends
+                 if backend.breaker and backend.breaker.opened_at is not None]
+
+        return min(waits, default=0.)
+
+
+# geocoder chain used by the whole process; it is built on first use
+_GEOCODER_CHAIN = {}
+
+
+def get_geocoder_chain():
+    """Return the geocoder chain used by the whole process.
+
+    By default, addresses are looked up in the gazetteer, then in the
+    geocode cache, and only then geocoded with Nominatim. The gazetteer
+    comes first, so that an address that Nominatim couldn't geocode, and
+    which was cached as such, is still found in a rebuilt gazetteer."""
+    if 'chain' not in _GEOCODER_CHAIN:
+        _GEOCODER_CHAIN['chain'] = GeocoderChain([
+            GazetteerBackend(),
+            CacheBackend(),
+            NominatimBackend(),
+        ])
+
+    return _GEOCODER_CHAIN['chain']
+
+
+def set_geocoder_chain(chain):
+    """Replace the geocoder chain used by the whole process.
+
+    Passing None restores the default chain on the next lookup."""
+    if chain is None:
+        _GEOCODER_CHAIN.pop('chain', None)
+    else:
+        _GEOCODER_CHAIN['chain'] = chain
@@ -1,17 +1,34 @@
-from geopy.geocoders import Nominatim
+import time
+
 import geocoder
-from shapely.geometry import Point
-from geoalchemy2.shape import to_shape
 
-from code.tract_tools import get_updated_tract_data
+from code.tract_tools import get_tract_locator
 from code.exceptions import AddressError
+from code.geocoders import get_geocoder_chain
+from code.key_utils import get_secret_key
+
+
+# location of the dispatcher when it's neither set in the keys file nor
+# detected from the IP address
+DEFAULT_DISPATCH_CITY = 'San Francisco'
+DEFAULT_DISPATCH_STATE = 'California'
+
+# how long (in seconds) a dispatcher location detected from the IP address is
+# kept before it's detected again
+DISPATCH_LOCATION_TTL = 24 * 3600.
 
+# dispatcher location resolved for the whole process, and when it expires
+_DISPATCH_LOCATION = {}
 
-def decode_address(address):
-    """Geocode address."""
-    geolocator = Nominatim(user_agent="my_fd_app")
 
-    return geolocator.geocode(address, timeout=180)
+def decode_address(address, deadline=None):
+    """Geocode address.
+
+    The address is looked up with the process-wide geocoder chain (see
+    `geocoders.get_geocoder_chain`): first in the gazetteer of historical
+    call addresses, then in the geocode cache, and only then with the remote
+    geocoder. An optional `deadline` limits the time spent on the lookup."""
+    return get_geocoder_chain().geocode(address, deadline=deadline)
 
 
 def find_me():
@@ -29,41 +46,74 @@ def add_city_state(address, city, state):
     return address + f", {city} {state}"
 
 
-def get_locations_as_shape(db_table):
-    """Return the locations of the fire stations as shapely objects."""
-    # hacky way to avoid circular imports... :-/
-    # TODO: Fix it, I guess?! ;-)
-    from code.flaskr import app
-    from code.db_model import db, connect_to_db
-    connect_to_db(app)
+def _resolve_dispatch_location():
+    """Resolve the location of the dispatcher.
+
+    Return the location, and how long (in seconds) it's valid for. The city
+    and state are read from the 'DISPATCH_CITY' and 'DISPATCH_STATE' keys in
+    the keys file. If 'DISPATCH_CITY' is 'detect', they are instead detected
+    from the IP address, which is only valid for `DISPATCH_LOCATION_TTL`
+    seconds. If the keys are not set, or the detection fails, the default
+    location is used."""
+    default_location = {
+        'city': DEFAULT_DISPATCH_CITY,
+        'state': DEFAULT_DISPATCH_STATE,
+    }
+
+    try:
+        city = get_secret_key('DISPATCH_CITY')
+    except KeyError:
+        return default_location, float('inf')
 
-    # get the positions of all fire stations as WKBElement objects;
-    # this returns tuples of one element each...
-    pts_wkbs = db_table.query.with_entities(
-        db_table.coords
-    ).all()
+    if city != 'detect':
+        return {
+            'city': city,
+            'state': get_secret_key('DISPATCH_STATE'),
+        }, float('inf')
 
-    # converts the list above to a list of shapely POINT geometries
-    return [to_shape(wkb[0]) for wkb in pts_wkbs]
+    try:
+        return find_me(), DISPATCH_LOCATION_TTL
+    except Exception:
+        # try again sooner than if the detection had worked
+        return default_location, DISPATCH_LOCATION_TTL / 24
 
 
-def get_new_incident_address(street_address):
+def get_dispatch_location(clock=time.monotonic):
+    """Return the city and state of the dispatcher.
+
+    The location is only resolved once per process (see
+    `_resolve_dispatch_location`), or once per `DISPATCH_LOCATION_TTL`
+    seconds if it's detected from the IP address, so that no remote lookup is
+    made when handling a request."""
+    now = clock()
+    if _DISPATCH_LOCATION.get('expires_at', -1.) <= now:
+        location, ttl = _resolve_dispatch_location()
+        _DISPATCH_LOCATION['location'] = location
+        _DISPATCH_LOCATION['expires_at'] = now + ttl
+
+    return dict(_DISPATCH_LOCATION['location'])
+
+
+def reset_dispatch_location():
+    """Resolve the location of the dispatcher again on the next request."""
+    _DISPATCH_LOCATION.clear()
+
+
+def get_new_incident_address(street_address, dispatch_location=None):
     """Return the address of a medical incident.
 
     Take in the street address of a medical incident as entered by the
     dispatcher, and combine it with the city and state of the dispatcher to
-    get the full address of the incident.
+    get the full address of the incident. The location of the dispatcher is
+    the one resolved for the whole process (see `get_dispatch_location`),
+    unless a `dispatch_location` dictionary with a 'city' and a 'state' is
+    given (e.g., set for a user session).
 
     Warning: The assumption is that the dispatcher is in the same city as the
     one in which the incident happens, which should generally be true. The
     advantage of doing this is that the dispacher saves times by not having to
     enter the same city and state over and over again."""
-    dispatch_loc = find_me()
-
-    # TODO: This is for testing purposes only, otherwise the code fails when
-    # I run the code from home (Alameda). Remove it later!
-    dispatch_loc['city'] = 'San Francisco'
-    dispatch_loc['state'] = 'California'
+    dispatch_loc = dispatch_location or get_dispatch_location()
 
     return {
         'address': add_city_state(
@@ -76,12 +126,15 @@ def get_new_incident_address(street_address):
     }
 
 
-def get_new_incident_coords(street_address):
+def get_new_incident_coords(street_address, dispatch_location=None):
     """Return the coordinates of a medical incident using its street address.
 
     See the warning in `get_new_incident_address` about assumptions made.
+
+    Addresses in the gazetteer of historical call addresses are resolved
+    without calling the remote geocoder (see `decode_address`).
     """
-    address = get_new_incident_address(street_address)
+    address = get_new_incident_address(street_address, dispatch_location)
     lct = decode_address(address['address'])
     if lct:
         return (
@@ -94,30 +147,27 @@ def get_new_incident_coords(street_address):
 
 
 def get_new_incident_tract(lng, lat):
-    """Return the tract corresponding to a given (longitude, latitude)."""
-    # TODO: The Census file should not be hardcoded in here...
-    tr = get_updated_tract_data(tracts_filename='Census_2010_Tracts.csv')
-    lct = Point(lng, lat)
-    for idx in range(len(tr.df)):
-        if lct.within(tr.df.loc[idx]['Polygon']):
-            return int(tr.df.loc[idx]['GEOID10'])
+    """Return the tract corresponding to a given (longitude, latitude).
 
+    The tracts are located with a `TractLocator` built from the prebuilt tract
+    geometry artifact, which is only loaded once per process."""
+    # TODO: The Census file should not be hardcoded in here...
+    tract = get_tract_locator(
+        tracts_filename='Census_2010_Tracts.csv'
+    ).locate(lng, lat)
+    if tract is not None:
+        return int(tract)
 
-def get_coords_from_address(street_address, city=None, state=None):
-    """Return a geocoded location.
 
-    Hacky way of deciphering an address and converting it to a GeoPy location
-    with longitude and latitude attributes."""
+def get_address_spellings(street_address, city=None, state=None):
+    """Return the spellings of an address to try when geocoding it.
 
-    full_address = street_address
+    The address as given comes first, followed by the address with each of
+    the common street types added."""
+    spellings = [street_address]
     if city and state:
-        full_address = add_city_state(street_address, city, state)
+        spellings = [add_city_state(street_address, city, state)]
 
-    location = decode_address(full_address)
-    if location:
-        return location
-
-    # if address not found on the first try
     for street_type in ['Street', 'Avenue', 'Road', 'Court', 'Way']:
         if city and state:
             full_address = add_city_state(
@@ -129,8 +179,24 @@ def get_coords_from_address(street_address, city=None, state=None):
             full_address = street_address.split(",", 1)[0] + \
                            f" {street_type}, " + \
                            max(street_address.split(",", 1)[1:], [''])[0]
+        spellings.append(full_address)
+
+    return spellings
+
+
+def get_coords_from_address(street_address, city=None, state=None):
+    """Return a geocoded location.
+
+    Hacky way of deciphering an address and converting it to a GeoPy location
+    with longitude and latitude attributes.
+
+    All the spellings of the address that are tried share the request budget
+    of the geocoder chain, so a bad address can't block for longer than
+    that."""
+    deadline = get_geocoder_chain().get_deadline()
 
-        location = decode_address(full_address)
+    for full_address in get_address_spellings(street_address, city, state):
+        location = decode_address(full_address, deadline=deadline)
 
         if location:
             return location
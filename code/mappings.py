@@ -5,6 +5,7 @@ WEEKEND_DAYS = [5, 6]
 
 
 DEGREES_TO_MILES = 69.
+EARTH_RADIUS_MILES = 3958.8
 DEGREES_TO_KM = 111.
 SQM_TO_100000SQFOOT = 9290.3
 
@@ -16,6 +17,63 @@ GROUPING_FREQ = 'QS'
 AMBULANCE_UNITS = ['MEDIC', 'PRIVATE']
 
 
+# value of the 'Call Type' column for the calls kept in the medical calls
+# dataset
+MEDICAL_CALL_TYPE = 'Medical Incident'
+
+
+# date and datetime columns in the fire department call dataset, together
+# with the formats in which they are recorded
+CALL_DATE_COLS = [
+    'Call Date',
+    'Watch Date',
+]
+CALL_DATE_FORMAT = '%m/%d/%Y'
+
+CALL_DTTM_COLS = [
+    'Received DtTm',
+    'Entry DtTm',
+    'Dispatch DtTm',
+    'Response DtTm',
+    'On Scene DtTm',
+    'Transport DtTm',
+    'Hospital DtTm',
+    'Available DtTm',
+]
+CALL_DTTM_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+
+# compact dtypes of the columns of the medical calls dataframe: low-cardinality
+# strings are stored as categoricals, the GEOID10 tract codes as nullable
+# integers (they have 10 digits, which is too many for an int32), and the
+# coordinates in single precision (about 1 m at the latitude of SF); the calls
+# themselves only hold the coordinates as POINTs in 'Coords', so the latter
+# only apply to the longitude and latitude features set from them
+CALL_CATEGORICAL_COLS = [
+    'Call Type',
+    'Call Type Group',
+    'Call Final Disposition',
+    'Unit Type',
+    'Original Priority',
+    'Priority',
+    'Final Priority',
+    'City',
+    'Battalion',
+    'Station Area',
+    'Fire Prevention District',
+    'Supervisor District',
+    'Neighborhooods - Analysis Boundaries',
+]
+
+CALL_SCHEMA = {
+    **{col: 'category' for col in CALL_CATEGORICAL_COLS},
+    **{col: 'datetime64[ns]' for col in CALL_DATE_COLS + CALL_DTTM_COLS},
+    'Tract': 'Int64',
+    'Latitude': 'float32',
+    'Longitude': 'float32',
+}
+
+
 PRIORITY_CODES = [
     '3',
     '2',
@@ -51,6 +109,32 @@ FEATURE_COLS = [
 ]
 
 
+# model features derived from the time at which a call was received
+TIME_FEATURE_COLS = [
+    'Year',
+    'Day_of_Year_sin',
+    'Day_of_Year_cos',
+    'Day_of_Week_sin',
+    'Day_of_Week_cos',
+    'Hour_sin',
+    'Hour_cos',
+    'is_weekend',
+    'is_holiday',
+]
+
+
+# columns of the medical calls dataset from which the model features and the
+# response time are computed
+MODEL_INPUT_COLS = [
+    'Received DtTm',
+    'On Scene DtTm',
+    'Tract',
+    'Coords',
+    'Original Priority',
+    'Unit Type',
+]
+
+
 NON_FEATURE_COLS = [
     'Call Number',
     'Unit ID',
@@ -85,6 +169,31 @@ NON_FEATURE_COLS = [
 ]
 
 
+# abbreviations of the street types, as they are recorded in the addresses of
+# the fire department call dataset
+STREET_TYPE_ABBR = {
+    'STREET': 'ST',
+    'AVENUE': 'AV',
+    'AVE': 'AV',
+    'BOULEVARD': 'BL',
+    'BLVD': 'BL',
+    'ROAD': 'RD',
+    'COURT': 'CT',
+    'WAY': 'WY',
+    'DRIVE': 'DR',
+    'PLACE': 'PL',
+    'LANE': 'LN',
+    'TERRACE': 'TR',
+    'TER': 'TR',
+    'HIGHWAY': 'HY',
+    'HWY': 'HY',
+    'ALLEY': 'AL',
+    'CIRCLE': 'CR',
+    'CIR': 'CR',
+    'PLAZA': 'PZ',
+}
+
+
 COUNTIES = {
     'CA':
         {'San Francisco': 'San Francisco',
@@ -1,11 +1,176 @@
-import re
+import os
+import pickle
 
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point, Polygon
+import shapely
+from shapely.geometry import Polygon
 
-from code.tract_tools import get_updated_tract_data
+from code.tract_tools import get_updated_tract_data, TractLocator
+from code.key_utils import get_secret_key
+from code.batch_geocoder import geocode_addresses
+from code.call_store import is_parquet_store, \
+                            write_medical_calls, \
+                            upsert_medical_calls, \
+                            apply_call_schema, \
+                            concat_medical_calls
+from code.mappings import MEDICAL_CALL_TYPE, \
+                          CALL_CATEGORICAL_COLS, \
+                          CALL_DATE_COLS, \
+                          CALL_DATE_FORMAT, \
+                          CALL_DTTM_COLS, \
+                          CALL_DTTM_FORMAT
+
+
+DATA_DIR = get_secret_key('DATA_DIR')
+
+
+def parse_call_dates(df):
+    """Parse the date columns of a call dataframe to `datetime` format.
+
+    Only the date columns present in the dataframe are parsed, so that the
+    function can be used on column projections of the call dataset."""
+    for col in CALL_DATE_COLS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], format=CALL_DATE_FORMAT)
+    for col in CALL_DTTM_COLS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], format=CALL_DTTM_FORMAT)
+
+    return df
+
+
+def parse_location_coords(locations):
+    """Extract the (lon, lat) coordinates from '(lat, lon)' location strings.
+
+    The coordinates are extracted from the whole column at once and returned
+    as two `float64` arrays. Missing or malformed locations are set to NaN."""
+    coords = pd.Series(locations, dtype=object).str.extract(
+        r'\(\s*([^,()]+?)\s*,\s*([^,()]+?)\s*\)',
+        expand=True,
+    )
+    lats = pd.to_numeric(coords[0], errors='coerce').to_numpy(np.float64)
+    lons = pd.to_numeric(coords[1], errors='coerce').to_numpy(np.float64)
+
+    return lons, lats
+
+
+def _hash_call_rows(chunk):
+    """Hash each row of a raw chunk of the fire department call dataset.
+
+    The types that `pd.read_csv` infers for a column depend on the rows in a
+    chunk (e.g., integers are read as floats if a value is missing), so the
+    values are normalized to strings before hashing; this way, a row always
+    gets the same hash, regardless of the chunk in which it was read."""
+    normalized = chunk.copy()
+    for col in chunk.select_dtypes('float').columns:
+        values = chunk[col].dropna()
+        if (values % 1 == 0).all():
+            normalized[col] = chunk[col].astype('Int64')
+    normalized = normalized.astype(str).where(chunk.notna(), '')
+
+    return pd.util.hash_pandas_object(normalized, index=False).values
+
+
+class CallWatermark:
+    """Keep track of the medical calls that have already been ingested.
+
+    The watermark holds a hash of the raw CSV row of each ingested call,
+    indexed by 'RowID'. Calls whose RowID has not been seen before, or whose
+    row hash has changed since they were ingested, are new. The calls are
+    not selected by date, since older calls are updated in the dataset
+    (e.g., when their unit becomes available).
+
+    The hashes of the new calls are kept aside until `commit` is called, so
+    that the watermark only moves forward once the new calls are stored."""
+
+    def __init__(self, filename='Med_Calls_Watermark.pkl'):
+        """Load the watermark, if it exists."""
+        self.filename = filename
+        self.row_hashes = pd.Series([], dtype=np.uint64)
+        self._pending_hashes = []
+
+        if os.path.isfile(DATA_DIR + filename):
+            with open(DATA_DIR + filename, 'rb') as f:
+                watermark = pickle.load(f)
+            self.row_hashes = watermark['row_hashes']
+
+    def select_new_calls(self, chunk):
+        """Return the calls in a raw CSV chunk that are new or changed."""
+        hashes = _hash_call_rows(chunk)
+        stored_idx = self.row_hashes.index.get_indexer(chunk['RowID'])
+        is_seen = stored_idx >= 0
+        is_new = ~is_seen
+        is_new[is_seen] = (
+            self.row_hashes.values[stored_idx[is_seen]] != hashes[is_seen]
+        )
+
+        self._pending_hashes.append(
+            pd.Series(hashes[is_new], index=chunk['RowID'].values[is_new])
+        )
+
+        return chunk[is_new]
+
+    def commit(self):
+        """Record the selected calls as ingested and save the watermark.
+
+        The watermark is written to a temporary file first, so that an
+        interrupted save leaves the previous watermark in place."""
+        self.row_hashes = pd.concat([self.row_hashes] + self._pending_hashes)
+        self.row_hashes = self.row_hashes[
+            ~self.row_hashes.index.duplicated(keep='last')
+        ]
+        self._pending_hashes = []
+
+        watermark_fp = DATA_DIR + self.filename
+        with open(f"{watermark_fp}.tmp", 'wb') as f:
+            pickle.dump({'row_hashes': self.row_hashes}, f)
+        os.replace(f"{watermark_fp}.tmp", watermark_fp)
+
+
+def iter_medical_incident_chunks(fd_call_filename,
+                                 chunksize=500000,
+                                 usecols=None,
+                                 dtype=None,
+                                 watermark=None):
+    """Stream the medical incidents in the fire department call dataset.
+
+    The CSV file is read `chunksize` rows at a time. Each chunk is projected
+    on `usecols` (all columns if None) with the given `dtype`, filtered to
+    medical incidents, and only then are its dates parsed. At most one raw
+    chunk is held in memory at any time, so the memory used by the reader is
+    bounded by `chunksize` rather than by the size of the CSV file.
+
+    The categorical columns (see `CALL_CATEGORICAL_COLS`) are read as
+    strings, unless another `dtype` is given for them; otherwise, a column
+    such as 'Original Priority' would be read as integers in the chunks
+    with only numeric priorities, and as strings in the others.
+
+    If a `CallWatermark` is given, only the calls that are new or changed
+    since the watermark was last committed are returned."""
+    if usecols is not None and 'Call Type' not in usecols:
+        usecols = list(usecols) + ['Call Type']
+    if (watermark is not None and usecols is not None and
+            'RowID' not in usecols):
+        usecols = list(usecols) + ['RowID']
+    if dtype is None or isinstance(dtype, dict):
+        dtype = {**{col: str for col in CALL_CATEGORICAL_COLS},
+                 **(dtype or {})}
+
+    reader = pd.read_csv(DATA_DIR + fd_call_filename,
+                         header=0,
+                         usecols=usecols,
+                         dtype=dtype,
+                         chunksize=chunksize)
+
+    for chunk in reader:
+        chunk = chunk[chunk['Call Type'] == MEDICAL_CALL_TYPE]
+        if watermark is not None:
+            chunk = watermark.select_new_calls(chunk)
+        if chunk.empty:
+            continue
+        yield apply_call_schema(parse_call_dates(chunk.copy()))
 
 
 class MedicalIncidents():
@@ -14,23 +179,40 @@ class MedicalIncidents():
     Read the fire department incident database, filter by medical incidents,
     assign a tract to each incident."""
 
-    def __init__(self, fd_call_filename):
-        """Load medical incidents in fire department call dataset."""
+    def __init__(self, fd_call_filename, chunksize=None, usecols=None,
+                 dtype=None, watermark=None):
+        """Load medical incidents in fire department call dataset.
+
+        The columns of the dataframe are cast to the compact dtypes in
+        `CALL_SCHEMA`. If `chunksize` is given, the call dataset is streamed
+        in chunks of `chunksize` rows (see `iter_medical_incident_chunks`)
+        instead of being read all at once, so only one chunk of the raw CSV
+        is in memory at a time. The compact chunks are then combined with
+        their categoricals kept (see `concat_medical_calls`), which takes up
+        to twice the memory of the compact dataframe while they're combined.
+        If a `CallWatermark` is also given, only the calls that are new or
+        changed since the last ingest are loaded."""
+        if watermark is not None and not chunksize:
+            chunksize = 500000
+        if chunksize:
+            chunks = list(iter_medical_incident_chunks(fd_call_filename,
+                                                       chunksize=chunksize,
+                                                       usecols=usecols,
+                                                       dtype=dtype,
+                                                       watermark=watermark))
+            if chunks:
+                self.df = concat_medical_calls(chunks)
+                del chunks
+            else:
+                self.df = pd.DataFrame(columns=usecols)
+            return
+
         all_call_df = pd.read_csv(DATA_DIR + fd_call_filename,
                                   header=0,
+                                  usecols=usecols,
+                                  dtype=dtype,
                                   parse_dates=True)
 
-        def _parse_dates():
-            """Parse date columns to `datetime` format."""
-            for col in ['Call Date', 'Watch Date']:
-                all_call_df[col] = pd.to_datetime(all_call_df[col],
-                                                  format='%m/%d/%Y')
-            for col in ['Received DtTm', 'Entry DtTm', 'Dispatch DtTm',
-                        'Response DtTm', 'On Scene DtTm', 'Transport DtTm',
-                        'Hospital DtTm', 'Available DtTm']:
-                all_call_df[col] = pd.to_datetime(all_call_df[col],
-                                                  format='%m/%d/%Y %I:%M:%S %p')
-
         def _get_medical_incidents():
             """
             Filter call dataset to only include medical incidents.
@@ -38,15 +220,62 @@ class MedicalIncidents():
             TODO: Take this out of this function and put it in the init. It
             looks stupid here and it's unnecessary.
             """
-            df = all_call_df[all_call_df['Call Type'] =='Medical Incident']
+            df = all_call_df[all_call_df['Call Type'] == MEDICAL_CALL_TYPE]
             return df
 
-        _parse_dates()
-        self.df = _get_medical_incidents()
+        parse_call_dates(all_call_df)
+        self.df = apply_call_schema(_get_medical_incidents().copy())
 
     def update_cached_df(self, pickled_df_filename='Med_Calls_with_Tracts.pkl'):
-        """Save the pickled dataframe."""
-        self.df.to_pickle(DATA_DIR + pickled_df_filename)
+        """Save the pickled dataframe.
+
+        If the filename ends in '.parquet', the dataframe is instead written
+        to a Parquet store partitioned by year (see `call_store`)."""
+        if is_parquet_store(pickled_df_filename):
+            write_medical_calls(self.df, DATA_DIR + pickled_df_filename)
+        else:
+            self.df.to_pickle(DATA_DIR + pickled_df_filename)
+
+    def append_to_cached_df(self,
+                            pickled_df_filename='Med_Calls_with_Tracts.pkl'):
+        """Add the calls to the saved dataframe.
+
+        Calls already in the saved dataframe (matched on 'RowID') are replaced
+        by their new version. With a Parquet store, only the partitions of the
+        affected years are rewritten."""
+        if is_parquet_store(pickled_df_filename):
+            upsert_medical_calls(self.df, DATA_DIR + pickled_df_filename)
+        else:
+            cached_df = pd.read_pickle(DATA_DIR + pickled_df_filename)
+            cached_df = cached_df[~cached_df['RowID'].isin(self.df['RowID'])]
+            pd.concat([cached_df, self.df]).to_pickle(
+                DATA_DIR + pickled_df_filename
+            )
+
+    def backfill_locations(self, city='San Francisco', state='CA',
+                           n_workers=4):
+        """Geocode the addresses of the calls that have no location.
+
+        The missing 'Location' values are filled in from the geocoded
+        'Address' of the calls, in the same '(lat, lon)' format as the call
+        dataset, using the batch geocoder (see `geocode_addresses`). Each
+        address is only geocoded once, however many calls share it. Return
+        the number of calls whose location was filled in."""
+        is_missing = self.df['Location'].isna() & self.df['Address'].notna()
+        addresses = self.df.loc[is_missing, 'Address'].astype(str).tolist()
+        if not addresses:
+            return 0
+
+        locations = [
+            f"({lct.latitude}, {lct.longitude})" if lct else np.nan
+            for lct in geocode_addresses(addresses,
+                                         city=city,
+                                         state=state,
+                                         n_workers=n_workers)
+        ]
+        self.df.loc[is_missing, 'Location'] = locations
+
+        return int(pd.notna(locations).sum())
 
     def _convert_coords_to_shapely_point(self):
         """
@@ -55,45 +284,76 @@ class MedicalIncidents():
         For each event, store its coordinates in 'shapely' POINT format.
         This will make it easy to check whether an event is within a certain
         US Census tract, since the tract boundaries are saved as POLYGONs.
+
+        The coordinates are parsed from the 'Location' column in one pass and
+        the POINTs are created in bulk. Events with no location in the
+        original dataset get a POINT with NaN coordinates. The parsed
+        coordinates are returned as (lon, lat) arrays.
         """
-        points = []
-        for i, location in zip(self.df.index,
-                               self.df['Location']):
-            try:
-                lat = float(re.search(r'\((.*?)\,', location).group(1))
-                lon = float(re.search(r'\, (.*?)\)', location).group(1))
-            except TypeError:
-                # If any of the events is missing the location in the original,
-                # dataset, leave the Coords value to np.nan and move on.
-                lat, lon = np.nan, np.nan
-            points.append(Point(lon, lat))
-        self.df['Coords'] = points
-
-    @staticmethod
-    def _find_tract(tracts, location):
-        """Find the tract that each (lon, lat) pair is in."""
-        for idx, polygon in tracts.df['Polygon'].items():
-            if location.within(polygon):
-                tract = tracts.df.at[idx, 'GEOID10']
-                return tract
-        return np.nan
+        lons, lats = parse_location_coords(self.df['Location'].values)
+        self.df['Coords'] = shapely.points(lons, lats)
+
+        return lons, lats
 
     def assign_tracts_to_calls(self, tracts_filename='Census_2010_Tracts.csv',
                                update_cached_df=False,
-                               pickled_df_filename='Med_Calls_with_Tracts.pkl'):
+                               pickled_df_filename='Med_Calls_with_Tracts.pkl',
+                               n_workers=1,
+                               backfill_locations=False):
         """Assign tracts to each ambulance call.
 
         The tracts used come from the 2010 US Census. The ambulance call
         database has (lon, lat) locations for each of the events. This function
         uses the tract boundaries to assign a tract to each (lon, lat) location
         in the call database.
+
+        The tracts are found with a spatial index over the tract polygons
+        (see `TractLocator`), rather than by testing every call against every
+        tract. With `n_workers > 1`, the calls are split between `n_workers`
+        processes; the result is the same as with a single process. If
+        `backfill_locations=True`, the calls with no location are first
+        geocoded from their address (see `backfill_locations`).
         """
+        if backfill_locations:
+            self.backfill_locations()
+
         tracts = get_updated_tract_data(tracts_filename)
-        self._convert_coords_to_shapely_point()
+        lons, lats = self._convert_coords_to_shapely_point()
 
-        for idx, location in self.df['Coords'].items():
-            self.df.at[idx, 'Tract'] = self._find_tract(tracts, location)
+        self.df['Tract'] = TractLocator.from_tracts_df(tracts.df).locate_many(
+            lons,
+            lats,
+            n_workers=n_workers,
+        )
+        apply_call_schema(self.df)
 
         # Save the pickled dataframe.
         if update_cached_df:
             self.update_cached_df(pickled_df_filename)
+
+
+def ingest_new_calls(fd_call_filename,
+                     pickled_df_filename='Med_Calls_with_Tracts.parquet',
+                     watermark_filename='Med_Calls_Watermark.pkl',
+                     tracts_filename='Census_2010_Tracts.csv',
+                     chunksize=500000,
+                     n_workers=1):
+    """Ingest the medical calls that are new since the last ingest.
+
+    Only the new or changed calls in the fire department call dataset have
+    their dates parsed and their tracts assigned, and only they are written
+    to the saved medical calls. The watermark is then moved forward. Return
+    the number of calls ingested."""
+    watermark = CallWatermark(watermark_filename)
+    incidents = MedicalIncidents(fd_call_filename,
+                                 chunksize=chunksize,
+                                 watermark=watermark)
+
+    if not incidents.df.empty:
+        incidents.assign_tracts_to_calls(tracts_filename=tracts_filename,
+                                         n_workers=n_workers)
+        incidents.append_to_cached_df(pickled_df_filename)
+
+    watermark.commit()
+
+    return len(incidents.df)
@@ -0,0 +1,91 @@
+import os
+import hashlib
+import threading
+
+from joblib import load, dump
+
+
+def _file_checksum(fp, block_size=2**20):
+    """Return the MD5 checksum of a file."""
+    md5 = hashlib.md5()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+
+def save_model(model, filename):
+    """Save a fitted model to a joblib file.
+
+    The model is first written to a temporary file, which then replaces the
+    old one, so that processes using the old model (which may be memory-mapped)
+    are not affected, and so that they never load a half-written model."""
+    tmp_filename = f"{filename}.tmp"
+    dump(model, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+class ModelRegistry:
+    """Fitted models loaded by the process, by file path and checksum.
+
+    A model is only loaded from its joblib file the first time it's needed,
+    with its large arrays memory-mapped (see `joblib.load`), and then kept in
+    memory. Each time the model is requested, the modification time and size
+    of the file are checked, which is cheap; if they have changed, the file
+    is loaded again only if its checksum has changed too. A newly trained
+    model saved over the old one (see `save_model`) is therefore used from
+    the next request on, without restarting the process."""
+
+    def __init__(self, mmap_mode='r'):
+        self.mmap_mode = mmap_mode
+
+        # file path -> ((mtime, size), checksum, model)
+        self._models = {}
+
+        # the registry is shared by the threads of the web server, and a
+        # model should only be loaded by one of them
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """Return the model saved in a joblib file."""
+        fp = os.path.abspath(filename)
+
+        with self._lock:
+            stat = os.stat(fp)
+            file_key = (stat.st_mtime_ns, stat.st_size)
+
+            entry = self._models.get(fp)
+            if entry is not None and entry[0] == file_key:
+                return entry[2]
+
+            checksum = _file_checksum(fp)
+            if entry is not None and entry[1] == checksum:
+                model = entry[2]
+            else:
+                model = load(fp, mmap_mode=self.mmap_mode)
+            self._models[fp] = (file_key, checksum, model)
+
+            return model
+
+    def invalidate(self, filename=None):
+        """Load a model (or all of them) again the next time it's needed."""
+        with self._lock:
+            if filename is None:
+                self._models.clear()
+            else:
+                self._models.pop(os.path.abspath(filename), None)
+
+
+# model registry used by the whole process
+_MODEL_REGISTRY = ModelRegistry()
+
+
+def get_model(filename='rf_model.joblib'):
+    """Return the model saved in a joblib file, loading it only if needed."""
+    return _MODEL_REGISTRY.get(filename)
+
+
+def invalidate_models(filename=None):
+    """Load a model (or all of them) again the next time it's needed."""
+    _MODEL_REGISTRY.invalidate(filename)
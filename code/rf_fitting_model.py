@@ -4,7 +4,6 @@ from copy import deepcopy
 import numpy as np
 import pandas as pd
 import holidays
-from joblib import dump
 from sklearn.preprocessing import OneHotEncoder, normalize
 from sklearn.model_selection import train_test_split, RandomizedSearchCV
 from sklearn.ensemble import RandomForestRegressor
@@ -18,8 +17,8 @@ from code.utils import set_time_features, \
                        set_lon_lat_from_shapely_point, \
                        find_dist_to_closest_fire_station, \
                        find_dist_to_closest_hospital
-from code.location_tools import get_locations_as_shape
-from code.db_model import SFHospital, SFFDFireStation
+from code.facilities import get_facilities
+from code.model_registry import save_model
 
 
 class RFModel:
@@ -31,6 +30,8 @@ class RFModel:
     def __init__(
         self,
         filename='Med_Calls_with_Tracts.pkl',
+        columns=None,
+        years=None,
         flag_holidays=True,
         country='US',
         state='CA',
@@ -43,8 +44,14 @@ class RFModel:
         min_samples_split=200,
         max_features='log2',
     ):
-        """Read the pickled Pandas dataframe of medical incidents."""
-        self.original_df = get_medical_calls(filename=filename)
+        """Read the pickled Pandas dataframe of medical incidents.
+
+        The medical incidents can also be read from a Parquet store, in which
+        case passing `columns=MODEL_INPUT_COLS` and a (first, last) range of
+        `years` only loads the data needed to fit the model."""
+        self.original_df = get_medical_calls(filename=filename,
+                                             columns=columns,
+                                             years=years)
 
         # this will be the preprocessed dataframe
         self.df = deepcopy(self.original_df)
@@ -77,7 +84,8 @@ class RFModel:
 
     def _filter_features(self, del_columns=NON_FEATURE_COLS):
         """Filter out columns that will not be used as model features."""
-        self.df.drop(NON_FEATURE_COLS, axis=1, inplace=True)
+        # some of these columns may not have been loaded in the first place
+        self.df.drop(NON_FEATURE_COLS, axis=1, inplace=True, errors='ignore')
 
     def _get_response_time(self):
         """Calculate the ambulance response time for each incident.
@@ -150,7 +158,7 @@ class RFModel:
         """Get the distance to the closest fire station."""
         self.df = find_dist_to_closest_fire_station(
             self.df,
-            get_locations_as_shape(SFFDFireStation)
+            get_facilities('fire_stations')
         )
 
     def _get_dist_to_closest_hospital(self):
@@ -158,7 +166,7 @@ class RFModel:
 
         self.df = find_dist_to_closest_hospital(
             self.df,
-            get_locations_as_shape(SFHospital)
+            get_facilities('hospitals')
         )
 
     def preprocess(self):
@@ -242,5 +250,7 @@ class RFModel:
         )
 
     def save_model(self, filename='rf_model.joblib'):
-        """Save the RF regression model."""
-        dump(self.model, filename)
+        """Save the RF regression model.
+
+        A running app picks up the new model on its next prediction."""
+        save_model(self.model, filename)
@@ -4,6 +4,7 @@ from sqlalchemy_utils import drop_database, \
                              create_database, \
                              database_exists
 from sqlalchemy.orm import sessionmaker
+from geoalchemy2.elements import WKBElement
 
 from code.db_model import connect_to_db, \
                           db, \
@@ -13,6 +14,10 @@ from code.db_model import connect_to_db, \
                           MedicalCall
 from code.flaskr import app
 from code.key_utils import get_secret_key
+from code.tract_tools import build_tract_artifact
+from code.gazetteer import build_gazetteer
+from code.facilities import update_facilities_version
+from code.distance_raster import build_distance_raster
 from code.sf_data import get_fire_stations, \
                          get_hospitals, \
                          get_tract_geom, \
@@ -54,19 +59,22 @@ def load_hospital_table():
 
 
 def load_tract_geom_table():
-    """Load the tract geometry into the database."""
+    """Load the tract geometry into the database.
+
+    The tract geometries are passed to PostGIS as (E)WKB, and the rows are
+    returned as mappings that can be inserted in bulk."""
     TractGeometry.query.delete()
 
     tracts = get_tract_geom()
     db_tracts = []
-    for tract in tracts:
-        db_tract = TractGeometry(
-             geoid10 = tract[0],
-             aland10 = tract[1],
-             awater10 = tract[2],
-             the_geom = tract[3]
-                                )
-        db_tracts.append(db_tract)
+    for geoid10, aland10, awater10, the_geom in tracts:
+        db_tracts.append({
+            'geoid10': geoid10,
+            'aland10': aland10,
+            'awater10': awater10,
+            'the_geom': (WKBElement(the_geom, extended=True)
+                         if the_geom is not None else None),
+        })
 
     return db_tracts
 
@@ -112,6 +120,10 @@ def load_medical_call_table():
     for col in possible_NaT_cols:
         medical_calls[col] = medical_calls[col].astype(object).where(medical_calls[col].notnull(), None)
 
+    # the tracts are stored as nullable integers, but the database holds them
+    # as strings
+    medical_calls['tract'] = medical_calls['tract'].astype(str).where(medical_calls['tract'].notnull(), None)
+
     medical_calls['coords'] = 'POINT' + medical_calls['location'].str.replace(',', '')
 
     return medical_calls
@@ -122,7 +134,7 @@ def populate_tables(session):
 
     # load the tract geometry table
     db_tract_geom = load_tract_geom_table()
-    session.add_all(db_tract_geom)
+    session.bulk_insert_mappings(TractGeometry, db_tract_geom)
 
     # load the hospital table
     db_hospitals = load_hospital_table()
@@ -173,3 +185,18 @@ if __name__ == "__main__":
 
     with session_scope() as session:
         populate_tables(session)
+
+    # the facilities loaded before the tables were reloaded are stale, in this
+    # process and in the running app
+    update_facilities_version()
+
+    # prebuild the tract geometry used to find the tract of new incidents
+    build_tract_artifact()
+
+    # index the addresses of the historical calls, so that new incidents at
+    # known addresses are geocoded without calling the remote geocoder
+    build_gazetteer()
+
+    # precompute the distances to the nearest facilities used for new
+    # incidents
+    build_distance_raster()
@@ -3,17 +3,45 @@ import urllib
 from bs4 import BeautifulSoup
 import pandas as pd
 
-from code.location_tools import get_coords_from_address
-from code.tract_tools import get_updated_tract_data, build_multipolygon
+from code.batch_geocoder import geocode_addresses
+from code.exceptions import AddressError
+from code.tract_tools import get_updated_tract_data, build_multipolygons
 from code.key_utils import get_secret_key
+from code.call_store import is_parquet_store, \
+                            read_medical_calls, \
+                            filter_medical_calls, \
+                            apply_call_schema
+
+
+def get_medical_calls(filename='Med_Calls_with_Tracts.pkl',
+                      columns=None,
+                      years=None,
+                      unit_types=None,
+                      priorities=None):
+    """Read the dataframe of SF medical calls.
+
+    The calls are read from a pickled dataframe, or from a Parquet store
+    partitioned by year if the filename ends in '.parquet'. Optionally, only
+    a subset of the `columns` is returned, and the calls are filtered by an
+    inclusive range of `years` and by lists of `unit_types` and `priorities`.
+    With a Parquet store, only the requested columns and years are read from
+    disk. The columns are cast to the compact dtypes in `CALL_SCHEMA`."""
 
+    DATA_DIR = get_secret_key('DATA_DIR')
 
-def get_medical_calls(filename='Med_Calls_with_Tracts.pkl'):
-    """Read the pickled dataframe of SF medical calls."""
+    query = dict(
+        columns=columns,
+        years=years,
+        unit_types=unit_types,
+        priorities=priorities,
+    )
 
-    DATA_DIR = get_secret_key('DATA_DIR')
+    if is_parquet_store(filename):
+        return read_medical_calls(DATA_DIR + filename, **query)
 
-    return pd.read_pickle(DATA_DIR + filename)
+    return apply_call_schema(
+        filter_medical_calls(pd.read_pickle(DATA_DIR + filename), **query)
+    )
 
 
 def get_tract_geom(update_tract_geom=True,
@@ -23,27 +51,21 @@ def get_tract_geom(update_tract_geom=True,
     The tract geometry information can be read directly from a CSV file if
     `update_tract_geom=False`, or after intersecting the tracts with a
     county shape file to create more accurate boundaries and change the
-    geometry of the polygons defining the tracts."""
+    geometry of the polygons defining the tracts. The geometry of each tract
+    is returned as a WKB MULTIPOLYGON."""
 
-    tract_geom = []
     if update_tract_geom:
         tracts = get_updated_tract_data(tracts_filename)
-        for idx in tracts.df.index:
-            geoid10 = tracts.df.at[idx, 'GEOID10']
-            # converting these from type 'np.int64', which returns the
-            # following error when trying to insert into the database:
-            #
-            # psycopg2.ProgrammingError: can't adapt type 'numpy.int64'
-            #
-            # to type 'int', which somehow works...
-            aland10 = int(tracts.df.at[idx, 'ALAND10'])
-            awater10 = int(tracts.df.at[idx, 'AWATER10'])
-            multipolygon_constructor = build_multipolygon(tracts, geoid10)
-
-            tract_geom.append((geoid10, aland10, awater10,
-                               multipolygon_constructor))
-
-        return tract_geom
+        # `tolist` converts the areas from type 'np.int64', which returns the
+        # following error when trying to insert into the database:
+        #
+        # psycopg2.ProgrammingError: can't adapt type 'numpy.int64'
+        #
+        # to type 'int', which somehow works...
+        return list(zip(tracts.df['GEOID10'].tolist(),
+                        tracts.df['ALAND10'].astype(int).tolist(),
+                        tracts.df['AWATER10'].astype(int).tolist(),
+                        build_multipolygons(tracts)))
     else:
         # TODO: Implement reading the tract data as is from a CSV file.
         raise Warning("Sorry, this is not implemented yet...")
@@ -56,17 +78,26 @@ def get_hospitals():
     DATA_DIR = get_secret_key('DATA_DIR')
     sf_hospitals_fp = DATA_DIR + "sf_hospitals.txt"
 
-    hospitals = []
+    hospital_names = []
+    hospital_addresses = []
 
     with open(sf_hospitals_fp, 'r') as f:
         for hospital in f.readlines():
             hospital_data = hospital.split("|")
-            hospital_name = hospital_data[0].strip()
-            hospital_address = hospital_data[1].strip()
-            lct = get_coords_from_address(hospital_address)
-            hospitals.append((hospital_name,
-                              hospital_address,
-                              lct.longitude, lct.latitude))
+            hospital_names.append(hospital_data[0].strip())
+            hospital_addresses.append(hospital_data[1].strip())
+
+    # the hospitals are geocoded all at once
+    hospitals = []
+    for hospital_name, hospital_address, lct in zip(
+            hospital_names,
+            hospital_addresses,
+            geocode_addresses(hospital_addresses)):
+        if lct is None:
+            raise AddressError(hospital_address)
+        hospitals.append((hospital_name,
+                          hospital_address,
+                          lct.longitude, lct.latitude))
 
     return hospitals
 
@@ -86,7 +117,8 @@ def get_fire_stations():
 
     fire_station_html_table = html.find('div', {'class': 'view-opensf-layout'})
 
-    fire_stations = []
+    station_names = []
+    station_addresses = []
 
     for row in fire_station_html_table.find_all('tr'):
         station_name_html, station_address_html = row.find_all('td')
@@ -112,9 +144,19 @@ def get_fire_stations():
             station_address = station_address[:comma_index]
 
         if station_address:
-            lct = get_coords_from_address(station_address, 'San Francisco', 'CA')
-            fire_stations.append((station_name,
-                                  f"{station_address}, San Francisco, CA",
-                                  lct.longitude, lct.latitude))
+            station_names.append(station_name)
+            station_addresses.append(station_address)
+
+    # the stations are geocoded all at once
+    fire_stations = []
+    for station_name, station_address, lct in zip(
+            station_names,
+            station_addresses,
+            geocode_addresses(station_addresses, 'San Francisco', 'CA')):
+        if lct is None:
+            raise AddressError(station_address, 'San Francisco', 'CA')
+        fire_stations.append((station_name,
+                              f"{station_address}, San Francisco, CA",
+                              lct.longitude, lct.latitude))
 
     return fire_stations
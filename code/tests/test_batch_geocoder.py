@@ -0,0 +1,107 @@
+import unittest
+
+from geopy.exc import GeocoderUnavailable
+
+from code import batch_geocoder
+from code import geocoders
+
+
+class FlakyBackend(geocoders.StubBackend):
+    """Stub backend that fails the first `n_failures` times it's called."""
+
+    def __init__(self, locations, n_failures):
+        super().__init__(locations)
+        self.n_failures = n_failures
+
+    def geocode(self, address, timeout):
+        if self.n_failures > 0:
+            self.n_failures -= 1
+            raise GeocoderUnavailable("Service unavailable")
+        return super().geocode(address, timeout)
+
+
+class TestBatchGeocoder(unittest.TestCase):
+    """Test that a batch of addresses is geocoded in order, with retries."""
+
+    def setUp(self):
+        self.locations = {
+            '683 Sutter St, San Francisco CA': (-122.4116, 37.7887),
+            '15 Embarcadero Street, San Francisco CA': (-122.3936, 37.7953),
+        }
+        self.waits = []
+
+    def tearDown(self):
+        geocoders.set_geocoder_chain(None)
+
+    def test_geocode_addresses(self):
+        geocoders.set_geocoder_chain(
+            geocoders.GeocoderChain([geocoders.StubBackend(self.locations)])
+        )
+
+        locations = batch_geocoder.geocode_addresses(
+            ['15 Embarcadero', 'blah blah blah', '683 Sutter St',
+             '15 Embarcadero'],
+            city='San Francisco',
+            state='CA',
+            sleep=self.waits.append,
+        )
+
+        self.assertEqual([lct.longitude if lct else None
+                          for lct in locations],
+                         [-122.3936, None, -122.4116, -122.3936])
+
+        # addresses that can't be geocoded are not retried
+        self.assertEqual(self.waits, [])
+
+    def test_retries_wait_for_breaker(self):
+        # Nominatim-like backend with a 3-call outage: its breaker opens
+        # during the first attempt, so the retry waits until it lets a call
+        # through again
+        self.now = 0.
+
+        def clock():
+            return self.now
+
+        def sleep(seconds):
+            self.waits.append(seconds)
+            self.now += seconds
+
+        backend = FlakyBackend(self.locations, n_failures=3)
+        backend.breaker = geocoders.CircuitBreaker(max_failures=3,
+                                                   reset_timeout=60.,
+                                                   clock=clock)
+        geocoders.set_geocoder_chain(
+            geocoders.GeocoderChain([backend], clock=clock)
+        )
+
+        locations = batch_geocoder.geocode_addresses(
+            ['683 Sutter St'],
+            city='San Francisco',
+            state='CA',
+            backoff=1.,
+            sleep=sleep,
+        )
+
+        self.assertEqual(locations[0].latitude, 37.7887)
+        self.assertEqual(self.waits, [60.])
+
+    def test_retries(self):
+        # each attempt tries the 6 spellings of the address, so the backend
+        # fails the whole first attempt and the first spelling of the second
+        backend = FlakyBackend(self.locations, n_failures=7)
+        geocoders.set_geocoder_chain(geocoders.GeocoderChain([backend]))
+
+        locations = batch_geocoder.geocode_addresses(
+            ['683 Sutter St'],
+            city='San Francisco',
+            state='CA',
+            backoff=1.,
+            sleep=self.waits.append,
+        )
+
+        self.assertEqual(locations[0].latitude, 37.7887)
+        self.assertEqual(self.waits, [1., 2.])
+
+
+if __name__ == '__main__':
+    unittest.main()
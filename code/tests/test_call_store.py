@@ -0,0 +1,281 @@
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from code import call_store
+from code import sf_data
+from code.tract_tools import get_point_coords
+
+
+class TestCallSchema(unittest.TestCase):
+    """Test that the medical calls are cast to the compact schema."""
+
+    def setUp(self):
+        """Initialize a test dataframe of medical calls."""
+        self.df = pd.DataFrame({
+            'Unit Type': ['MEDIC', 'PRIVATE', 'MEDIC'],
+            'Original Priority': ['3', 'E', '2'],
+            'Tract': ['6075010100', np.nan, '6075061200'],
+            'Latitude': [37.7868, 37.7597, np.nan],
+            'Received DtTm': pd.to_datetime([
+                '2018-11-05 00:00:00',
+                '2018-11-05 01:00:00',
+                '2018-11-05 02:00:00',
+            ]),
+            'Address': ['683 SUTTER ST', '15 EMBARCADERO', '1 MARKET ST'],
+        })
+
+    def test_apply_call_schema(self):
+        df = call_store.apply_call_schema(self.df.copy())
+
+        self.assertEqual(df['Unit Type'].dtype, 'category')
+        self.assertEqual(df['Original Priority'].dtype, 'category')
+        self.assertEqual(df['Tract'].dtype, 'Int64')
+        self.assertEqual(df['Latitude'].dtype, np.float32)
+
+        self.assertEqual(df['Tract'][0], 6075010100)
+        self.assertTrue(df['Tract'].isna()[1])
+
+        # columns outside the schema are left alone
+        self.assertEqual(df['Address'].dtype, self.df['Address'].dtype)
+
+    def test_concat_medical_calls(self):
+        chunks = [call_store.apply_call_schema(self.df.iloc[[i]].copy())
+                  for i in range(len(self.df))]
+        self.assertNotEqual(list(chunks[0]['Unit Type'].cat.categories),
+                            list(chunks[1]['Unit Type'].cat.categories))
+
+        df = call_store.concat_medical_calls(chunks)
+
+        self.assertEqual(df['Unit Type'].dtype, 'category')
+        self.assertEqual(df['Original Priority'].dtype, 'category')
+        self.assertEqual(df['Unit Type'].tolist(),
+                         self.df['Unit Type'].tolist())
+        pd.testing.assert_index_equal(df.index, self.df.index)
+
+    def test_memory_report(self):
+        report = call_store.memory_report(self.df)
+
+        self.assertIn('Total', report.index)
+        self.assertAlmostEqual(
+            report.loc['Total', 'memory_MB'],
+            self.df.memory_usage(index=True, deep=True).sum() / 1024.**2,
+        )
+
+
+class TestCallStore(unittest.TestCase):
+    """Test that the medical calls read back from the Parquet store are the
+    ones written to it, and the same as those read from a pickle."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store_dirname = os.path.join(self.tmp_dir,
+                                          'Med_Calls_with_Tracts.parquet')
+
+        self.df = call_store.apply_call_schema(pd.DataFrame({
+            'RowID': ['1-M1', '2-M1', '3-P1', '4-M1', '5-P1', '6-M1'],
+            'Unit Type': ['MEDIC', 'MEDIC', 'PRIVATE',
+                          'MEDIC', 'PRIVATE', 'MEDIC'],
+            'Original Priority': ['3', '2', 'E', '3', '3', '2'],
+            'Received DtTm': pd.to_datetime([
+                '2016-03-01 10:00:00',
+                '2016-07-01 11:00:00',
+                '2017-01-05 12:00:00',
+                '2017-08-15 13:00:00',
+                '2018-02-20 14:00:00',
+                '2018-11-05 15:00:00',
+            ]),
+            'Coords': shapely.points(
+                [-122.41, np.nan, -122.39, -122.47, -122.45, -122.40],
+                [37.78, np.nan, 37.79, 37.75, 37.76, 37.79],
+            ),
+            'Tract': ['6075011700', None, '6075061500',
+                      '6075030400', '6075030600', '6075061500'],
+        }))
+
+        self.df.to_pickle(os.path.join(self.tmp_dir,
+                                       'Med_Calls_with_Tracts.pkl'))
+        call_store.write_medical_calls(self.df, self.store_dirname)
+
+        self.patch = mock.patch.object(sf_data, 'get_secret_key',
+                                       lambda key_name: self.tmp_dir + '/')
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def sort_calls(df):
+        return df.sort_values('RowID').reset_index(drop=True)
+
+    def assert_same_calls(self, df, expected):
+        """Compare two dataframes of calls, with their POINTs compared by
+        coordinates, since the POINTs with NaN coordinates are serialized as
+        empty POINTs."""
+        df = self.sort_calls(df)
+        expected = self.sort_calls(expected)
+        if 'Coords' in df.columns:
+            for calls in [df, expected]:
+                calls['Longitude'], calls['Latitude'] = get_point_coords(
+                    calls.pop('Coords').values
+                )
+
+        pd.testing.assert_frame_equal(df, expected[df.columns],
+                                      check_categorical=False)
+
+    def test_round_trip(self):
+        df = call_store.read_medical_calls(self.store_dirname)
+
+        self.assertEqual(sorted(os.listdir(self.store_dirname)),
+                         ['Received Year=2016',
+                          'Received Year=2017',
+                          'Received Year=2018'])
+        self.assertEqual(sorted(df.columns), sorted(self.df.columns))
+        self.assertEqual(df['Unit Type'].dtype, 'category')
+        self.assertEqual(df['Tract'].dtype, 'Int64')
+        self.assert_same_calls(df, self.df)
+
+        # the POINTs are stored as WKB, and the missing ones come back empty
+        coords = self.sort_calls(df)['Coords']
+        self.assertIsInstance(coords.iloc[0], shapely.Point)
+        self.assertEqual((coords.iloc[0].x, coords.iloc[0].y),
+                         (-122.41, 37.78))
+        self.assertTrue(coords.iloc[1].is_empty)
+
+    def test_filters(self):
+        df = call_store.read_medical_calls(self.store_dirname,
+                                           columns=['RowID', 'Tract'],
+                                           years=(2017, None))
+        self.assertEqual(list(df.columns), ['RowID', 'Tract'])
+        self.assertEqual(sorted(df['RowID']), ['3-P1', '4-M1', '5-P1', '6-M1'])
+
+        df = call_store.read_medical_calls(self.store_dirname,
+                                           years=(None, 2016))
+        self.assertEqual(sorted(df['RowID']), ['1-M1', '2-M1'])
+
+        df = call_store.read_medical_calls(self.store_dirname,
+                                           years=(2017, 2018),
+                                           unit_types=['MEDIC'],
+                                           priorities=['2', '3'])
+        self.assertEqual(sorted(df['RowID']), ['4-M1', '6-M1'])
+
+    def interrupt_after(self, n_replaces):
+        """Make the store writes fail after `n_replaces` directory renames."""
+        replace = os.replace
+        n_calls = []
+
+        def interrupted_replace(src, dst):
+            if len(n_calls) == n_replaces:
+                raise KeyboardInterrupt
+            n_calls.append(1)
+            replace(src, dst)
+
+        return mock.patch.object(call_store.os, 'replace', interrupted_replace)
+
+    def test_interrupted_upsert(self):
+        # a call of 2017 is updated, and a call of 2019 is added...
+        df = self.df.iloc[[3]].copy()
+        df['Unit Type'] = 'PRIVATE'
+        df = pd.concat([df, self.df.iloc[[5]].assign(
+            **{'RowID': '7-M1',
+               'Received DtTm': pd.Timestamp('2019-01-01 00:30:00')}
+        )])
+
+        # ...but the upsert stops once the 2017 partition is moved aside
+        with self.interrupt_after(1), \
+                self.assertRaises(KeyboardInterrupt):
+            call_store.upsert_medical_calls(df, self.store_dirname)
+        self.assertNotIn('Received Year=2017',
+                         os.listdir(self.store_dirname))
+
+        # the next write puts it back before upserting
+        call_store.upsert_medical_calls(df.iloc[[1]], self.store_dirname)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['Med_Calls_with_Tracts.parquet',
+                          'Med_Calls_with_Tracts.pkl'])
+        expected = call_store.apply_call_schema(
+            pd.concat([self.df, df.iloc[[1]]])
+        )
+        self.assert_same_calls(
+            call_store.read_medical_calls(self.store_dirname), expected
+        )
+
+        # the upsert is done again, and stops once the 2017 partition is
+        # replaced, so the old one is no longer needed
+        with self.interrupt_after(2), \
+                self.assertRaises(KeyboardInterrupt):
+            call_store.upsert_medical_calls(df, self.store_dirname)
+        call_store.recover_interrupted_write(self.store_dirname)
+
+        expected = call_store.apply_call_schema(
+            pd.concat([self.df.drop(index=3), df])
+        )
+        self.assertFalse(os.path.exists(self.store_dirname + '.staging'))
+        self.assert_same_calls(
+            call_store.read_medical_calls(self.store_dirname), expected
+        )
+
+    def test_interrupted_overwrite(self):
+        # the store is moved aside, but the new one isn't moved in
+        with self.interrupt_after(1), \
+                self.assertRaises(KeyboardInterrupt):
+            call_store.write_medical_calls(self.df.iloc[:2],
+                                           self.store_dirname)
+        self.assertFalse(os.path.exists(self.store_dirname))
+
+        # the next upsert adds the calls to the old store, rather than
+        # starting a new one
+        call_store.upsert_medical_calls(self.df.iloc[[5]].assign(
+            RowID='7-M1'
+        ), self.store_dirname)
+        self.assertEqual(
+            sorted(call_store.read_medical_calls(self.store_dirname)['RowID']),
+            ['1-M1', '2-M1', '3-P1', '4-M1', '5-P1', '6-M1', '7-M1'],
+        )
+        self.assertFalse(os.path.exists(self.store_dirname + '.old'))
+        self.assertFalse(os.path.exists(self.store_dirname + '.new'))
+
+    def test_filter_dataframe(self):
+        # the filters are combined in one mask, which doesn't depend on the
+        # index of the calls
+        df = self.df.set_index(pd.Index([5, 4, 3, 2, 1, 0]))
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            filtered = call_store.filter_medical_calls(
+                df,
+                years=(2017, 2018),
+                unit_types=['MEDIC'],
+                priorities=['2', '3'],
+            )
+        self.assertEqual(sorted(filtered['RowID']), ['4-M1', '6-M1'])
+
+    def test_pickle_and_parquet(self):
+        queries = [
+            {},
+            {'columns': ['RowID', 'Coords', 'Tract']},
+            {'years': (2016, 2017)},
+            {'unit_types': ['PRIVATE']},
+            {'priorities': ['E'], 'years': (2017, 2017)},
+        ]
+        for query in queries:
+            with self.subTest(**query):
+                self.assert_same_calls(
+                    sf_data.get_medical_calls(
+                        'Med_Calls_with_Tracts.parquet', **query
+                    ),
+                    sf_data.get_medical_calls(
+                        'Med_Calls_with_Tracts.pkl', **query
+                    ),
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,12 @@
 import unittest
 import datetime as dt
 
+import numpy as np
 import pandas as pd
+import shapely
 
 from code import utils
+from code.mappings import FEATURE_COLS
 
 
 class TestModelFeatures(unittest.TestCase):
@@ -86,6 +89,63 @@ class TestModelFeatures(unittest.TestCase):
             False
         )
 
+    def test_set_holidays(self):
+        """Test that holidays are flagged from the precomputed calendar."""
+        df = pd.DataFrame({
+            'Received DtTm': pd.to_datetime([
+                '2018-07-04 00:00:00',
+                '2018-07-04 23:59:59',
+                '2018-07-05 00:00:00',
+                '1998-12-25 12:00:00',
+            ])
+        })
+
+        df = utils.set_holidays(df, country='US', state='CA')
+        np.testing.assert_array_equal(df['is_holiday'].values, [1, 1, 0, 1])
+
+        # the calendar is shared by all the calls with the same parameters
+        self.assertIs(utils.get_holiday_calendar('US', 'CA'),
+                      utils.get_holiday_calendar('US', 'CA'))
+
+    def test_encode_time_features(self):
+        """Test that the feature matrix matches the dataframe features."""
+        dttms = pd.to_datetime([
+            '2018-11-05 00:00:00',
+            '2019-07-04 13:45:00',
+            '2020-12-31 23:59:00',
+        ])
+        df = pd.DataFrame({'Received DtTm': dttms})
+        for col in FEATURE_COLS:
+            if col not in df.columns and col != 'Year':
+                df[col] = 1.
+
+        features = utils.build_feature_matrix(df, dttms.values)
+        df_processed = utils.set_time_features(df)
+
+        self.assertEqual(features.dtype, np.float32)
+        self.assertEqual(features.shape, (3, len(FEATURE_COLS)))
+        np.testing.assert_allclose(
+            features,
+            df_processed[FEATURE_COLS].values.astype(np.float32),
+            atol=1e-6,
+        )
+        np.testing.assert_array_equal(
+            features[:, FEATURE_COLS.index('is_holiday')], [0, 1, 0]
+        )
+
+    def test_set_lon_lat_from_shapely_point(self):
+        df = pd.DataFrame({
+            'Coords': shapely.points([-122.4116, np.nan], [37.7868, np.nan]),
+        })
+
+        df = utils.set_lon_lat_from_shapely_point(df)
+
+        self.assertNotIn('Coords', df.columns)
+        self.assertEqual(df['Longitude'].dtype, np.float32)
+        self.assertEqual(df['Latitude'].dtype, np.float32)
+        self.assertAlmostEqual(df['Longitude'][0], -122.4116, places=4)
+        self.assertAlmostEqual(df['Latitude'][0], 37.7868, places=5)
+        self.assertTrue(df.iloc[1].isna().all())
 
 
 if __name__ == '__main__':
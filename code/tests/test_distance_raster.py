@@ -0,0 +1,153 @@
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from code import distance_raster
+from code import facilities
+from code import utils
+
+
+class TestDistanceRaster(unittest.TestCase):
+    """Test that the distances looked up in the raster are within its error
+    bound of the exact distances."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.facilities = {
+            'hospitals': facilities.Facilities(
+                ids=[1, 2],
+                names=['Hospital 1', 'Hospital 2'],
+                lngs=[-122.45, -122.40],
+                lats=[37.76, 37.79],
+            ),
+            'fire_stations': facilities.Facilities(
+                ids=[1, 2, 3],
+                names=['Station 1', 'Station 2', 'Station 3'],
+                lngs=[-122.41, -122.39, -122.47],
+                lats=[37.78, 37.79, 37.75],
+            ),
+        }
+
+        self.patch = mock.patch.object(distance_raster, 'DATA_DIR',
+                                       self.tmp_dir + '/')
+        self.patch.start()
+
+        distance_raster.build_distance_raster(
+            bounds=(-122.52, 37.70, -122.35, 37.83),
+            resolution=100.,
+            facilities=self.facilities,
+        )
+        self.raster = distance_raster.get_distance_raster()
+
+        rng = np.random.RandomState(0)
+        self.lngs = rng.uniform(-122.52, -122.35, 1000)
+        self.lats = rng.uniform(37.70, 37.83, 1000)
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lookup(self):
+        for kind, kind_facilities in self.facilities.items():
+            self.assertTrue(self.raster.is_current(kind, kind_facilities))
+
+            exact, _ = kind_facilities.nearest(self.lngs, self.lats)
+            distances, ids, is_inside = self.raster.lookup(kind,
+                                                           self.lngs,
+                                                           self.lats)
+
+            self.assertTrue(is_inside.all())
+            self.assertLessEqual(np.abs(distances - exact).max(),
+                                 self.raster.error_bound)
+
+        # locations outside the raster
+        distances, ids, is_inside = self.raster.lookup('hospitals',
+                                                       [-123.], [37.7])
+        self.assertFalse(is_inside[0])
+        self.assertTrue(np.isnan(distances[0]))
+
+    def test_rebuild(self):
+        self.assertIs(distance_raster.get_distance_raster(), self.raster)
+
+        # the hospitals move, and the raster is rebuilt (e.g., by another
+        # process): the new raster is loaded on the next use
+        hospitals = facilities.Facilities(
+            ids=[1, 2],
+            names=['Hospital 1', 'Hospital 2'],
+            lngs=[-122.48, -122.38],
+            lats=[37.72, 37.80],
+        )
+        self.assertFalse(self.raster.is_current('hospitals', hospitals))
+
+        distance_raster.build_distance_raster(
+            bounds=(-122.52, 37.70, -122.35, 37.83),
+            resolution=100.,
+            facilities={'hospitals': hospitals},
+        )
+        raster = distance_raster.get_distance_raster()
+
+        self.assertIsNot(raster, self.raster)
+        self.assertTrue(raster.is_current('hospitals', hospitals))
+
+        # the old raster can still be read
+        distances, _, _ = self.raster.lookup('hospitals', [-122.45], [37.76])
+        self.assertLessEqual(distances[0], self.raster.error_bound)
+
+    def test_interrupted_rebuild(self):
+        # the build stops before it's put in use...
+        with mock.patch.object(distance_raster.os, 'replace',
+                               side_effect=KeyboardInterrupt), \
+                self.assertRaises(KeyboardInterrupt):
+            distance_raster.build_distance_raster(
+                bounds=(-122.0, 37.0, -121.9, 37.1),
+                resolution=100.,
+                facilities=self.facilities,
+            )
+
+        # ...so a process loading the raster gets the whole previous one
+        distance_raster._DISTANCE_RASTERS.clear()
+        raster = distance_raster.get_distance_raster()
+        self.assertIsNot(raster, self.raster)
+        self.assertEqual(raster.meta, self.raster.meta)
+        self.assertEqual(raster.shape, self.raster.shape)
+
+    def test_no_facilities(self):
+        distance_raster.build_distance_raster(
+            bounds=(-122.52, 37.70, -122.35, 37.83),
+            resolution=100.,
+            facilities={},
+        )
+        raster = distance_raster.get_distance_raster()
+
+        self.assertFalse(raster.is_current('hospitals',
+                                           self.facilities['hospitals']))
+        self.assertEqual(raster.shape, self.raster.shape)
+
+    def test_find_dist_to_closest_hospital(self):
+        # one of the incidents is outside the raster
+        lngs = np.append(self.lngs, -123.)
+        lats = np.append(self.lats, 37.7)
+        df = pd.DataFrame({'Coords': shapely.points(lngs, lats)})
+
+        exact = utils.find_dist_to_closest_hospital(
+            df.copy(),
+            self.facilities['hospitals'],
+        )['Nearest Hospital']
+        looked_up = utils.find_dist_to_closest_hospital(
+            df.copy(),
+            self.facilities['hospitals'],
+            raster=self.raster,
+        )['Nearest Hospital']
+
+        np.testing.assert_allclose(looked_up, exact,
+                                   atol=self.raster.error_bound)
+        self.assertEqual(looked_up.iloc[-1], exact.iloc[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from code import facilities
+from code import file_version
+
+
+class TestFacilities(unittest.TestCase):
+    """Test that the facilities are loaded once, until invalidated."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.patch = mock.patch.object(facilities, 'DATA_DIR',
+                                       self.tmp_dir + '/')
+        self.patch.start()
+
+        facilities.invalidate_facilities()
+        self.n_loads = 0
+
+    def tearDown(self):
+        facilities.invalidate_facilities()
+        self.patch.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def load_facilities(self, kind):
+        self.n_loads += 1
+        return facilities.Facilities(
+            ids=[1, 2],
+            names=['Station 1', 'Station 2'],
+            lngs=[-122.41, -122.39],
+            lats=[37.78, 37.79],
+        )
+
+    def test_facilities(self):
+        stations = self.load_facilities('fire_stations')
+
+        self.assertEqual(len(stations), 2)
+        self.assertTrue(stations.coords.flags['C_CONTIGUOUS'])
+        np.testing.assert_array_equal(stations.coords[1], [-122.39, 37.79])
+        self.assertEqual(stations.points[0].x, -122.41)
+
+    def test_nearest(self):
+        stations = self.load_facilities('fire_stations')
+        rng = np.random.RandomState(0)
+        lngs = rng.uniform(-122.52, -122.35, 100)
+        lats = rng.uniform(37.70, 37.83, 100)
+        lngs[0] = np.nan
+
+        distances, ids = stations.nearest(lngs, lats)
+
+        # compare with the brute-force flat distances
+        dx = lngs[:, None] - stations.coords[None, :, 0]
+        dy = lats[:, None] - stations.coords[None, :, 1]
+        brute_force = np.hypot(dx, dy)
+        np.testing.assert_allclose(distances[1:],
+                                   brute_force[1:].min(axis=1) * 69.)
+        np.testing.assert_array_equal(
+            ids[1:].astype(int),
+            stations.ids[brute_force[1:].argmin(axis=1)],
+        )
+        self.assertTrue(np.isnan(distances[0]))
+        self.assertIsNone(ids[0])
+
+        # compare with the brute-force great-circle distances
+        haversine_distances, _ = stations.nearest(lngs, lats, haversine=True)
+        lng1, lat1 = np.radians(lngs[1:, None]), np.radians(lats[1:, None])
+        lng2, lat2 = np.radians(stations.coords.T)
+        a = np.sin((lat2 - lat1) / 2)**2 + \
+            np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2)**2
+        brute_force = 2 * 3958.8 * np.arcsin(np.sqrt(a))
+        np.testing.assert_allclose(haversine_distances[1:],
+                                   brute_force.min(axis=1))
+
+    def test_registry(self):
+        with mock.patch.object(facilities, '_load_facilities',
+                               self.load_facilities):
+            for _ in range(3):
+                facilities.get_facilities('fire_stations')
+            self.assertEqual(self.n_loads, 1)
+
+            facilities.invalidate_facilities()
+            facilities.get_facilities('fire_stations')
+            self.assertEqual(self.n_loads, 2)
+
+    def test_version(self):
+        with mock.patch.object(facilities, '_load_facilities',
+                               self.load_facilities):
+            facilities.update_facilities_version()
+            facilities.get_facilities('fire_stations')
+            facilities.get_facilities('fire_stations')
+            self.assertEqual(self.n_loads, 1)
+
+            # the tables are reloaded by another process, which writes a new
+            # version file without touching the registry of this one
+            version_fp = os.path.join(self.tmp_dir,
+                                      facilities.FACILITIES_VERSION_FILENAME)
+            with open(version_fp + '.new', 'w') as f:
+                f.write('reloaded\n')
+            os.replace(version_fp + '.new', version_fp)
+
+            # the new version is only seen once the last one has been
+            # checked long enough ago
+            facilities.get_facilities('fire_stations')
+            self.assertEqual(self.n_loads, 1)
+
+            file_version.expire_file_version(version_fp)
+            facilities.get_facilities('fire_stations')
+            facilities.get_facilities('fire_stations')
+            self.assertEqual(self.n_loads, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
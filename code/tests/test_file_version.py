@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from code import file_version
+
+
+class TestFileVersion(unittest.TestCase):
+    """Test that the version of a file is only checked once per interval."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fp = os.path.join(self.tmp_dir, 'Version')
+        self.now = 0.
+        self.version = file_version.FileVersion(self.fp,
+                                                interval=1.,
+                                                clock=lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def replace_file(self):
+        with open(self.fp + '.tmp', 'w') as f:
+            f.write('new version\n')
+        os.replace(self.fp + '.tmp', self.fp)
+
+    def test_version(self):
+        self.assertIsNone(self.version.get())
+
+        self.replace_file()
+        self.assertIsNone(self.version.get())
+        self.now = 1.
+        first_version = self.version.get()
+        self.assertIsNotNone(first_version)
+
+        self.replace_file()
+        self.now = 1.5
+        self.assertEqual(self.version.get(), first_version)
+        self.now = 2.
+        self.assertNotEqual(self.version.get(), first_version)
+
+    def test_expire(self):
+        self.version.get()
+        self.replace_file()
+
+        self.version.expire()
+        self.assertIsNotNone(self.version.get())
+
+
+if __name__ == '__main__':
+    unittest.main()
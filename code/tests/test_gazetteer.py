@@ -0,0 +1,113 @@
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+import shapely
+
+from code import gazetteer
+from code import geocode_cache
+from code import geocoders
+from code import sf_data
+
+
+class TestBlockAddresses(unittest.TestCase):
+    """Test that dispatcher addresses and call addresses are normalized to
+    the same block addresses."""
+
+    def test_normalize_block_address(self):
+        self.assertEqual(
+            gazetteer.normalize_block_address('683 Sutter Street'),
+            '600 SUTTER ST',
+        )
+        self.assertEqual(
+            gazetteer.normalize_block_address('600 Block of SUTTER ST'),
+            '600 SUTTER ST',
+        )
+        self.assertEqual(
+            gazetteer.normalize_block_address('15 Embarcadero'),
+            '0 EMBARCADERO',
+        )
+        self.assertEqual(
+            gazetteer.normalize_block_address('1500 Block of 19TH AV'),
+            gazetteer.normalize_block_address('1531 19th Avenue'),
+        )
+
+        # intersections and missing addresses can't be normalized
+        self.assertIsNone(
+            gazetteer.normalize_block_address('MARKET ST/5TH ST')
+        )
+        self.assertIsNone(gazetteer.normalize_block_address(None))
+
+
+class TestGazetteer(unittest.TestCase):
+    """Test that the gazetteer built from the historical calls resolves the
+    addresses of new incidents."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_dir = self.tmp_dir + '/'
+
+        pd.DataFrame({
+            'Address': ['600 Block of SUTTER ST',
+                        '600 Block of SUTTER ST',
+                        '600 Block of SUTTER ST',
+                        '0 Block of EMBARCADERO',
+                        'MARKET ST/5TH ST'],
+            'Coords': shapely.points([-122.411, -122.412, -122.419,
+                                      -122.393, -122.408],
+                                     [37.788, 37.789, 37.780,
+                                      37.795, 37.783]),
+        }).to_pickle(self.data_dir + 'Med_Calls_with_Tracts.pkl')
+
+        self.patches = [
+            mock.patch.object(gazetteer, 'DATA_DIR', self.data_dir),
+            mock.patch.object(sf_data, 'get_secret_key',
+                              lambda key_name: self.data_dir),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_build_and_lookup(self):
+        # nothing is found before the gazetteer is built...
+        self.assertIsNone(gazetteer.lookup_address('683 Sutter Street'))
+
+        # ...and the gazetteer is picked up once it's built
+        gazetteer.build_gazetteer()
+
+        lng, lat = gazetteer.lookup_address('683 Sutter Street')
+        self.assertAlmostEqual(lng, -122.412)
+        self.assertAlmostEqual(lat, 37.788)
+
+        self.assertIsNotNone(gazetteer.lookup_address('15 Embarcadero'))
+        self.assertIsNone(gazetteer.lookup_address('100 Mission St'))
+        self.assertEqual(len(gazetteer.load_gazetteer()), 2)
+
+    def test_gazetteer_before_cache(self):
+        gazetteer.build_gazetteer()
+        address = '683 Sutter Street, San Francisco CA'
+
+        # Nominatim couldn't geocode the address before the gazetteer was
+        # built, and the cache remembers it
+        cache = geocode_cache.GeocodeCache(self.data_dir + 'cache.sqlite')
+        cache.set(address, None)
+
+        with mock.patch.object(geocoders, 'get_geocode_cache',
+                               lambda: cache):
+            geocoders.set_geocoder_chain(None)
+            try:
+                location = geocoders.get_geocoder_chain().geocode(address)
+            finally:
+                geocoders.set_geocoder_chain(None)
+
+        self.assertAlmostEqual(location.longitude, -122.412)
+
+
+if __name__ == '__main__':
+    unittest.main()
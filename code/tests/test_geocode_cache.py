@@ -0,0 +1,141 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from geopy.location import Location
+from geopy.point import Point
+
+from code import geocode_cache
+
+
+class TestGeocodeCache(unittest.TestCase):
+    """Test that geocoded addresses are cached, expired, and evicted."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.now = 0.
+        self.cache = geocode_cache.GeocodeCache(
+            os.path.join(self.tmp_dir, 'geocode_cache.sqlite'),
+            ttl=100.,
+            negative_ttl=10.,
+            max_entries=2,
+            clock=lambda: self.now,
+        )
+        self.location = Location(
+            '683 Sutter Street, San Francisco',
+            Point(37.7887, -122.4116),
+            {},
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_normalize_address(self):
+        self.assertEqual(
+            geocode_cache.normalize_address('683 Sutter St.,  San Francisco'),
+            geocode_cache.normalize_address('683 sutter st san francisco'),
+        )
+
+    def test_get_set(self):
+        self.assertEqual(self.cache.get('683 Sutter St'), (False, None))
+
+        self.cache.set('683 Sutter St', self.location)
+        found, location = self.cache.get('683 SUTTER ST.')
+        self.assertTrue(found)
+        self.assertEqual(location.latitude, self.location.latitude)
+        self.assertEqual(location.longitude, self.location.longitude)
+
+        # addresses that can't be geocoded are cached too
+        self.cache.set('blab blob', None)
+        self.assertEqual(self.cache.get('blab blob'), (True, None))
+
+    def test_ttl(self):
+        self.cache.set('683 Sutter St', self.location)
+        self.cache.set('blab blob', None)
+
+        self.now = 50.
+        self.assertTrue(self.cache.get('683 Sutter St')[0])
+        self.assertFalse(self.cache.get('blab blob')[0])
+
+        self.now = 150.
+        self.assertFalse(self.cache.get('683 Sutter St')[0])
+
+    def test_lru_eviction(self):
+        self.cache.set('683 Sutter St', self.location)
+        self.now = 1.
+        self.cache.set('15 Embarcadero', self.location)
+        self.now = 2.
+        self.cache.get('683 Sutter St')
+        self.now = 3.
+        self.cache.set('1 Market St', self.location)
+
+        # '15 Embarcadero' is the least recently used address
+        self.assertFalse(self.cache.get('15 Embarcadero')[0])
+        self.assertTrue(self.cache.get('683 Sutter St')[0])
+        self.assertTrue(self.cache.get('1 Market St')[0])
+
+    def test_memory(self):
+        self.cache.set('683 Sutter St', self.location)
+        self.cache.set('blab blob', None)
+
+        # the hits are answered from memory, even if the database changes
+        # behind the back of the cache...
+        conn = sqlite3.connect(os.path.join(self.tmp_dir,
+                                            'geocode_cache.sqlite'))
+        with conn:
+            conn.execute("DELETE FROM geocodes")
+        self.assertTrue(self.cache.get('683 Sutter St')[0])
+        self.assertEqual(self.cache.get('blab blob'), (True, None))
+
+        # ...until they expire
+        self.now = 20.
+        self.assertEqual(self.cache.get('blab blob'), (False, None))
+        conn.close()
+
+    def test_batched_last_used(self):
+        cache = geocode_cache.GeocodeCache(
+            os.path.join(self.tmp_dir, 'geocode_cache.sqlite'),
+            flush_every=2,
+            clock=lambda: self.now,
+        )
+        cache.set('683 Sutter St', self.location)
+        conn = sqlite3.connect(os.path.join(self.tmp_dir,
+                                            'geocode_cache.sqlite'))
+
+        def last_used():
+            return conn.execute(
+                "SELECT last_used FROM geocodes"
+            ).fetchone()[0]
+
+        self.now = 1.
+        cache.get('683 Sutter St')
+        self.assertEqual(last_used(), 0.)
+
+        self.now = 2.
+        cache.get('683 Sutter St')
+        self.assertEqual(last_used(), 2.)
+        conn.close()
+
+    def test_replace_does_not_evict(self):
+        self.cache.set('683 Sutter St', self.location)
+        self.cache.set('15 Embarcadero', self.location)
+        for _ in range(3):
+            self.cache.set('683 Sutter St', self.location)
+
+        self.assertTrue(self.cache.get('15 Embarcadero')[0])
+        self.assertEqual(self.cache._n_entries, 2)
+
+    def test_persistence(self):
+        self.cache.set('683 Sutter St', self.location)
+
+        cache = geocode_cache.GeocodeCache(
+            os.path.join(self.tmp_dir, 'geocode_cache.sqlite'),
+            clock=lambda: self.now,
+        )
+        self.assertTrue(cache.get('683 Sutter St')[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import unittest
+
+from geopy.exc import GeocoderUnavailable
+
+from code import geocoders
+
+
+class FailingBackend(geocoders.GeocoderBackend):
+    """Backend that always fails, counting the number of times it's called."""
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self.n_calls = 0
+
+    def geocode(self, address, timeout):
+        self.n_calls += 1
+        raise GeocoderUnavailable("Service unavailable")
+
+
+class RecordingBackend(geocoders.GeocoderBackend):
+    """Backend that knows no address, but records what it's asked to store."""
+
+    def __init__(self):
+        self.stored = {}
+
+    def geocode(self, address, timeout):
+        return None
+
+    def store(self, address, location):
+        self.stored[address] = location
+
+
+class TestGeocoderChain(unittest.TestCase):
+    """Test the geocoder backend chain, with its timeouts and breakers."""
+
+    def setUp(self):
+        self.now = 0.
+        self.clock = lambda: self.now
+        self.stub = geocoders.StubBackend({
+            '683 Sutter St, San Francisco CA': (-122.4116, 37.7887),
+        })
+
+    def test_chain(self):
+        recorder = RecordingBackend()
+        chain = geocoders.GeocoderChain([recorder, self.stub],
+                                        clock=self.clock)
+
+        location = chain.geocode('683 Sutter St, San Francisco CA')
+        self.assertEqual(location.longitude, -122.4116)
+        self.assertEqual(location.latitude, 37.7887)
+        self.assertIsNone(chain.geocode('blab blob'))
+
+        # the answers of the stub are stored in the earlier backends,
+        # including the addresses that couldn't be geocoded
+        self.assertEqual(
+            recorder.stored['683 Sutter St, San Francisco CA'], location
+        )
+        self.assertIs(recorder.stored['blab blob'], geocoders.NOT_FOUND)
+
+    def test_budget(self):
+        chain = geocoders.GeocoderChain([self.stub],
+                                        budget=5.,
+                                        clock=self.clock)
+
+        deadline = chain.get_deadline()
+        self.now = 10.
+        self.assertIsNone(
+            chain.geocode('683 Sutter St, San Francisco CA',
+                          deadline=deadline)
+        )
+
+    def test_circuit_breaker(self):
+        failing = FailingBackend(
+            geocoders.CircuitBreaker(max_failures=2,
+                                     reset_timeout=60.,
+                                     clock=self.clock)
+        )
+        chain = geocoders.GeocoderChain([failing, self.stub],
+                                        clock=self.clock)
+
+        for _ in range(5):
+            self.assertIsNotNone(
+                chain.geocode('683 Sutter St, San Francisco CA')
+            )
+
+        # the failing backend is skipped once its breaker opens...
+        self.assertEqual(failing.n_calls, 2)
+
+        # ...until the breaker lets a call through again
+        self.now = 61.
+        chain.geocode('683 Sutter St, San Francisco CA')
+        self.assertEqual(failing.n_calls, 3)
+
+    def test_half_open_breaker(self):
+        breaker = geocoders.CircuitBreaker(max_failures=1,
+                                           reset_timeout=60.,
+                                           clock=self.clock)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+
+        # only one trial call is let through once the timeout expires...
+        self.now = 61.
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        # ...and another one after the trial fails and the timeout expires
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        self.now = 122.
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    def test_unexpected_error_ends_trial(self):
+        breaker = geocoders.CircuitBreaker(max_failures=1,
+                                           reset_timeout=60.,
+                                           clock=self.clock)
+        broken = geocoders.StubBackend({})
+        broken.breaker = breaker
+        broken.geocode = lambda address, timeout: int('not a coordinate')
+        chain = geocoders.GeocoderChain([broken], clock=self.clock)
+
+        breaker.record_failure()
+        self.now = 61.
+        with self.assertRaises(ValueError):
+            chain.geocode('683 Sutter St, San Francisco CA')
+
+        # the failed trial reopened the breaker, and another trial is let
+        # through once the timeout expires again
+        self.assertFalse(breaker.allow())
+        self.now = 122.
+        self.assertTrue(breaker.allow())
+
+    def test_local_answers_not_stored(self):
+        recorder = RecordingBackend()
+        local = geocoders.StubBackend({
+            '683 Sutter St, San Francisco CA': (-122.4116, 37.7887),
+        })
+        local.cacheable = False
+        chain = geocoders.GeocoderChain([recorder, local], clock=self.clock)
+
+        self.assertIsNotNone(chain.geocode('683 Sutter St, San Francisco CA'))
+        self.assertEqual(recorder.stored, {})
+
+    def test_token_bucket(self):
+        def sleep(seconds):
+            self.now += seconds
+
+        bucket = geocoders.TokenBucket(rate=1., capacity=2,
+                                       clock=self.clock, sleep=sleep)
+
+        # the burst is let through at once...
+        self.assertTrue(bucket.acquire())
+        self.assertTrue(bucket.acquire())
+        self.assertEqual(self.now, 0.)
+
+        # ...and then the calls are spaced out
+        self.assertTrue(bucket.acquire())
+        self.assertEqual(self.now, 1.)
+
+        # no token in time
+        self.assertFalse(bucket.acquire(timeout=0.5))
+
+    def test_rate_limited_chain(self):
+        def sleep(seconds):
+            self.now += seconds
+
+        self.stub.rate_limiter = geocoders.TokenBucket(rate=1., capacity=1,
+                                                       clock=self.clock,
+                                                       sleep=sleep)
+        chain = geocoders.GeocoderChain([self.stub], clock=self.clock)
+
+        # one call per second
+        self.assertIsNotNone(chain.geocode('683 Sutter St, San Francisco CA'))
+        self.assertIsNotNone(chain.geocode('683 Sutter St, San Francisco CA'))
+        self.assertEqual(self.now, 1.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
 import unittest
+from unittest import mock
 
 from code import location_tools
 from code import exceptions
+from code import geocoders
 
 
 class TestLocationTools(unittest.TestCase):
@@ -13,7 +15,10 @@ class TestLocationTools(unittest.TestCase):
         (2) 15 Embarcadero, San Francisco, CA
         (3) 683 Sutter St, with city=San Francisco and state=CA
         (4) blah blah blah, San Francisco, CA
-        (5) blab blob"""
+        (5) blab blob
+
+    The addresses are geocoded with an offline stub backend, so the test
+    doesn't need network access."""
 
     def setUp(self):
         existing_street_address1 = "683 Sutter St"
@@ -51,6 +56,28 @@ class TestLocationTools(unittest.TestCase):
             ]
         )
 
+        geocoders.set_geocoder_chain(
+            geocoders.GeocoderChain([
+                geocoders.StubBackend({
+                    self.existing_address1: (-122.4116, 37.7887),
+                    self.existing_address2: (-122.3936, 37.7953),
+                    location_tools.add_city_state(
+                        self.existing_street_address1,
+                        self.city,
+                        self.state,
+                    ): (-122.4116, 37.7887),
+                    location_tools.add_city_state(
+                        self.existing_address1,
+                        self.city,
+                        self.state,
+                    ): (-122.4116, 37.7887),
+                }),
+            ])
+        )
+
+    def tearDown(self):
+        geocoders.set_geocoder_chain(None)
+
     def test_get_coords_from_address(self):
 
         # test "683 Sutter St, San Francisco, CA"
@@ -112,5 +139,65 @@ class TestLocationTools(unittest.TestCase):
             )
 
 
+class TestDispatchLocation(unittest.TestCase):
+    """Test that the location of the dispatcher is only resolved once, and
+    that it can be overridden for a session."""
+
+    def setUp(self):
+        location_tools.reset_dispatch_location()
+        self.keys = {}
+        self.now = 0.
+
+    def tearDown(self):
+        location_tools.reset_dispatch_location()
+
+    def get_secret_key(self, key_name):
+        return self.keys[key_name]
+
+    def get_dispatch_location(self):
+        with mock.patch.object(location_tools, 'get_secret_key',
+                               self.get_secret_key), \
+             mock.patch.object(location_tools, 'find_me',
+                               self.find_me):
+            return location_tools.get_dispatch_location(
+                clock=lambda: self.now
+            )
+
+    def find_me(self):
+        self.n_detections += 1
+        return {'city': 'Alameda', 'state': 'California'}
+
+    def test_dispatch_location(self):
+        self.n_detections = 0
+
+        # default location if not set in the keys file
+        self.assertEqual(self.get_dispatch_location(),
+                         {'city': 'San Francisco', 'state': 'California'})
+
+        # location set in the keys file
+        location_tools.reset_dispatch_location()
+        self.keys = {'DISPATCH_CITY': 'Oakland', 'DISPATCH_STATE': 'California'}
+        self.assertEqual(self.get_dispatch_location()['city'], 'Oakland')
+
+        # detected location, cached until it expires
+        location_tools.reset_dispatch_location()
+        self.keys = {'DISPATCH_CITY': 'detect'}
+        for _ in range(3):
+            self.assertEqual(self.get_dispatch_location()['city'], 'Alameda')
+        self.assertEqual(self.n_detections, 1)
+
+        self.now = location_tools.DISPATCH_LOCATION_TTL
+        self.get_dispatch_location()
+        self.assertEqual(self.n_detections, 2)
+
+    def test_session_override(self):
+        address = location_tools.get_new_incident_address(
+            "683 Sutter St",
+            dispatch_location={'city': 'Oakland', 'state': 'California'},
+        )
+        self.assertEqual(address['address'],
+                         "683 Sutter St, Oakland California")
+
+
 if __name__ == '__main__':
     unittest.main()
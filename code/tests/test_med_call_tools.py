@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from code import call_store
+from code import med_call_tools
+
+
+class TestLocationParsing(unittest.TestCase):
+    """Test that `parse_location_coords` extracts the coordinates of the
+    incidents from the 'Location' strings in the call dataset."""
+
+    def setUp(self):
+        self.locations = [
+            '(37.7868, -122.4116)',
+            '(37.7597,-122.4148)',
+            None,
+            np.nan,
+            '',
+            'not a location',
+        ]
+
+    def test_parse_location_coords(self):
+        lons, lats = med_call_tools.parse_location_coords(self.locations)
+
+        self.assertEqual(lons.dtype, np.float64)
+        self.assertEqual(lats.dtype, np.float64)
+
+        np.testing.assert_array_equal(lons[:2], [-122.4116, -122.4148])
+        np.testing.assert_array_equal(lats[:2], [37.7868, 37.7597])
+
+        # missing or malformed locations are NaN
+        self.assertTrue(np.isnan(lons[2:]).all())
+        self.assertTrue(np.isnan(lats[2:]).all())
+
+
+class TestIngestNewCalls(unittest.TestCase):
+    """Test that only the new or changed calls are ingested, and that they
+    are upserted into the Parquet store of medical calls."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store_dirname = os.path.join(self.tmp_dir,
+                                          'Med_Calls_with_Tracts.parquet')
+
+        self.calls = pd.DataFrame({
+            'Call Type': ['Medical Incident', 'Medical Incident', 'Alarms'],
+            'Call Date': ['12/31/2017', '01/02/2018', '01/02/2018'],
+            'Received DtTm': ['12/31/2017 11:02:03 PM',
+                              '01/02/2018 01:02:03 PM',
+                              '01/02/2018 01:05:03 PM'],
+            'Unit Type': ['MEDIC', 'MEDIC', 'ENGINE'],
+            'Original Priority': ['3', '2', '3'],
+            'RowID': ['1-M1', '2-M1', '3-E1'],
+            'Location': ['(37.780, -122.410)', None, '(37.790, -122.400)'],
+            'Address': ['0 MARKET ST', '100 MISSION ST', '200 MAIN ST'],
+        })
+
+        self.patches = [
+            mock.patch.object(med_call_tools, 'DATA_DIR',
+                              self.tmp_dir + '/'),
+            mock.patch.object(med_call_tools.MedicalIncidents,
+                              'assign_tracts_to_calls',
+                              self.assign_tracts_to_calls),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def assign_tracts_to_calls(incidents, tracts_filename, n_workers):
+        # the tracts themselves are tested in `test_tract_tools`
+        incidents._convert_coords_to_shapely_point()
+        incidents.df['Tract'] = 6075011700
+
+    def ingest(self):
+        self.calls.to_csv(os.path.join(self.tmp_dir, 'calls.csv'),
+                          index=False)
+        n_calls = med_call_tools.ingest_new_calls('calls.csv', chunksize=2)
+
+        # nothing is left over from rewriting the store
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['Med_Calls_Watermark.pkl',
+                          'Med_Calls_with_Tracts.parquet',
+                          'calls.csv'])
+
+        return n_calls
+
+    def read_store(self):
+        return call_store.read_medical_calls(
+            self.store_dirname,
+        ).sort_values('RowID').reset_index(drop=True)
+
+    def test_ingest_new_calls(self):
+        # initial ingest
+        self.assertEqual(self.ingest(), 2)
+        stored = self.read_store()
+        self.assertEqual(stored['RowID'].tolist(), ['1-M1', '2-M1'])
+        self.assertTrue(stored['Coords'].iloc[1].is_empty)
+        self.assertEqual(sorted(os.listdir(self.store_dirname)),
+                         ['Received Year=2017', 'Received Year=2018'])
+
+        # nothing has changed, so nothing is ingested or rewritten
+        partition_2017 = os.path.join(self.store_dirname,
+                                      'Received Year=2017')
+        partition_files = sorted(os.listdir(partition_2017))
+        self.assertEqual(self.ingest(), 0)
+        pd.testing.assert_frame_equal(self.read_store(), stored)
+        self.assertEqual(sorted(os.listdir(partition_2017)), partition_files)
+
+        # a call is updated, and a new one comes in the next year: only the
+        # partitions of those years are rewritten
+        self.calls.loc[1, 'Location'] = '(37.791, -122.399)'
+        self.calls.loc[3] = ['Medical Incident', '01/01/2019',
+                             '01/01/2019 12:01:03 AM', 'PRIVATE', 'E',
+                             '4-P1', '(37.760, -122.420)', '1 VALENCIA ST']
+        self.assertEqual(self.ingest(), 2)
+
+        upserted = self.read_store()
+        self.assertEqual(upserted['RowID'].tolist(),
+                         ['1-M1', '2-M1', '4-P1'])
+        self.assertEqual(upserted['Location'].iloc[1], '(37.791, -122.399)')
+        self.assertEqual(upserted['Coords'].iloc[1].x, -122.399)
+        self.assertEqual(upserted['Unit Type'].iloc[2], 'PRIVATE')
+        pd.testing.assert_frame_equal(upserted.iloc[:1], stored.iloc[:1],
+                                      check_categorical=False)
+        self.assertEqual(sorted(os.listdir(partition_2017)), partition_files)
+        self.assertEqual(len(upserted.columns), len(stored.columns))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+
+from code import model_registry
+from code import utils
+
+
+class TestModelRegistry(unittest.TestCase):
+    """Test that models are loaded once, and reloaded when they change."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'rf_model.joblib')
+        self.registry = model_registry.ModelRegistry()
+
+        rng = np.random.RandomState(0)
+        self.X = rng.uniform(size=(50, 3))
+        self.y = self.X.sum(axis=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def fit_model(self, n_estimators):
+        model = RandomForestRegressor(n_estimators=n_estimators,
+                                      random_state=0)
+        return model.fit(self.X, self.y)
+
+    def test_registry(self):
+        fitted_model = self.fit_model(2)
+        model_registry.save_model(fitted_model, self.filename)
+
+        model = self.registry.get(self.filename)
+        self.assertEqual(len(model.estimators_), 2)
+        self.assertIs(self.registry.get(self.filename), model)
+
+        # the same model saved again is not reloaded
+        model_registry.save_model(fitted_model, self.filename)
+        self.assertIs(self.registry.get(self.filename), model)
+
+        # a new model is hot-swapped in
+        model_registry.save_model(self.fit_model(3), self.filename)
+        self.assertEqual(len(self.registry.get(self.filename).estimators_), 3)
+
+    def test_predict_eta(self):
+        model = self.fit_model(2)
+        model_registry.save_model(model, self.filename)
+
+        eta = utils.predict_eta(self.X[:1], filename=self.filename)
+        self.assertEqual(eta, model.predict(self.X[:1])[0])
+
+        # a model passed directly takes precedence over the filename
+        other_model = self.fit_model(3)
+        eta = utils.predict_eta(self.X[:1],
+                                filename=self.filename,
+                                model=other_model)
+        self.assertEqual(eta, other_model.predict(self.X[:1])[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
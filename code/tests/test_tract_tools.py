@@ -0,0 +1,296 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.geometry import box
+
+from code import tract_tools
+from code import file_version
+
+
+class TestTractLocator(unittest.TestCase):
+    """Test that `TractLocator` finds the tracts that points are in.
+
+    The test tracts are two adjacent unit squares, and a third square that
+    overlaps both of them."""
+
+    def setUp(self):
+        self.locator = tract_tools.TractLocator(
+            [box(0, 0, 1, 1), box(1, 0, 2, 1), box(0.5, 0.5, 1.5, 1.5)],
+            ['6075000100', '6075000200', '6075000300'],
+        )
+
+    def test_locate(self):
+        self.assertEqual(self.locator.locate(0.25, 0.25), '6075000100')
+        self.assertEqual(self.locator.locate(1.75, 0.25), '6075000200')
+        self.assertEqual(self.locator.locate(1.25, 1.25), '6075000300')
+
+        # points in more than one tract are assigned to the first one
+        self.assertEqual(self.locator.locate(0.75, 0.75), '6075000100')
+
+        # points outside of all tracts
+        self.assertIsNone(self.locator.locate(-122.42, 37.77))
+        self.assertIsNone(self.locator.locate(0.25, 1.25))
+
+    def test_locate_many(self):
+        lngs = [0.25, 1.75, np.nan, 3.]
+        lats = [0.25, 0.25, np.nan, 3.]
+
+        serial_tracts = self.locator.locate_many(lngs, lats)
+        self.assertEqual(list(serial_tracts[:2]), ['6075000100', '6075000200'])
+        self.assertTrue(np.isnan(serial_tracts[2]))
+        self.assertTrue(np.isnan(serial_tracts[3]))
+
+        parallel_tracts = self.locator.locate_many(lngs, lats, n_workers=2)
+        np.testing.assert_array_equal(serial_tracts.astype(str),
+                                      parallel_tracts.astype(str))
+
+
+class TestWKTParsing(unittest.TestCase):
+    """Test that `parse_wkt_column` converts WKT boundaries to geometries."""
+
+    def test_parse_wkt_column(self):
+        geoms = tract_tools.parse_wkt_column([
+            'MULTIPOLYGON (((0 0, 1 0, 1 1, 0 0)), ((2 2, 3 2, 3 3, 2 2)))',
+            'MULTIPOLYGON (((0 0, 4 0, 4 4, 0 4, 0 0), '
+            '(1 1, 2 1, 2 2, 1 2, 1 1)))',
+            np.nan,
+        ])
+
+        # both parts of the multipolygon are kept
+        self.assertEqual(len(geoms[0].geoms), 2)
+
+        # and so are the holes
+        self.assertEqual(geoms[1].area, 15.)
+
+        self.assertIsNone(geoms[2])
+
+
+class TestTractArtifact(unittest.TestCase):
+    """Test that a rebuilt tract artifact is picked up by a running process."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.artifact_fp = os.path.join(self.tmp_dir,
+                                        'Census_2010_Tracts_geom.parquet')
+        self.patch = mock.patch.object(tract_tools, 'DATA_DIR',
+                                       self.tmp_dir + '/')
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def write_artifact(self, geoid):
+        """Write an artifact with one tract, as another process would."""
+        polygon = shapely.to_wkb(box(-122.5, 37.7, -122.3, 37.9))
+        pd.DataFrame({
+            'GEOID10': [geoid],
+            'ALAND10': [1],
+            'AWATER10': [0],
+            'Polygon': [polygon],
+            'Land Polygon': [polygon],
+        }).to_parquet(self.artifact_fp + '.new', index=False)
+        os.replace(self.artifact_fp + '.new', self.artifact_fp)
+
+    def test_rebuilt_artifact(self):
+        self.write_artifact('6075011700')
+        locator = tract_tools.get_tract_locator()
+        self.assertEqual(locator.locate(-122.4, 37.8), '6075011700')
+        self.assertIs(tract_tools.get_tract_locator(), locator)
+
+        self.write_artifact('6075061500')
+        file_version.expire_file_version(self.artifact_fp)
+
+        self.assertEqual(tract_tools.get_tract_locator().locate(-122.4, 37.8),
+                         '6075061500')
+        self.assertEqual(tract_tools.load_tract_artifact()['GEOID10'][0],
+                         '6075061500')
+
+
+def write_county_shapefile(shp_fp, counties, geoms):
+    """Write a shape file with the boundaries of the given counties."""
+    gpd.GeoDataFrame(
+        {'COUNTY': counties},
+        geometry=geoms,
+        crs='EPSG:4326',
+    ).to_file(shp_fp, engine='pyogrio')
+
+
+class TestTractBoundaries(unittest.TestCase):
+    """Test that the tracts are intersected with the whole county shape.
+
+    The county is a mainland square and an island. The tracts cross the
+    border of the mainland, cover both the mainland and the island, cover
+    only the island, have no land area, and only touch the border."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.patches = [
+            mock.patch.object(tract_tools, 'DATA_DIR', self.tmp_dir + '/'),
+            mock.patch.dict(tract_tools._COUNTY_BOUNDARIES, clear=True),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+        shp_dir = os.path.join(self.tmp_dir,
+                               os.path.dirname(tract_tools.COUNTY_SHP_FP))
+        os.makedirs(shp_dir)
+        write_county_shapefile(
+            os.path.join(self.tmp_dir, tract_tools.COUNTY_SHP_FP),
+            ['San Francisco', 'San Francisco', 'Marin'],
+            [box(0, 0, 10, 10), box(20, 0, 21, 1), box(0, 20, 10, 30)],
+        )
+
+        tract_geoms = [
+            box(-1, -1, 5, 5),
+            box(8, 0, 22, 0.5),
+            box(19, -1, 22, 2),
+            box(2, 2, 3, 3),
+            box(10, 0, 12, 10),
+        ]
+        pd.DataFrame({
+            'GEOID10': [6075000100 + 100 * i
+                        for i in range(len(tract_geoms))],
+            'the_geom': [shapely.to_wkt(shapely.multipolygons([geom]))
+                         for geom in tract_geoms],
+            'ALAND10': [1, 1, 1, 0, 1],
+            'AWATER10': [0, 0, 0, 1, 0],
+            'NAMELSAD10': [f'Census Tract {i + 1}'
+                           for i in range(len(tract_geoms))],
+        }).to_csv(os.path.join(self.tmp_dir, 'Census_2010_Tracts.csv'),
+                  index=False)
+
+        self.tracts = tract_tools.get_updated_tract_data(
+            'Census_2010_Tracts.csv'
+        )
+
+    def tearDown(self):
+        for patch in reversed(self.patches):
+            patch.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def loop_land_polygons(self):
+        """Return the land polygons of the tracts, one tract at a time."""
+        boundary = shapely.union_all([box(0, 0, 10, 10), box(20, 0, 21, 1)])
+        land_polygons = []
+        for i in self.tracts.df.index:
+            if not self.tracts.df.at[i, 'ALAND10']:
+                land_polygons.append([])
+                continue
+            land = self.tracts.df.at[i, 'Polygon'].intersection(boundary)
+            land_polygons.append([
+                polygon for polygon in getattr(land, 'geoms', [land])
+                if polygon.geom_type == 'Polygon' and not polygon.is_empty
+            ])
+
+        return land_polygons
+
+    def test_get_boundaries(self):
+        land = self.tracts.df['Land Polygon'].values
+        for i, polygons in enumerate(self.loop_land_polygons()):
+            if not polygons:
+                self.assertIsNone(land[i])
+                continue
+            self.assertEqual(land[i].geom_type, 'MultiPolygon')
+            self.assertTrue(land[i].equals(shapely.union_all(polygons)))
+            self.assertEqual(len(land[i].geoms), len(polygons))
+
+        # the tract on the mainland and the island keeps both parts
+        self.assertEqual(len(land[1].geoms), 2)
+        self.assertEqual(land[1].area, 1.5)
+
+        # and the tract on the island keeps all of it
+        self.assertTrue(land[2].equals(box(20, 0, 21, 1)))
+
+        # the individual polygons are kept with their tracts
+        self.assertEqual(len(self.tracts.land_polygons), 4)
+        self.assertEqual(
+            list(self.tracts.tract_names),
+            ['6075000100', '6075000200', '6075000200', '6075000300'],
+        )
+
+    def test_build_multipolygons(self):
+        wkb = tract_tools.build_multipolygons(self.tracts)
+
+        geoms = shapely.from_wkb(wkb)
+        self.assertEqual(len(geoms), len(self.tracts.df))
+        for geom, land in zip(geoms, self.tracts.df['Land Polygon']):
+            if land is None:
+                self.assertIsNone(geom)
+            else:
+                self.assertEqual(shapely.get_type_id(geom),
+                                 shapely.GeometryType.MULTIPOLYGON)
+                self.assertTrue(geom.equals_exact(land, tolerance=0))
+
+
+class TestCountyBoundaries(unittest.TestCase):
+    """Test that the county boundaries are cached until the shape file
+    changes."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        mock.patch.object(tract_tools, 'DATA_DIR', self.tmp_dir + '/').start()
+        mock.patch.dict(tract_tools._COUNTY_BOUNDARIES, clear=True).start()
+
+        self.shp_fp = os.path.join(self.tmp_dir, 'counties', 'counties.shp')
+        os.makedirs(os.path.dirname(self.shp_fp))
+        write_county_shapefile(self.shp_fp, ['Marin', 'Napa'],
+                               [box(0, 0, 1, 1), box(2, 2, 3, 3)])
+
+        self.read_file = mock.patch.object(tract_tools.gpd, 'read_file',
+                                           wraps=gpd.read_file).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        shutil.rmtree(self.tmp_dir)
+
+    def load(self, county):
+        return tract_tools.load_county_boundaries(
+            [county],
+            shp_fp='counties/counties.shp',
+        )[county]
+
+    def test_cache_hit(self):
+        self.assertTrue(self.load('Marin').equals(box(0, 0, 1, 1)))
+        self.assertEqual(self.read_file.call_count, 1)
+
+        # the boundary is kept in memory...
+        self.assertTrue(self.load('Marin').equals(box(0, 0, 1, 1)))
+
+        # ...and on disk, with no temporary file left behind
+        tract_tools._COUNTY_BOUNDARIES.clear()
+        self.assertTrue(self.load('Marin').equals(box(0, 0, 1, 1)))
+        self.assertEqual(self.read_file.call_count, 1)
+
+        cache_dir = os.path.join(self.tmp_dir, tract_tools.COUNTY_CACHE_DIR)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertTrue(os.listdir(cache_dir)[0].endswith('.wkb'))
+
+        # an unknown county is not cached
+        with self.assertRaises(ValueError):
+            self.load('Sonoma')
+
+    def test_cache_miss(self):
+        self.assertTrue(self.load('Marin').equals(box(0, 0, 1, 1)))
+
+        # only the `.dbf` file changes: the counties swap boundaries
+        other_fp = os.path.join(self.tmp_dir, 'other', 'counties.shp')
+        os.makedirs(os.path.dirname(other_fp))
+        write_county_shapefile(other_fp, ['Napa', 'Marin'],
+                               [box(0, 0, 1, 1), box(2, 2, 3, 3)])
+        shutil.copy(os.path.splitext(other_fp)[0] + '.dbf',
+                    os.path.splitext(self.shp_fp)[0] + '.dbf')
+
+        self.assertTrue(self.load('Marin').equals(box(2, 2, 3, 3)))
+        self.assertEqual(self.read_file.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,40 @@
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Polygon
+import shapely
+from shapely.strtree import STRtree
 from geoalchemy2.shape import to_shape
 
 from code.key_utils import get_secret_key
+from code.file_version import get_file_version, expire_file_version
+from code.mappings import COUNTIES
 
 
 DATA_DIR = get_secret_key('DATA_DIR')
 
+# `shp` file with the boundaries of the Bay Area counties, and the directory
+# in which the boundaries of the individual counties are cached
+COUNTY_SHP_FP = "Bay_Area_County_Boundaries/ark28722-s7hs4j-shapefile/s7hs4j.shp"
+COUNTY_CACHE_DIR = "County_Boundaries_Cache/"
+
+# files that make up a shape file
+SHAPEFILE_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj']
+
+# county boundaries kept in memory by `load_county_boundaries`, keyed by
+# (county name, shape file checksum)
+_COUNTY_BOUNDARIES = {}
+
+# tract geometry artifacts, and the tract locators built from them, loaded by
+# the whole process, by artifact file path, with the version of the file when
+# they were loaded
+_TRACT_ARTIFACTS = {}
+_TRACT_LOCATORS = {}
+
 
 def get_updated_tract_data(tracts_filename):
     """Make Tracts() object, with the boundaries as `shapely` polygons."""
@@ -18,6 +45,246 @@ def get_updated_tract_data(tracts_filename):
     return tracts
 
 
+def get_point_coords(points):
+    """Return the (lon, lat) coordinates of an array of `shapely` POINTs.
+
+    The coordinates are returned as two `float64` arrays. Missing and empty
+    POINTs (e.g., the POINTs of calls with no location, once they have been
+    serialized) get NaN coordinates."""
+    points = np.asarray(points, dtype=object)
+    lngs = np.full(len(points), np.nan)
+    lats = np.full(len(points), np.nan)
+
+    is_valid = ~shapely.is_missing(points)
+    is_valid[is_valid] = ~shapely.is_empty(points[is_valid])
+    lngs[is_valid] = shapely.get_x(points[is_valid])
+    lats[is_valid] = shapely.get_y(points[is_valid])
+
+    return lngs, lats
+
+
+def parse_wkt_column(wkt_strings):
+    """Convert a column of WKT boundary definitions to `shapely` geometries.
+
+    All the strings are parsed in a single call, and multi-part geometries
+    (e.g., MULTIPOLYGONs with several polygons, or polygons with holes) are
+    kept whole. Missing values are converted to None."""
+    wkt_strings = pd.Series(wkt_strings, dtype=object)
+    wkt_strings = wkt_strings.where(wkt_strings.notna(), None)
+
+    return shapely.from_wkt(wkt_strings.values)
+
+
+def get_tract_artifact_filename(tracts_filename):
+    """Return the filename of the prebuilt tract geometry artifact."""
+    return os.path.splitext(tracts_filename)[0] + '_geom.parquet'
+
+
+def build_tract_artifact(tracts_filename='Census_2010_Tracts.csv'):
+    """Build the tract geometry artifact.
+
+    The tract boundaries are intersected with the county shape (see
+    `Tracts.get_boundaries`), and the resulting tracts are saved to a Parquet
+    file, with the geometries stored as WKB. Loading the file is much faster
+    than rebuilding the tracts from the Census CSV and the county shape file.
+    """
+    tracts = get_updated_tract_data(tracts_filename)
+
+    artifact_df = tracts.df[['GEOID10', 'ALAND10', 'AWATER10']].copy()
+    for col in ['Polygon', 'Land Polygon']:
+        artifact_df[col] = shapely.to_wkb(tracts.df[col].values)
+
+    # the artifact is written to a temporary file first, so that a running
+    # app never reads a half-written artifact
+    artifact_fp = DATA_DIR + get_tract_artifact_filename(tracts_filename)
+    artifact_df.to_parquet(f"{artifact_fp}.tmp",
+                           engine='pyarrow',
+                           index=False)
+    os.replace(f"{artifact_fp}.tmp", artifact_fp)
+
+    # make sure the new artifact is picked up by this process at once
+    expire_file_version(artifact_fp)
+
+
+def _load_tract_artifact(tracts_filename):
+    """Load the tract geometry artifact, with the version of its file."""
+    artifact_fp = DATA_DIR + get_tract_artifact_filename(tracts_filename)
+
+    version = get_file_version(artifact_fp)
+    if version is None:
+        build_tract_artifact(tracts_filename)
+        version = get_file_version(artifact_fp)
+
+    entry = _TRACT_ARTIFACTS.get(artifact_fp)
+    if entry is None or entry[0] != version:
+        tracts_df = pd.read_parquet(artifact_fp, engine='pyarrow')
+        for col in ['Polygon', 'Land Polygon']:
+            tracts_df[col] = shapely.from_wkb(tracts_df[col].values)
+        _TRACT_ARTIFACTS[artifact_fp] = (version, tracts_df)
+
+    return _TRACT_ARTIFACTS[artifact_fp]
+
+
+def load_tract_artifact(tracts_filename='Census_2010_Tracts.csv'):
+    """Load the tract geometry artifact, building it if it doesn't exist.
+
+    The tracts are returned as a dataframe with the 'GEOID10', 'ALAND10',
+    'AWATER10', 'Polygon' (the Census tract boundary), and 'Land Polygon'
+    (the boundary intersected with the county shape) columns. The dataframe
+    is kept in memory, so the artifact is only read once per process, and
+    read again when it's rebuilt (e.g., by `seed.py` while the app is
+    running), which is checked at most once per second (see
+    `FileVersion`)."""
+    return _load_tract_artifact(tracts_filename)[1]
+
+
+# tract locator built in each worker process by `_init_tract_worker`
+_WORKER_TRACT_LOCATOR = {}
+
+
+def _init_tract_worker(polygons_wkb, tract_ids):
+    """Rebuild the tract locator once per worker process."""
+    _WORKER_TRACT_LOCATOR['locator'] = TractLocator(
+        shapely.from_wkb(polygons_wkb),
+        tract_ids,
+    )
+
+
+def _locate_indices_in_worker(xs, ys):
+    """Locate a shard of points with the tract locator of a worker."""
+    return _WORKER_TRACT_LOCATOR['locator'].locate_indices(xs, ys)
+
+
+class TractLocator:
+    """Find the tracts that (lon, lat) points are in.
+
+    The tract polygons are prepared and indexed in an R-tree (`STRtree`), so
+    each point is only tested against the few polygons whose bounding boxes
+    contain it. Points outside the bounding box of the tracts, or outside the
+    area they cover, are rejected before the tree is queried. If a point is
+    in more than one polygon, the first tract in `tract_ids` order is
+    returned."""
+
+    def __init__(self, polygons, tract_ids):
+        self.polygons = np.asarray(polygons, dtype=object)
+        self.tract_ids = np.asarray(tract_ids, dtype=object)
+
+        shapely.prepare(self.polygons)
+        self.tree = STRtree(self.polygons)
+        self.bounds = shapely.total_bounds(self.polygons)
+
+        # the area covered by all the tracts, used to reject points with a
+        # single test
+        self.boundary = shapely.union_all(self.polygons)
+        shapely.prepare(self.boundary)
+
+    @classmethod
+    def from_tracts_df(cls, tracts_df, geometry_col='Polygon'):
+        """Build a locator from a dataframe of tracts."""
+        return cls(tracts_df[geometry_col].values, tracts_df['GEOID10'].values)
+
+    def _reject_outside(self, xs, ys):
+        """Return the indices of the points that may be in a tract."""
+        # NaN coordinates fail all the comparisons, so points without a
+        # location are rejected as well
+        xmin, ymin, xmax, ymax = self.bounds
+        in_bbox = np.flatnonzero(
+            (xs >= xmin) & (xs <= xmax) & (ys >= ymin) & (ys <= ymax)
+        )
+        in_boundary = shapely.contains_xy(self.boundary,
+                                          xs[in_bbox],
+                                          ys[in_bbox])
+
+        return in_bbox[in_boundary]
+
+    def locate_indices(self, xs, ys):
+        """Return the position of the tract containing each point.
+
+        Points that are not in any tract get a position of -1."""
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+
+        matches = np.full(len(xs), -1, dtype=np.int64)
+        candidates = self._reject_outside(xs, ys)
+        if not len(candidates):
+            return matches
+
+        # match the points to the polygons whose bounding boxes contain them,
+        # then test the candidate pairs against the prepared polygons
+        pt_idx, poly_idx = self.tree.query(
+            shapely.points(xs[candidates], ys[candidates])
+        )
+        is_within = shapely.contains_xy(self.polygons[poly_idx],
+                                        xs[candidates[pt_idx]],
+                                        ys[candidates[pt_idx]])
+        pt_idx, poly_idx = pt_idx[is_within], poly_idx[is_within]
+
+        # sort the matches by point, then by polygon, and keep the first
+        # polygon for each point
+        order = np.lexsort((poly_idx, pt_idx))
+        pt_idx, poly_idx = pt_idx[order], poly_idx[order]
+        _, first = np.unique(pt_idx, return_index=True)
+        matches[candidates[pt_idx[first]]] = poly_idx[first]
+
+        return matches
+
+    def locate_many(self, lngs, lats, n_workers=1):
+        """Return the tract of each (lon, lat) pair, or NaN if none is found.
+
+        With `n_workers > 1`, the points are split into `n_workers` contiguous
+        shards that are located in a process pool. The tract polygons are sent
+        to each worker once, as WKB, and the shards are merged back in their
+        original order, so the result is identical to the one computed in a
+        single process."""
+        lngs = np.asarray(lngs, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+
+        if n_workers > 1 and len(lngs) > n_workers:
+            shards = np.array_split(np.arange(len(lngs)), n_workers)
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=_init_tract_worker,
+                initargs=(shapely.to_wkb(self.polygons), self.tract_ids),
+            ) as executor:
+                # `map` returns the results in the order of the shards
+                matches = np.concatenate(list(executor.map(
+                    _locate_indices_in_worker,
+                    [lngs[shard] for shard in shards],
+                    [lats[shard] for shard in shards],
+                )))
+        else:
+            matches = self.locate_indices(lngs, lats)
+
+        tracts = np.full(len(lngs), np.nan, dtype=object)
+        found = matches >= 0
+        tracts[found] = self.tract_ids[matches[found]]
+
+        return tracts
+
+    def locate(self, lng, lat):
+        """Return the tract of a (lon, lat) pair, or None if none is found."""
+        match = self.locate_indices([lng], [lat])[0]
+        if match >= 0:
+            return self.tract_ids[match]
+
+
+def get_tract_locator(tracts_filename='Census_2010_Tracts.csv'):
+    """Return the tract locator for the prebuilt tract geometry artifact.
+
+    The locator is built once per process and kept in memory, until the
+    artifact is rebuilt (see `load_tract_artifact`)."""
+    version, tracts_df = _load_tract_artifact(tracts_filename)
+
+    entry = _TRACT_LOCATORS.get(tracts_filename)
+    if entry is None or entry[0] != version:
+        _TRACT_LOCATORS[tracts_filename] = (
+            version,
+            TractLocator.from_tracts_df(tracts_df),
+        )
+
+    return _TRACT_LOCATORS[tracts_filename][1]
+
+
 def get_tract_geom(tract):
     """Extract the geometry of a specific tract from the database."""
     # hacky way to avoid circular imports--not pretty...
@@ -36,40 +303,131 @@ def get_tract_geom(tract):
     ).first()
 
     geom = to_shape(tract_geometry[0])
-    cntr_lng, cntr_lat = geom[0].centroid.xy
+    cntr_lng, cntr_lat = geom.geoms[0].centroid.xy
 
     return (geom, cntr_lng[0], cntr_lat[0])
 
 
-def build_multipolygon(tracts, geoid10):
-    """Construct definition for PostGIS MULTIPOLYGON.
+def build_multipolygons(tracts):
+    """Construct the WKB definitions of the tract MULTIPOLYGONs.
+
+    Given a Tracts object whose boundaries have been intersected with the
+    county shape (see `Tracts.get_boundaries`), return the WKB definition of
+    the land MULTIPOLYGON of each tract, in the order of the tract dataframe.
+    Tracts with no land area get None. The land polygons are grouped by tract
+    in `get_boundaries`, so all the tracts are converted in a single call;
+    the WKB can then be inserted into PostGIS without any parsing of text.
+    """
+    return shapely.to_wkb(tracts.df['Land Polygon'].values)
+
+
+def _shapefile_checksum(shp_fp):
+    """Return the MD5 checksum of the files that make up a shape file."""
+    md5 = hashlib.md5()
+    for ext in SHAPEFILE_EXTENSIONS:
+        fp = os.path.splitext(shp_fp)[0] + ext
+        if os.path.isfile(fp):
+            with open(fp, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    md5.update(block)
+
+    return md5.hexdigest()
+
+
+def _shapefile_version(shp_fp):
+    """Return the modification times and sizes of the files of a shape file.
+
+    All the files are included, since editing only the `.dbf` (e.g., a
+    county name) or the `.prj` changes the boundaries read from the shape
+    file. Missing sidecar files get None, but the `.shp` file must exist."""
+    version = []
+    for ext in SHAPEFILE_EXTENSIONS:
+        fp = os.path.splitext(shp_fp)[0] + ext
+        try:
+            stat = os.stat(fp)
+        except FileNotFoundError:
+            if ext == '.shp':
+                raise
+            version.append(None)
+        else:
+            version.append((stat.st_mtime_ns, stat.st_size))
+
+    return tuple(version)
+
+
+@lru_cache(maxsize=None)
+def _cached_shapefile_checksum(shp_fp, version):
+    """Return the checksum of a shape file, computed once per version."""
+    return _shapefile_checksum(shp_fp)
+
+
+def _county_cache_fp(county, checksum):
+    """Return the path of the cached boundary of a county."""
+    county_name = county.replace(' ', '_')
+    return DATA_DIR + COUNTY_CACHE_DIR + f"{county_name}_{checksum}.wkb"
+
+
+def load_county_boundaries(counties, shp_fp=COUNTY_SHP_FP):
+    """Load the boundaries of the given counties.
+
+    The boundaries are cached, in memory and on disk, by county name and by
+    the checksum of the shape file, so a new shape file is picked up as soon
+    as it replaces the old one. The shape file itself is only read if a
+    boundary is missing from both caches, and in that case all the missing
+    boundaries are extracted in the same read. The boundaries are returned as
+    prepared `shapely` geometries, in a dictionary keyed by county name."""
+    checksum = _cached_shapefile_checksum(
+        DATA_DIR + shp_fp,
+        _shapefile_version(DATA_DIR + shp_fp),
+    )
+
+    boundaries, missing = {}, []
+    for county in counties:
+        if (county, checksum) not in _COUNTY_BOUNDARIES:
+            cache_fp = _county_cache_fp(county, checksum)
+            if not os.path.isfile(cache_fp):
+                missing.append(county)
+                continue
+            with open(cache_fp, 'rb') as f:
+                boundary = shapely.from_wkb(f.read())
+            shapely.prepare(boundary)
+            _COUNTY_BOUNDARIES[(county, checksum)] = boundary
+        boundaries[county] = _COUNTY_BOUNDARIES[(county, checksum)]
+
+    if missing:
+        shp = gpd.read_file(DATA_DIR + shp_fp, encoding='UTF-8')
+        os.makedirs(DATA_DIR + COUNTY_CACHE_DIR, exist_ok=True)
+        for county in missing:
+            # Filter on county name.
+            county_geoms = shp.loc[shp['COUNTY'] == county, 'geometry']
+            if county_geoms.empty:
+                raise ValueError('Shape file not found!')
+            boundary = shapely.union_all(np.asarray(county_geoms.values))
 
-    Given a Tracts object and a GEOID10 tract name, use the `longitude` and
-    `latitude` attributes to construct a MULTIPOLYGON definition from the lists
-    of longitudes and latitudes."""
+            # the boundary is written to a temporary file first, so that no
+            # process reads a half-written boundary; the name of the file
+            # includes the process ID, since several processes can fill the
+            # cache at the same time
+            cache_fp = _county_cache_fp(county, checksum)
+            tmp_fp = f"{cache_fp}.{os.getpid()}.tmp"
+            with open(tmp_fp, 'wb') as f:
+                f.write(shapely.to_wkb(boundary))
+            os.replace(tmp_fp, cache_fp)
 
-    polygons = []
-    multipolygon_constructor = 'MULTIPOLYGON('
+            shapely.prepare(boundary)
+            _COUNTY_BOUNDARIES[(county, checksum)] = boundary
+            boundaries[county] = boundary
 
-    geoid_indices = [i for i, _ in enumerate(tracts.tract_names)
-                     if tracts.tract_names[i] == geoid10]
+    return boundaries
 
-    for geoid_idx in geoid_indices:
-        multipolygon_constructor_el = '(('
-        lons = tracts.longitude[geoid_idx]
-        lats = tracts.latitude[geoid_idx]
-        multipolygon_constructor_el += ",".join([f'{lon} {lat}'
-                                                 for lon, lat
-                                                 in zip(lons, lats)])
-        multipolygon_constructor_el += '))'
-        polygons.append(multipolygon_constructor_el)
 
-    if not polygons:
-        return None
-    multipolygon_constructor += ','.join(polygons)
-    multipolygon_constructor += ')'
+def preload_county_boundaries(shp_fp=COUNTY_SHP_FP):
+    """Load the boundaries of all the counties in `COUNTIES`."""
+    counties = sorted(set(county
+                          for state_counties in COUNTIES.values()
+                          for county in state_counties.values()))
 
-    return multipolygon_constructor
+    return load_county_boundaries(counties, shp_fp=shp_fp)
 
 
 class CountyShape:
@@ -80,17 +438,15 @@ class CountyShape:
     a `shp` file with more precise boundary definitions is intersected with
     the tract polygons defined in the US Census. The tract boundaries are
     adjusted to the border coordinates in the `shp` file for tract boundary
-    coordinates found to be outside of the border defined in the `shp` file."""
+    coordinates found to be outside of the border defined in the `shp` file.
 
-    def __init__(self, county):
-        # Read a `shp` file with county edge coordinates.
-        shp_fp = "Bay_Area_County_Boundaries/ark28722-s7hs4j-shapefile/s7hs4j.shp"
-        shp = gpd.read_file(DATA_DIR + shp_fp, encoding='UTF-8')
-        # Filter on county name.
-        if any(shp['COUNTY'] == county):
-            self.boundary = shp[shp['COUNTY'] == county]['geometry']
-        else:
-            raise ValueError('Shape file not found!')
+    The county boundary, including all its islands, is stored in the
+    `boundary` attribute as a single prepared `shapely` geometry. Boundaries
+    are cached (see `load_county_boundaries`), so the `shp` file is not read
+    every time a CountyShape is created."""
+
+    def __init__(self, county, shp_fp=COUNTY_SHP_FP):
+        self.boundary = load_county_boundaries([county], shp_fp=shp_fp)[county]
 
 
 class Tracts:
@@ -120,27 +476,19 @@ class Tracts:
         tracts_df['GEOID10'] = tracts_df['GEOID10'].astype('str')
         self.df = tracts_df
         self.county = county
-        self.longitude, self.latitude = [], []
-        self.tract_names = []
+        self.land_polygons = np.array([], dtype=object)
+        self.tract_names = np.array([], dtype=object)
 
     def _convert_boundary_to_shapely_polygon(self):
         """Convert boundary coordinates to `shapely` POLYGON.
 
         In the tract dataframe, create a column the defines the boundary of
-        each tract in a 'shapely' POLYGON format.
+        each tract in a 'shapely' (MULTI)POLYGON format.
 
         The tract dataframe must have a 'the_geom' column containing the
-        coordinates of the polygon boundaries."""
-
-        start, end = 'MULTIPOLYGON (((', ')))'
-
-        for i, tract in enumerate(self.df['the_geom']):
-            tract_poly_str = tract[len(start):-len(end)]
-            tract_poly_arr = [[float(x.split()[0]), float(x.split()[1])]
-                                        for x in tract_poly_str.split(',')]
-            tract_poly = Polygon(tract_poly_arr)
-            self.df.loc[i, 'Polygon'] = tract_poly
+        WKT definitions of the polygon boundaries."""
 
+        self.df['Polygon'] = parse_wkt_column(self.df['the_geom'])
         self.df.drop(labels='the_geom', axis=1, inplace=True)
 
     def get_boundaries(self):
@@ -148,48 +496,40 @@ class Tracts:
 
         The tract polygons have rough edges and do not presisely follow the
         contours of the county's boundary. Intersecting the tracts with the
-        county shape ensures a correct mapping of each tract's land area."""
+        county shape ensures a correct mapping of each tract's land area.
+
+        All the tracts with any land area are intersected with the whole
+        county shape, including its islands, in a single call. The land area
+        of each tract is saved as a MULTIPOLYGON in the 'Land Polygon' column
+        of the tract dataframe. The individual polygons are also kept in the
+        `land_polygons` attribute, with the matching GEOID10 tract names in
+        the `tract_names` attribute."""
 
         self._convert_boundary_to_shapely_polygon()
         county = CountyShape(self.county)
-        # TODO: Would it make more sense to index this by tract id?
-        for i in self.df.index:
-            tract_id = self.df.at[i, 'GEOID10']
-            # If the tract has any land area...
-            if self.df.at[i, 'ALAND10']:
-                # This is the land area of (most of) San Francisco County.
-                # Also included in SF County are a few islands around the
-                # continental part? Those are mapped in sf.values[0][1:19].
-                # I will ignore those areas for now, hence the use of
-                # county.boundary.values[0][0].
-                # TODO: Handle multiple boundary polygons.
-                land_poly = self.df.at[i, 'Polygon'].intersection(
-                            county.boundary.values[0][0])
-                try:
-                    tract_coords_xy = [(x, y)
-                                       for x, y in land_poly.exterior.coords]
-                except AttributeError:
-                    # AttributeError is thrown if the intersection between
-                    # self.df.at[i, 'Polygon'] and county.boundary.values[0][0]
-                    # results in unconnected polygons. The individual polygons
-                    # are then handled separately, making sure that the same tract
-                    # number is assigned to all of them.
-                    multi_land_polys = list(land_poly)
-                    n_polys = len(multi_land_polys)
-                    for p in multi_land_polys:
-                        tract_coords_xy = [(x, y) for x, y in p.exterior.coords]
-                        self.longitude.append(
-                                                [x for x, _ in tract_coords_xy])
-                        self.latitude.append(
-                                                [y for _, y in tract_coords_xy])
-                else:
-                # This else is here just to avoid having all this code under
-                # the `try` statement.
-                    if tract_coords_xy:
-                        n_polys = 1
-                        self.longitude.append([x for x, _ in tract_coords_xy])
-                        self.latitude.append([y for _, y in tract_coords_xy])
-                    else:
-                        n_polys = 0
-                finally:
-                    self.tract_names.extend([tract_id]*n_polys)
+
+        has_land = self.df['ALAND10'].fillna(0).values.astype(bool)
+        land_geoms = np.full(len(self.df), None, dtype=object)
+        land_geoms[has_land] = shapely.intersection(
+            self.df['Polygon'].values[has_land],
+            county.boundary,
+        )
+
+        # the intersections can be empty, or they can contain lines and points
+        # where a tract touches the county border, so only the non-empty
+        # polygons are kept
+        parts, tract_idx = shapely.get_parts(land_geoms, return_index=True)
+        is_land_polygon = (
+            (shapely.get_type_id(parts) == shapely.GeometryType.POLYGON) &
+            ~shapely.is_empty(parts)
+        )
+        self.land_polygons = parts[is_land_polygon]
+        self.tract_names = self.df['GEOID10'].to_numpy(dtype=object)[
+            tract_idx[is_land_polygon]
+        ]
+
+        land_multipolygons = np.full(len(self.df), None, dtype=object)
+        shapely.multipolygons(self.land_polygons,
+                              indices=tract_idx[is_land_polygon],
+                              out=land_multipolygons)
+        self.df['Land Polygon'] = land_multipolygons
@@ -1,7 +1,7 @@
+from functools import lru_cache
+
 import yaml
-import pandas as pd
 import holidays
-from joblib import load
 import numpy as np
 from geoalchemy2.shape import to_shape
 
@@ -9,8 +9,17 @@ from code.mappings import WEEKEND_DAYS, \
                           PRIORITY_CODES, \
                           AMBULANCE_UNITS, \
                           TRIG_PARAMS, \
-                          DEGREES_TO_MILES
-from code.location_tools import get_locations_as_shape
+                          FEATURE_COLS, \
+                          TIME_FEATURE_COLS, \
+                          CALL_SCHEMA
+from code.tract_tools import get_point_coords
+from code.model_registry import get_model
+
+
+# range of years covered by the holiday calendars, unless the data goes
+# beyond it
+HOLIDAY_FIRST_YEAR = 2000
+HOLIDAY_LAST_YEAR = 2030
 
 
 def get_fig_components(
@@ -44,15 +53,47 @@ def _evaluate_circular_feature(
     )
 
 
-def set_time_features(df,
-                      flag_weekends=True,
-                      flag_holidays=True,
-                      country='US',
-                      prov=None,
-                      state='CA',
-                    ):
-    """Split the date into year, day of year, day of the week, and hour."""
-    df['Year'] = pd.DatetimeIndex(df['Received DtTm']).year
+def _get_holiday_calendar_for_years(years, country, state, prov):
+    """Return the holiday calendar covering the given years.
+
+    The calendar covers the years from `HOLIDAY_FIRST_YEAR` to
+    `HOLIDAY_LAST_YEAR`, extended to the given years if needed."""
+    return get_holiday_calendar(
+        country=country,
+        state=state,
+        prov=prov,
+        first_year=int(min(years.min(), HOLIDAY_FIRST_YEAR)),
+        last_year=int(max(years.max(), HOLIDAY_LAST_YEAR)),
+    )
+
+
+def encode_time_features(received_dttms,
+                         out=None,
+                         columns=FEATURE_COLS,
+                         flag_weekends=True,
+                         flag_holidays=True,
+                         country='US',
+                         prov=None,
+                         state='CA',
+                         ):
+    """Encode the time features of the calls into a feature matrix.
+
+    The features in `TIME_FEATURE_COLS` are computed from the array of
+    datetimes at which the calls were received in a single vectorized pass,
+    and written to the matching columns of `out`, a float32 matrix with one
+    row per call and one column per feature in `columns`. If `out` is None, a
+    matrix of zeros is allocated. The other columns of the matrix are left
+    untouched, as are the weekend and holiday flags if they're not
+    requested. Return the matrix."""
+    dttms = np.asarray(received_dttms, dtype='datetime64[m]')
+    if out is None:
+        out = np.zeros((len(dttms), len(columns)), dtype=np.float32)
+    col_index = {col: i for i, col in enumerate(columns)}
+
+    days = dttms.astype('datetime64[D]')
+    year_starts = dttms.astype('datetime64[Y]')
+    years = year_starts.astype(np.int64) + 1970
+    out[:, col_index['Year']] = years
 
     # The hour, day of the week, and the day of the year are circular features.
     # For example, in the case of hours, 23:30 is closer to 00:10 than 00:10 is
@@ -62,59 +103,138 @@ def set_time_features(df,
     # angle of a point on the circle corresponds to the hour, and the hour
     # 24:00 corresponds to 2pi.
 
-    # subtract 1 to have the days start at 0 and end at 365
-    # (for leap years; or 364 otherwise)
-    day_of_year = df['Received DtTm'].dt.dayofyear - 1
-    df['Day_of_Year_sin'], df['Day_of_Year_cos'] = _evaluate_circular_feature(
+    # the days start at 0 and end at 365 (for leap years; or 364 otherwise)
+    day_of_year = (days - year_starts.astype('datetime64[D]')).astype(np.int64)
+    (out[:, col_index['Day_of_Year_sin']],
+     out[:, col_index['Day_of_Year_cos']]) = _evaluate_circular_feature(
         day_of_year,
         param='day_of_year',
     )
 
-    day_of_week = df['Received DtTm'].dt.weekday
-    df['Day_of_Week'] = day_of_week
-    df['Day_of_Week_sin'], df['Day_of_Week_cos'] = _evaluate_circular_feature(
+    # 1970-01-01 was a Thursday, and the days of the week start on Monday
+    day_of_week = (days.astype(np.int64) + 3) % 7
+    (out[:, col_index['Day_of_Week_sin']],
+     out[:, col_index['Day_of_Week_cos']]) = _evaluate_circular_feature(
         day_of_week,
         param='day_of_week',
     )
 
-    hour = df['Received DtTm'].dt.hour + df['Received DtTm'].dt.minute / 60.
-    df['Hour_sin'], df['Hour_cos'] = _evaluate_circular_feature(
+    hour = (dttms - days).astype(np.int64) / 60.
+    (out[:, col_index['Hour_sin']],
+     out[:, col_index['Hour_cos']]) = _evaluate_circular_feature(
         hour,
         param='hour',
     )
 
     if flag_weekends:
-        df = set_weekends(df)
+        out[:, col_index['is_weekend']] = np.isin(day_of_week, WEEKEND_DAYS)
+
+    if flag_holidays and len(dttms):
+        calendar = _get_holiday_calendar_for_years(years, country, state, prov)
+        out[:, col_index['is_holiday']] = is_holiday(days, calendar)
+
+    return out
+
+
+def build_feature_matrix(df, received_dttms, **time_feature_kwargs):
+    """Build the float32 feature matrix of the calls, in `FEATURE_COLS` order.
+
+    The time features are encoded from the `received_dttms` array (see
+    `encode_time_features`), and the other features are copied from the
+    columns of the dataframe."""
+    out = encode_time_features(received_dttms, **time_feature_kwargs)
+    for i, col in enumerate(FEATURE_COLS):
+        if col not in TIME_FEATURE_COLS:
+            out[:, i] = df[col].values
+
+    return out
+
 
-    if flag_holidays:
-        df = set_holidays(
-                df,
-                country=country,
-                prov=prov,
-                state=state,
-            )
+def set_time_features(df,
+                      flag_weekends=True,
+                      flag_holidays=True,
+                      country='US',
+                      prov=None,
+                      state='CA',
+                    ):
+    """Split the date into year, day of year, day of the week, and hour.
+
+    The features are encoded in one pass (see `encode_time_features`) and
+    added to the dataframe, replacing the 'Received DtTm' column."""
+    columns = [col for col in TIME_FEATURE_COLS
+               if not (col == 'is_weekend' and not flag_weekends) and
+                  not (col == 'is_holiday' and not flag_holidays)]
+
+    features = encode_time_features(df['Received DtTm'].values,
+                                    columns=TIME_FEATURE_COLS,
+                                    flag_weekends=flag_weekends,
+                                    flag_holidays=flag_holidays,
+                                    country=country,
+                                    prov=prov,
+                                    state=state)
+
+    for col in columns:
+        i = TIME_FEATURE_COLS.index(col)
+        if col in ['Year', 'is_weekend', 'is_holiday']:
+            df[col] = features[:, i].astype(int)
+        else:
+            df[col] = features[:, i]
+
+    # without the weekend flag, the day of the week is kept as is
+    if not flag_weekends:
+        df['Day_of_Week'] = df['Received DtTm'].dt.weekday
 
     df.drop('Received DtTm', axis=1, inplace=True)
 
     return df
 
 
-def set_weekends(df):
-    """Flag calls received on weekends."""
-    is_weekend_func = lambda d: 1 if d in WEEKEND_DAYS else 0
-    df['is_weekend'] = df['Day_of_Week'].apply(is_weekend_func)
+@lru_cache(maxsize=None)
+def get_holiday_calendar(country='US',
+                         state='CA',
+                         prov=None,
+                         first_year=HOLIDAY_FIRST_YEAR,
+                         last_year=HOLIDAY_LAST_YEAR):
+    """Return the sorted array of holiday dates between two years.
+
+    The calendar of each country/state/province and year range is only built
+    once per process."""
+    holiday_list = holidays.CountryHoliday(
+        country,
+        prov=prov,
+        state=state,
+        years=range(first_year, last_year + 1),
+    )
 
-    df.drop('Day_of_Week', axis=1, inplace=True)
+    return np.array(sorted(holiday_list.keys()), dtype='datetime64[D]')
 
-    return df
+
+def is_holiday(dttms, calendar):
+    """Flag the datetimes that fall on one of the dates of a calendar.
+
+    The datetimes are truncated to their dates, which are then looked up in
+    the sorted calendar all at once."""
+    days = np.asarray(dttms, dtype='datetime64[D]')
+    if not len(calendar):
+        return np.zeros(days.shape, dtype=bool)
+
+    index = np.minimum(np.searchsorted(calendar, days), len(calendar) - 1)
+
+    return calendar[index] == days
 
 
 def set_holidays(df, country='US', state='CA', prov=None):
-    """Flag holidays received on weekends."""
-    holiday_list = holidays.CountryHoliday(country, prov=prov, state=state)
+    """Flag holidays received on weekends.
+
+    The calendar covers the years from `HOLIDAY_FIRST_YEAR` to
+    `HOLIDAY_LAST_YEAR`, extended to the years of the calls if needed."""
+    calendar = _get_holiday_calendar_for_years(df['Received DtTm'].dt.year,
+                                               country,
+                                               state,
+                                               prov)
 
-    is_holiday_func = lambda dttm: 1 if dttm in holiday_list else 0
-    df['is_holiday'] = df['Received DtTm'].apply(is_holiday_func)
+    df['is_holiday'] = is_holiday(df['Received DtTm'].values,
+                                  calendar).astype(int)
 
     return df
 
@@ -145,45 +265,68 @@ def set_new_incident_unit_type(unit_type):
     )
 
 
-def get_shortest_distance(location, pts=None):
-    """Return the shortest distance between a location and a set of points."""
-    return min([location.distance(pt) for pt in pts])
+def _set_dist_to_closest_facility(df, facilities, kind, col,
+                                  haversine=False, raster=None):
+    """Set a column with the distance (in miles) to the closest facility.
 
+    If a `DistanceRaster` built for the same facilities is given, the
+    distances are looked up in it, and only the incidents outside of it have
+    their distances computed."""
+    lngs, lats = get_point_coords(df['Coords'].values)
 
-def find_dist_to_closest_fire_station(df, pts):
-    """Calculate the distance to the closest fire station."""
-
-    # calculate the closest fire station for each incident;
-    # result is in degrees
-    df['Nearest Fire Station'] = df['Coords'].apply(lambda x:
-        get_shortest_distance(x, pts=pts)
-    )
+    if raster is None or raster.haversine != haversine or \
+            not raster.is_current(kind, facilities):
+        df[col], _ = facilities.nearest(lngs, lats, haversine=haversine)
+        return df
 
-    # convert the result to miles
-    df['Nearest Fire Station'] *= DEGREES_TO_MILES
+    distances, _, is_inside = raster.lookup(kind, lngs, lats)
+    if not is_inside.all():
+        distances[~is_inside], _ = facilities.nearest(lngs[~is_inside],
+                                                      lats[~is_inside],
+                                                      haversine=haversine)
+    df[col] = distances
 
     return df
 
 
-def find_dist_to_closest_hospital(df, pts):
-    """Calculate the distance to the closest hospital."""
+def find_dist_to_closest_fire_station(df, facilities, haversine=False,
+                                      raster=None):
+    """Calculate the distance to the closest fire station.
 
-    # calculate the closest fire station for each incident;
-    # result is in degrees
-    df['Nearest Hospital'] = df['Coords'].apply(lambda x:
-        get_shortest_distance(x, pts=pts)
-    )
+    The distances of all the incidents are found at once with the spatial
+    index of the fire stations (see `Facilities.nearest`), or looked up in
+    the precomputed `raster` if given (see `DistanceRaster`)."""
+    return _set_dist_to_closest_facility(df,
+                                         facilities,
+                                         'fire_stations',
+                                         'Nearest Fire Station',
+                                         haversine=haversine,
+                                         raster=raster)
 
-    # convert the result to miles
-    df['Nearest Hospital'] *= DEGREES_TO_MILES
 
-    return df
+def find_dist_to_closest_hospital(df, facilities, haversine=False,
+                                  raster=None):
+    """Calculate the distance to the closest hospital.
+
+    The distances of all the incidents are found at once with the spatial
+    index of the hospitals (see `Facilities.nearest`), or looked up in the
+    precomputed `raster` if given (see `DistanceRaster`)."""
+    return _set_dist_to_closest_facility(df,
+                                         facilities,
+                                         'hospitals',
+                                         'Nearest Hospital',
+                                         haversine=haversine,
+                                         raster=raster)
 
 
 def set_lon_lat_from_shapely_point(df):
-    """Set longitude and latitude columns from the POINT coordinates."""
-    df['Latitude'] = df['Coords'].apply(lambda c: c.y)
-    df['Longitude'] = df['Coords'].apply(lambda c: c.x)
+    """Set longitude and latitude columns from the POINT coordinates.
+
+    The columns are stored in single precision (see `CALL_SCHEMA`), which is
+    also the precision at which the random forest splits on them."""
+    lngs, lats = get_point_coords(df['Coords'].values)
+    df['Longitude'] = lngs.astype(CALL_SCHEMA['Longitude'])
+    df['Latitude'] = lats.astype(CALL_SCHEMA['Latitude'])
 
     df.drop('Coords', axis=1, inplace=True)
 
@@ -191,19 +334,21 @@ def set_lon_lat_from_shapely_point(df):
 
 
 def load_model(filename):
-    """Load a fitted scikit-learn model from the given filename."""
-    return load(filename)
+    """Load a fitted scikit-learn model from the given filename.
+
+    The model is only loaded from disk once per process, or again when a new
+    model is saved to the file (see `model_registry.ModelRegistry`)."""
+    return get_model(filename)
 
 
 def predict_eta(df, filename='rf_model.joblib', model=None):
     """Predict the arrival time of an ambulance using a given model.
 
-    The model can be read from a joblib file, or can be passed directly to
-    the function."""
-    if filename:
-        m = load_model('rf_model.joblib')
-        return m.predict(df)[0]
-    elif model:
-        raise Warning("Sorry, this is not implemented yet...")
+    The model can be passed directly to the function, or read from a joblib
+    file; a model passed directly takes precedence."""
+    if model is not None:
+        return model.predict(df)[0]
+    elif filename:
+        return load_model(filename).predict(df)[0]
     else:
         raise Warning("Either the `filename` or the `model` parameters must be provided.")